@@ -1,6 +1,9 @@
+import time
+from typing import Any, Callable
+
 from app.server_logging import get_logger
-from fastapi import APIRouter, Depends, Query
-from fastapi.responses import Response
+from fastapi import APIRouter, Body, Depends, Query
+from fastapi.responses import ORJSONResponse, Response
 from io import BytesIO
 from pathlib import Path
 
@@ -12,7 +15,7 @@ except Exception:  # pragma: no cover - graceful fallback when pillow is missing
     ImageFont = None
 
 from app.models import HealthResponse, SessionInfo
-from app.websocket.session import get_all_sessions
+from app.websocket.session import get_session_by_id, iter_sessions, session_count
 from app.database.chat_history import get_chat_sessions_for_user
 from .auth import router as auth_router
 from .robot_api import router as robot_router
@@ -35,6 +38,20 @@ logger = get_logger(__name__)
 router = APIRouter(prefix="/api", tags=["API"])
 v1_router = APIRouter(prefix="/api/v1", tags=["API v1"])
 
+# TTL cache nhỏ cho các endpoint bị probe liên tục (health/sessions).
+STATUS_CACHE_TTL_S = 1.0
+_status_cache: dict[str, tuple[float, Any]] = {}
+
+
+def _cached(key: str, build: Callable[[], Any], ttl: float = STATUS_CACHE_TTL_S) -> Any:
+    now = time.monotonic()
+    hit = _status_cache.get(key)
+    if hit is not None and now - hit[0] < ttl:
+        return hit[1]
+    value = build()
+    _status_cache[key] = (now, value)
+    return value
+
 
 def _pick_flashcard_font(size: int, bold: bool = False):
     if ImageFont is None:
@@ -83,30 +100,35 @@ def _pick_flashcard_font(size: int, bold: bool = False):
 
 @router.get("/health", response_model=HealthResponse)
 async def health_check():
-    sessions = get_all_sessions()
-    return HealthResponse(active_sessions=len(sessions))
+    return _cached("health", lambda: HealthResponse(active_sessions=session_count()))
 
 
-@router.get("/sessions", response_model=list[SessionInfo])
-async def list_sessions():
+def _build_session_infos() -> list[SessionInfo]:
+    # Dữ liệu nội bộ server đã đúng kiểu → model_construct bỏ qua validate.
     return [
-        SessionInfo(
+        SessionInfo.model_construct(
             session_id=s.session_id,
             device_id=s.device_id,
             client_id=s.client_id,
             is_speaking=s.is_speaking,
             history_length=len(s.chat_history),
         )
-        for s in get_all_sessions()
+        for s in iter_sessions()
     ]
 
 
+@router.get("/sessions", response_model=list[SessionInfo])
+async def list_sessions():
+    return _cached("sessions", _build_session_infos)
+
+
 @router.get("/sessions/{session_id}/history")
 async def get_history(session_id: str):
-    for s in get_all_sessions():
-        if s.session_id == session_id:
-            return {"session_id": session_id, "history": s.chat_history}
-    return {"error": "Session not found"}
+    s = get_session_by_id(session_id)
+    if s is None:
+        return {"error": "Session not found"}
+    # Trả thẳng ORJSONResponse: history là list dict thuần, bỏ qua jsonable_encoder.
+    return ORJSONResponse({"session_id": session_id, "history": list(s.chat_history)})
 
 
 v1_router.include_router(auth_router)
@@ -406,19 +428,23 @@ async def learning_flashcard(
     return Response(content=svg, media_type="image/svg+xml")
 
 
+_MCP_TOOLS_RESPONSE = {
+    "tools": [
+        {"name": "set_volume",     "description": "Điều chỉnh âm lượng"},
+        {"name": "set_brightness", "description": "Điều chỉnh độ sáng"},
+        {"name": "reboot",         "description": "Khởi động lại thiết bị"},
+    ]
+}
+
+
 @router.post("/mcp/tools")
 async def list_mcp_tools():
-    return {
-        "tools": [
-            {"name": "set_volume",     "description": "Điều chỉnh âm lượng"},
-            {"name": "set_brightness", "description": "Điều chỉnh độ sáng"},
-            {"name": "reboot",         "description": "Khởi động lại thiết bị"},
-        ]
-    }
+    return _MCP_TOOLS_RESPONSE
 
 
 @router.post("/mcp/call/{tool_name}")
-async def call_mcp_tool(tool_name: str, params: dict = {}):
+async def call_mcp_tool(tool_name: str, params: dict | None = Body(default=None)):
+    params = params or {}
     logger.info(f"MCP call: {tool_name} params={params}")
     return {
         "tool":    tool_name,
@@ -5,55 +5,194 @@ ESP32 gửi: Opus 16kHz mono 60ms/frame
 Server trả: Opus 24kHz mono 60ms/frame
 """
 
+import asyncio
+import ctypes
+
 from app.server_logging import get_logger
 from app.config import AudioInputConfig, AudioOutputConfig
 
 import opuslib
+import opuslib.api
+from opuslib.api.decoder import libopus_decode as _libopus_decode
 
 logger = get_logger(__name__)
 
 
 class OpusDecoder:
-    """Decode Opus từ ESP32 → PCM int16."""
+    """Decode Opus từ ESP32 → PCM int16.
+
+    Gọi thẳng `opus_decode` vào 1 buffer ctypes cấp phát sẵn: `Decoder.decode`
+    của opuslib cấp phát buffer mới mỗi frame rồi chuyển PCM qua list int
+    Python, tốn hơn cả phần decode.
+    """
 
     def __init__(self, cfg: AudioInputConfig):
         self._decoder = opuslib.Decoder(fs=cfg.sample_rate, channels=cfg.channels)
         self._frame_size = cfg.frame_size
+        self._channels = cfg.channels
+        self._pcm_out = (ctypes.c_int16 * (cfg.frame_size * cfg.channels))()
+        self._pcm_ptr = ctypes.cast(self._pcm_out, opuslib.api.c_int16_pointer)
 
     def decode(self, opus_data: bytes) -> bytes:
-        """Decode 1 frame Opus → PCM int16 bytes."""
-        return self._decoder.decode(opus_data, self._frame_size)
+        """Decode 1 frame Opus → PCM int16 bytes (1 lần copy ra khỏi buffer ctypes)."""
+        n_samples = _libopus_decode(
+            self._decoder.decoder_state,
+            opus_data,
+            len(opus_data),
+            self._pcm_ptr,
+            self._frame_size,
+            0,
+        )
+        if n_samples < 0:
+            raise opuslib.OpusError(n_samples)
+        return ctypes.string_at(self._pcm_out, n_samples * self._channels * 2)
+
+    @property
+    def max_frame_bytes(self) -> int:
+        """Số bytes PCM tối đa 1 frame decode ra (chỗ trống cần có cho `decode_into`)."""
+        return self._frame_size * self._channels * 2
+
+    def decode_into(self, opus_data: bytes, out: bytearray, offset: int) -> int:
+        """Decode 1 frame Opus ghi thẳng vào `out[offset:]`, trả về số sample đã ghi.
+
+        `out` phải còn ít nhất `max_frame_bytes` từ `offset`. Không cấp phát
+        bytes trung gian; `out` chỉ bị khoá resize trong lúc gọi libopus.
+        """
+        if len(out) - offset < self.max_frame_bytes:
+            raise ValueError("decode_into: output buffer too small")
+        view = (ctypes.c_char * len(out)).from_buffer(out)
+        try:
+            n_samples = _libopus_decode(
+                self._decoder.decoder_state,
+                opus_data,
+                len(opus_data),
+                ctypes.cast(ctypes.addressof(view) + offset, opuslib.api.c_int16_pointer),
+                self._frame_size,
+                0,
+            )
+        finally:
+            del view
+        if n_samples < 0:
+            raise opuslib.OpusError(n_samples)
+        return n_samples * self._channels
+
+
+# OPUS_SIGNAL_* trong opus_defines.h (opuslib không export sẵn).
+_OPUS_SIGNALS = {"voice": 3001, "music": 3002}
+
+# Pool encoder nhàn rỗi theo (sample_rate, channels, bitrate, complexity, signal).
+# Encoder Opus có state nội bộ và không thread-safe nên KHÔNG dùng chung
+# đồng thời giữa các session: mỗi OpusEncoder mượn riêng 1 encoder và trả
+# lại pool khi release(), session sau tái sử dụng thay vì khởi tạo lại.
+_EncoderKey = tuple[int, int, int, int, str]
+_idle_encoders: dict[_EncoderKey, list[opuslib.Encoder]] = {}
+
+
+def _acquire_encoder(key: _EncoderKey) -> opuslib.Encoder:
+    idle = _idle_encoders.get(key)
+    if idle:
+        return idle.pop()
+    sample_rate, channels, bitrate, complexity, signal = key
+    encoder = opuslib.Encoder(
+        fs=sample_rate,
+        channels=channels,
+        application=opuslib.APPLICATION_AUDIO,
+    )
+    encoder.bitrate = bitrate
+    # Complexity 10 (mặc định) tốn CPU nhất; ~5 đủ cho giọng nói TTS.
+    encoder.complexity = complexity
+    # Constrained VBR: bitrate dao động ít, hợp với pacing frame đều.
+    encoder.vbr = 1
+    encoder.vbr_constraint = 1
+    if signal in _OPUS_SIGNALS:
+        encoder.signal = _OPUS_SIGNALS[signal]
+    return encoder
+
+
+def _release_encoder(key: _EncoderKey, encoder: opuslib.Encoder) -> None:
+    # OPUS_RESET_STATE để session sau không kế thừa state dự đoán cũ.
+    encoder.reset_state()
+    _idle_encoders.setdefault(key, []).append(encoder)
 
 
 class OpusEncoder:
     """Encode PCM int16 → Opus để gửi về ESP32."""
 
     def __init__(self, cfg: AudioOutputConfig):
-        self._encoder = opuslib.Encoder(
-            fs=cfg.sample_rate,
-            channels=cfg.channels,
-            application=opuslib.APPLICATION_AUDIO,
-        )
         # Bitrate cao hơn cho TTS 24kHz giúp giữ chi tiết và độ "dày" âm.
-        self._encoder.bitrate = max(16000, int(getattr(cfg, "opus_bitrate", 48000)))
+        bitrate = max(16000, int(getattr(cfg, "opus_bitrate", 48000)))
+        complexity = max(0, min(10, int(getattr(cfg, "opus_complexity", 5))))
+        signal = str(getattr(cfg, "opus_signal", "auto") or "auto").strip().lower()
+        self._key: _EncoderKey = (cfg.sample_rate, cfg.channels, bitrate, complexity, signal)
+        self._encoder: opuslib.Encoder | None = _acquire_encoder(self._key)
         self._frame_size = cfg.frame_size
         self._frame_bytes = cfg.frame_size * 2  # 2 bytes per int16 sample
+        # Lượt encode_all_async đang chạy trong thread (không hủy được giữa chừng)
+        self._inflight: asyncio.Future[list[bytes]] | None = None
 
     @property
     def frame_bytes(self) -> int:
         """Số bytes PCM cần cho 1 frame."""
         return self._frame_bytes
 
+    def release(self) -> None:
+        """Trả encoder về pool. Nếu còn task encode sau đó sẽ mượn encoder khác.
+
+        Caller bị cancel giữa `encode_all_async` thì thread vẫn đang encode:
+        chỉ trả encoder khi thread đó xong, không để session khác mượn giữa chừng.
+        """
+        encoder, self._encoder = self._encoder, None
+        if encoder is None:
+            return
+        inflight, self._inflight = self._inflight, None
+        if inflight is not None and not inflight.done():
+            key = self._key
+            inflight.add_done_callback(lambda _: _release_encoder(key, encoder))
+        else:
+            _release_encoder(self._key, encoder)
+
+    def _active_encoder(self) -> opuslib.Encoder:
+        if self._encoder is None:
+            self._encoder = _acquire_encoder(self._key)
+        return self._encoder
+
     def encode(self, pcm_data: bytes) -> bytes:
         """Encode 1 frame PCM int16 → Opus bytes."""
-        return self._encoder.encode(pcm_data, self._frame_size)
+        return self._active_encoder().encode(pcm_data, self._frame_size)
+
+    def encode_many(self, frames: list[bytes]) -> list[bytes]:
+        """Encode 1 lô frame PCM đã cắt sẵn, bind encoder/frame_size 1 lần cho cả lô."""
+        encode = self._active_encoder().encode
+        frame_size = self._frame_size
+        return [encode(frame, frame_size) for frame in frames]
 
     def encode_all(self, pcm_data: bytes) -> list[bytes]:
-        """Chia PCM thành frames và encode tất cả → list Opus frames."""
-        frames = []
-        offset = 0
-        while offset + self._frame_bytes <= len(pcm_data):
-            chunk = pcm_data[offset : offset + self._frame_bytes]
-            frames.append(self.encode(chunk))
-            offset += self._frame_bytes
+        """Chia PCM thành frames và encode tất cả → list Opus frames.
+
+        Bọc input bằng memoryview 1 lần để cắt frame không copy cả buffer;
+        opuslib cast con trỏ qua ctypes nên mỗi frame vẫn cần `bytes`.
+        """
+        return self._encode_all_with(self._active_encoder(), pcm_data)
+
+    def _encode_all_with(self, encoder: opuslib.Encoder, pcm_data: bytes) -> list[bytes]:
+        mv = memoryview(pcm_data)
+        n = self._frame_bytes
+        count = len(mv) // n
+        frames: list[bytes] = [b""] * count
+        encode = encoder.encode
+        frame_size = self._frame_size
+        for i in range(count):
+            offset = i * n
+            frames[i] = encode(bytes(mv[offset : offset + n]), frame_size)
         return frames
+
+    async def encode_all_async(self, pcm_data: bytes) -> list[bytes]:
+        """`encode_all` chạy trong thread pool để không chặn event loop.
+
+        opuslib nhả GIL trong lời gọi C nên nhiều session encode song song được.
+        Future được shield: caller bị cancel thì `release()` vẫn biết thread chưa xong.
+        """
+        # Mượn encoder ngay trên event loop, thread chỉ dùng đúng encoder này
+        encoder = self._active_encoder()
+        self._inflight = asyncio.ensure_future(asyncio.to_thread(self._encode_all_with, encoder, pcm_data))
+        return await asyncio.shield(self._inflight)
@@ -0,0 +1,172 @@
+"""
+RMS cho VAD trên frame PCM int16 ngắn (320–960 sample).
+
+Chọn backend lúc import, nhanh nhất trước:
+- numba (tùy chọn): vòng lặp njit 1 lượt, không cấp phát mảng tạm.
+- numpy-rms (tùy chọn): kernel SIMD AVX/NEON.
+- numpy thuần (dot float32 qua BLAS, cũng là SIMD).
+Cả 3 đều trả AC RMS (đã trừ DC offset).
+
+`vad_level` là bản cho VAD: frame gần im lặng trả luôn biên độ đỉnh.
+`VadBatcher` gom frame của nhiều session để tính mức VAD theo lô.
+"""
+
+import asyncio
+import math
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import numpy_rms
+except ImportError:
+    numpy_rms = None
+
+
+def _ac_rms_numpy(samples: np.ndarray) -> float:
+    n = samples.size
+    # float32 để np.dot đi qua BLAS sdot (kernel SIMD sẵn có: AVX2/NEON FMA);
+    # dot trên int64 chỉ là vòng lặp C thường. Sai số float32 (~1e-6 tương đối)
+    # không đáng kể so với ngưỡng VAD.
+    wide = samples.astype(np.float32)
+    mean = float(wide.sum()) / n
+    mean_sq = float(np.dot(wide, wide)) / n
+    # Var = E[x^2] - E[x]^2, tương đương sum((s - mean)^2) / n
+    return math.sqrt(max(mean_sq - mean * mean, 0.0))
+
+
+def _ac_rms_numpy_rms(samples: np.ndarray) -> float:
+    centered = samples.astype(np.float32)
+    centered -= centered.mean()
+    return float(numpy_rms.rms(centered, samples.size)[0])
+
+
+if numba is not None:
+    @numba.njit(cache=True, fastmath=True)
+    def _ac_rms_numba(samples):
+        n = samples.size
+        total = 0.0
+        total_sq = 0.0
+        for i in range(n):
+            v = float(samples[i])
+            total += v
+            total_sq += v * v
+        mean = total / n
+        var = total_sq / n - mean * mean
+        return math.sqrt(var) if var > 0.0 else 0.0
+
+    # Compile ngay lúc import (cache=True → các lần chạy sau đọc từ cache đĩa),
+    # tránh frame đầu tiên của client đầu tiên phải chờ JIT.
+    _ac_rms_numba(np.zeros(2, dtype=np.int16))
+    _ac_rms_impl = _ac_rms_numba
+elif numpy_rms is not None:
+    _ac_rms_impl = _ac_rms_numpy_rms
+else:
+    _ac_rms_impl = _ac_rms_numpy
+
+
+def ac_rms_i16(pcm: bytes) -> float:
+    """AC RMS của PCM int16 little-endian; byte lẻ cuối bị bỏ qua."""
+    n_samples = len(pcm) // 2
+    if not n_samples:
+        return 0.0
+    return float(_ac_rms_impl(np.frombuffer(pcm, dtype=np.int16, count=n_samples)))
+
+
+def batch_ac_rms_i16(frames: list[bytes]) -> list[float]:
+    """`ac_rms_i16` cho nhiều frame: cùng độ dài thì xếp thành ma trận (k, n)
+    và tính cả lô trong vài lời gọi numpy thay vì k lần."""
+    return _batch_level(frames, 0)
+
+
+# Frame có |biên độ| đỉnh dưới mức này: `vad_level` trả luôn đỉnh (cận trên
+# của RMS) thay vì tính tổng bình phương. Ngưỡng thật dùng lúc chạy được kẹp
+# xuống dưới các ngưỡng VAD cấu hình (xem `vad_peak_shortcut`).
+VAD_PEAK_SHORTCUT = 120
+
+
+def vad_peak_shortcut(*thresholds: float) -> int:
+    """Ngưỡng tắt đỉnh an toàn: không vượt quá ngưỡng VAD nào (ngưỡng <= 0 bỏ qua)."""
+    return int(min((VAD_PEAK_SHORTCUT, *(t for t in thresholds if t > 0))))
+
+
+def vad_level(pcm: bytes, peak_shortcut: int = VAD_PEAK_SHORTCUT) -> float:
+    """Mức năng lượng cho VAD: AC RMS, riêng frame có đỉnh < `peak_shortcut` trả đỉnh.
+
+    Chỉ dùng để so với ngưỡng VAD; cần RMS thật (lọc STT...) thì dùng `ac_rms_i16`.
+    """
+    n_samples = len(pcm) // 2
+    if not n_samples:
+        return 0.0
+    samples = np.frombuffer(pcm, dtype=np.int16, count=n_samples)
+    # max/min thay cho abs(): không cấp phát mảng tạm, không tràn ở -32768
+    peak = max(int(samples.max()), -int(samples.min()))
+    if peak < peak_shortcut:
+        return float(peak)
+    return float(_ac_rms_impl(samples))
+
+
+def _batch_level(frames: list[bytes], peak_shortcut: int) -> list[float]:
+    n_bytes = len(frames[0]) if frames else 0
+    if n_bytes < 2 or len(frames) == 1 or any(len(f) != n_bytes for f in frames):
+        if peak_shortcut > 0:
+            return [vad_level(f, peak_shortcut) for f in frames]
+        return [ac_rms_i16(f) for f in frames]
+    n = n_bytes // 2
+    if n_bytes % 2:
+        frames = [f[: n * 2] for f in frames]
+    samples = np.frombuffer(b"".join(frames), dtype=np.int16).reshape(len(frames), n)
+    wide = samples.astype(np.float32)
+    mean = wide.mean(axis=1)
+    mean_sq = np.einsum("ij,ij->i", wide, wide) / n
+    rms = np.sqrt(np.maximum(mean_sq - mean * mean, 0.0))
+    if peak_shortcut <= 0:
+        return rms.tolist()
+    # Cùng quy tắc tắt với vad_level: frame gần im lặng trả về đỉnh
+    peak = np.maximum(samples.max(axis=1).astype(np.int32), -samples.min(axis=1).astype(np.int32))
+    return np.where(peak < peak_shortcut, peak, rms).tolist()
+
+
+def batch_vad_level(frames: list[bytes], peak_shortcut: int = VAD_PEAK_SHORTCUT) -> list[float]:
+    """`vad_level` cho nhiều frame, tính theo lô như `batch_ac_rms_i16`."""
+    return _batch_level(frames, peak_shortcut)
+
+
+class VadBatcher:
+    """Gom frame PCM của mọi session trong 1 cửa sổ ngắn rồi tính RMS 1 lần.
+
+    Frame đầu tiên của cửa sổ hẹn `_flush` sau `window_s`; các frame tới
+    trong lúc đó chờ chung kết quả.
+    """
+
+    def __init__(self, window_s: float, peak_shortcut: int = VAD_PEAK_SHORTCUT):
+        self._window_s = window_s
+        self._peak_shortcut = peak_shortcut
+        self._pending: list[tuple[bytes, asyncio.Future[float]]] = []
+
+    async def submit(self, pcm: bytes) -> float:
+        loop = asyncio.get_running_loop()
+        fut: asyncio.Future[float] = loop.create_future()
+        if not self._pending:
+            loop.call_later(self._window_s, self._flush)
+        self._pending.append((pcm, fut))
+        return await fut
+
+    def _flush(self) -> None:
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        try:
+            values = batch_vad_level([pcm for pcm, _ in pending], self._peak_shortcut)
+        except Exception as e:
+            for _, fut in pending:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for (_, fut), value in zip(pending, values):
+            if not fut.done():
+                fut.set_result(value)
@@ -5,24 +5,44 @@ Cấu hình tập trung cho toàn bộ server.
 Sửa file này để đổi provider STT/LLM/TTS.
 """
 
+import functools
 import os
+import re
 from pathlib import Path
+from types import MappingProxyType
 from pydantic import BaseModel
 from .prompt_store import SYSTEM_PROMPT
 
 
+# KEY=VALUE trên 1 dòng; dòng comment (#...) không khớp vì key phải là identifier.
+_ENV_LINE_RE = re.compile(r"^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*(.*?)[ \t\r]*$", re.MULTILINE)
+
+
+def _read_env_file(path: Path) -> MappingProxyType:
+    """Parse `.env` 1 lần duy nhất → mapping chỉ đọc (key đầu tiên thắng)."""
+    values: dict[str, str] = {}
+    if path.exists():
+        for m in _ENV_LINE_RE.finditer(path.read_text(encoding="utf-8-sig")):
+            values.setdefault(m.group(1), m.group(2))
+    return MappingProxyType(values)
+
+
 _env_path = Path(__file__).resolve().parent.parent / ".env"
-if _env_path.exists():
-    for line in _env_path.read_text(encoding="utf-8-sig").splitlines():
-        line = line.strip()
-        if line and not line.startswith("#") and "=" in line:
-            key, _, value = line.partition("=")
-            os.environ.setdefault(key.strip(), value.strip())
+_env_file_values = _read_env_file(_env_path)
+for _key, _value in _env_file_values.items():
+    os.environ.setdefault(_key, _value)
+
+
+@functools.cache
+def _env(key: str, default: str = "") -> str:
+    """Đọc biến môi trường có cache — giá trị không đổi sau khi process start."""
+    return os.environ.get(key, default)
 
 
 class ServerConfig(BaseModel):
     host: str = "0.0.0.0"
     port: int = 8000
+    workers: int = int(_env("SERVER_WORKERS", "1"))
 
 
 class AudioInputConfig(BaseModel):
@@ -30,6 +50,12 @@ class AudioInputConfig(BaseModel):
     sample_rate: int = 16000
     channels: int = 1
     frame_duration_ms: int = 60
+    # Decode Opus + tính RMS trong thread pool thay vì trên event loop (ctypes
+    # nhả GIL khi gọi libopus). Chỉ đáng khi nhiều thiết bị cùng stream.
+    decode_offload: bool = _env("AUDIO_INPUT_DECODE_OFFLOAD", "false").strip().lower() in {"1", "true", "yes", "on"}
+    # > 0: gom frame của mọi session trong cửa sổ này (ms) rồi tính RMS VAD 1 lần.
+    # Mỗi frame trễ thêm tối đa chừng đó; 0 = tính ngay từng frame.
+    vad_batch_ms: float = max(0.0, float(_env("AUDIO_INPUT_VAD_BATCH_MS", "0")))
 
     @property
     def frame_size(self) -> int:
@@ -37,12 +63,27 @@ class AudioInputConfig(BaseModel):
         return self.sample_rate * self.frame_duration_ms // 1000
 
 
+class VADConfig(BaseModel):
+    """Ngưỡng VAD (RMS int16 / số frame), cố định cho cả deployment."""
+    speech_threshold: int = int(_env("VAD_SPEECH_THRESHOLD", "500"))
+    silence_threshold: int = int(_env("VAD_SILENCE_THRESHOLD", "260"))
+    speech_frames_needed: int = int(_env("VAD_SPEECH_FRAMES", "8"))
+    silence_frames_needed: int = int(_env("VAD_SILENCE_FRAMES", "10"))
+
+
 class AudioOutputConfig(BaseModel):
     """Audio server gửi về ESP32: Opus 24kHz mono 60ms."""
     sample_rate: int = 24000
     channels: int = 1
     frame_duration_ms: int = 60
-    opus_bitrate: int = int(os.environ.get("AUDIO_OUTPUT_OPUS_BITRATE", "48000"))
+    opus_bitrate: int = int(_env("AUDIO_OUTPUT_OPUS_BITRATE", "48000"))
+    # 0-10; thấp hơn = ít CPU hơn mỗi frame encode.
+    opus_complexity: int = int(_env("AUDIO_OUTPUT_OPUS_COMPLEXITY", "5"))
+    # auto | voice | music — encoder dùng chung cho TTS lẫn phát nhạc nên mặc định auto.
+    opus_signal: str = _env("AUDIO_OUTPUT_OPUS_SIGNAL", "auto")
+    # Số frame gửi liền giữa 2 lần sleep pacing. Mỗi frame vẫn là 1 WebSocket
+    # message riêng (ESP32 cần 1 Opus packet / message), chỉ gom nhịp sleep.
+    pacing_batch_frames: int = max(1, int(_env("AUDIO_OUTPUT_PACING_BATCH_FRAMES", "3")))
 
     @property
     def frame_size(self) -> int:
@@ -75,7 +116,7 @@ class LLMConfig(BaseModel):
         default_model_env: str = "OPENAI_LLM_MODEL",
     ) -> "LLMConfig":
         providers = []
-        raw = os.environ.get(providers_env, "")
+        raw = _env(providers_env, "")
         if raw:
             for entry in raw.split(";"):
                 entry = entry.strip()
@@ -87,89 +128,111 @@ class LLMConfig(BaseModel):
                         name=parts[0].strip(),
                         base_url=parts[1].strip(),
                         model=parts[2].strip(),
-                        api_key=parts[3].strip() if len(parts) > 3 else os.environ.get(default_api_key_env, ""),
+                        api_key=parts[3].strip() if len(parts) > 3 else _env(default_api_key_env, ""),
                     ))
 
         if not providers:
             providers.append(LLMProviderConfig(
                 name="default",
-                api_key=os.environ.get(default_api_key_env, os.environ.get("OPENAI_API_KEY", "")),
-                base_url=os.environ.get(default_base_url_env, os.environ.get("OPENAI_BASE_URL", "http://127.0.0.1:8045/v1")),
-                model=os.environ.get(default_model_env, os.environ.get("OPENAI_LLM_MODEL", "claude-sonnet-4-5")),
+                api_key=_env(default_api_key_env, _env("OPENAI_API_KEY", "")),
+                base_url=_env(default_base_url_env, _env("OPENAI_BASE_URL", "http://127.0.0.1:8045/v1")),
+                model=_env(default_model_env, _env("OPENAI_LLM_MODEL", "claude-sonnet-4-5")),
             ))
         return cls(
             providers=providers,
-            max_tokens=int(os.environ.get("LLM_MAX_TOKENS", "500")),
-            temperature=float(os.environ.get("LLM_TEMPERATURE", "0.7")),
+            max_tokens=int(_env("LLM_MAX_TOKENS", "500")),
+            temperature=float(_env("LLM_TEMPERATURE", "0.7")),
         )
 
 
 class OpenAIConfig(BaseModel):
     """Legacy — chỉ còn dùng cho STT nếu cần."""
-    api_key: str = os.environ.get("OPENAI_API_KEY", "")
-    base_url: str = os.environ.get("OPENAI_BASE_URL", "http://127.0.0.1:8045/v1")
+    api_key: str = _env("OPENAI_API_KEY", "")
+    base_url: str = _env("OPENAI_BASE_URL", "http://127.0.0.1:8045/v1")
     stt_model: str = "whisper-1"
 
 
 class STTConfig(BaseModel):
     """STT config — mặc định dùng Groq Whisper."""
     provider: str = "groq" 
-    api_key: str = os.environ.get("GROQ_API_KEY", "")
+    api_key: str = _env("GROQ_API_KEY", "")
     base_url: str = "https://api.groq.com/openai/v1"
     model: str = "whisper-large-v3-turbo" 
 
     language: str = ""  # Rỗng = auto-detect (hỗ trợ cả tiếng Việt + tiếng Anh)
+    # "wav" | "flac" — flac nhỏ ~1/2 payload upload, cần cài thêm `soundfile`
+    upload_format: str = _env("STT_UPLOAD_FORMAT", "wav")
+    # Bỏ qua (không gọi API) khi frame 20ms to nhất vẫn có AC RMS (int16) dưới
+    # ngưỡng này. Mặc định 0 = tắt; bật tùy mic/môi trường, vd. 150.
+    min_rms: float = float(_env("STT_MIN_RMS", "0"))
 
 
 
 class TTSConfig(BaseModel):
-    provider: str = os.environ.get("TTS_PROVIDER", "google")
+    provider: str = _env("TTS_PROVIDER", "google")
 
     # === Google Cloud TTS (primary) ===
-    google_tts_api_key: str = os.environ.get("GOOGLE_TTS_API_KEY", "")
-    google_tts_voice: str = os.environ.get("GOOGLE_TTS_VOICE", "vi-VN-Neural2-A")
-    google_tts_language: str = os.environ.get("GOOGLE_TTS_LANGUAGE", "vi-VN")
-    google_tts_voice_vi: str = os.environ.get("GOOGLE_TTS_VOICE_VI", "vi-VN-Neural2-A")
-    google_tts_voice_en: str = os.environ.get("GOOGLE_TTS_VOICE_EN", "en-US-Neural2-F")
-    google_tts_language_vi: str = os.environ.get("GOOGLE_TTS_LANGUAGE_VI", "vi-VN")
-    google_tts_language_en: str = os.environ.get("GOOGLE_TTS_LANGUAGE_EN", "en-US")
+    google_tts_api_key: str = _env("GOOGLE_TTS_API_KEY", "")
+    google_tts_voice: str = _env("GOOGLE_TTS_VOICE", "vi-VN-Neural2-A")
+    google_tts_language: str = _env("GOOGLE_TTS_LANGUAGE", "vi-VN")
+    google_tts_voice_vi: str = _env("GOOGLE_TTS_VOICE_VI", "vi-VN-Neural2-A")
+    google_tts_voice_en: str = _env("GOOGLE_TTS_VOICE_EN", "en-US-Neural2-F")
+    google_tts_language_vi: str = _env("GOOGLE_TTS_LANGUAGE_VI", "vi-VN")
+    google_tts_language_en: str = _env("GOOGLE_TTS_LANGUAGE_EN", "en-US")
 
     # === Microsoft Edge TTS (backup / optional) ===
-    edge_tts_voice_vi: str = os.environ.get("EDGE_TTS_VOICE_VI", "vi-VN-HoaiMyNeural")
-    edge_tts_voice_en: str = os.environ.get("EDGE_TTS_VOICE_EN", "en-US-JennyNeural")
-    edge_tts_rate_vi: str = os.environ.get("EDGE_TTS_RATE_VI", "+0%")
-    edge_tts_rate_en: str = os.environ.get("EDGE_TTS_RATE_EN", "+0%")
-    edge_tts_pitch_vi: str = os.environ.get("EDGE_TTS_PITCH_VI", "+0Hz")
-    edge_tts_pitch_en: str = os.environ.get("EDGE_TTS_PITCH_EN", "+0Hz")
+    edge_tts_voice_vi: str = _env("EDGE_TTS_VOICE_VI", "vi-VN-HoaiMyNeural")
+    edge_tts_voice_en: str = _env("EDGE_TTS_VOICE_EN", "en-US-JennyNeural")
+    edge_tts_rate_vi: str = _env("EDGE_TTS_RATE_VI", "+0%")
+    edge_tts_rate_en: str = _env("EDGE_TTS_RATE_EN", "+0%")
+    edge_tts_pitch_vi: str = _env("EDGE_TTS_PITCH_VI", "+0Hz")
+    edge_tts_pitch_en: str = _env("EDGE_TTS_PITCH_EN", "+0Hz")
 
     # Ràng buộc ngôn ngữ mặc định cho robot: vi | en | auto
-    language: str = os.environ.get("TTS_LANGUAGE", "auto")
-
-    speed: float = float(os.environ.get("TTS_SPEED", "1.0"))
-    voice_style: str = os.environ.get("TTS_VOICE_STYLE", "normal")
-    volume_gain_db: float = float(os.environ.get("TTS_VOLUME_GAIN_DB", "6.0"))
-    post_gain_db: float = float(os.environ.get("TTS_POST_GAIN_DB", "8.0"))
-    target_rms: float = float(os.environ.get("TTS_TARGET_RMS", "9500"))
-    max_peak: int = int(os.environ.get("TTS_MAX_PEAK", "30000"))
-    max_boost_db: float = float(os.environ.get("TTS_MAX_BOOST_DB", "18.0"))
-    compressor_threshold: float = float(os.environ.get("TTS_COMPRESSOR_THRESHOLD", "0.70"))
-    compressor_ratio: float = float(os.environ.get("TTS_COMPRESSOR_RATIO", "3.0"))
-    post_makeup_db: float = float(os.environ.get("TTS_POST_MAKEUP_DB", "10.0"))
-    softclip_drive: float = float(os.environ.get("TTS_SOFTCLIP_DRIVE", "1.6"))
-    enable_post_loudness: bool = os.environ.get("TTS_ENABLE_POST_LOUDNESS", "true").strip().lower() in {"1", "true", "yes", "on"}
-    log_audio_stats: bool = os.environ.get("TTS_LOG_AUDIO_STATS", "false").strip().lower() in {"1", "true", "yes", "on"}
+    language: str = _env("TTS_LANGUAGE", "auto")
+
+    speed: float = float(_env("TTS_SPEED", "1.0"))
+    voice_style: str = _env("TTS_VOICE_STYLE", "normal")
+    # Piper backup: high = polyphase FIR | fast = nội suy tuyến tính |
+    # auto = fast cho các style robot (vốn đã méo tiếng), high cho còn lại.
+    resample_quality: str = _env("TTS_RESAMPLE_QUALITY", "auto")
+    volume_gain_db: float = float(_env("TTS_VOLUME_GAIN_DB", "6.0"))
+    post_gain_db: float = float(_env("TTS_POST_GAIN_DB", "8.0"))
+    target_rms: float = float(_env("TTS_TARGET_RMS", "9500"))
+    max_peak: int = int(_env("TTS_MAX_PEAK", "30000"))
+    max_boost_db: float = float(_env("TTS_MAX_BOOST_DB", "18.0"))
+    compressor_threshold: float = float(_env("TTS_COMPRESSOR_THRESHOLD", "0.70"))
+    compressor_ratio: float = float(_env("TTS_COMPRESSOR_RATIO", "3.0"))
+    post_makeup_db: float = float(_env("TTS_POST_MAKEUP_DB", "10.0"))
+    softclip_drive: float = float(_env("TTS_SOFTCLIP_DRIVE", "1.6"))
+    enable_post_loudness: bool = _env("TTS_ENABLE_POST_LOUDNESS", "true").strip().lower() in {"1", "true", "yes", "on"}
+    log_audio_stats: bool = _env("TTS_LOG_AUDIO_STATS", "false").strip().lower() in {"1", "true", "yes", "on"}
 
     # === Piper TTS backup config (không dùng nữa, giữ lại để tham khảo) ===
-    audio_profile: str = os.environ.get("TTS_AUDIO_PROFILE", "small-bluetooth-speaker-class-device")
+    audio_profile: str = _env("TTS_AUDIO_PROFILE", "small-bluetooth-speaker-class-device")
+
+    model_path: str = "models/vi_VN-vais1000-medium.onnx"
+    speaker_id: int | None = None
 
-    # model_path: str = os.environ.get("TTS_MODEL_PATH", "models/vi_VN-vais1000-medium.onnx")
-    # speaker_id: int | None = int(os.environ["TTS_SPEAKER_ID"]) if os.environ.get("TTS_SPEAKER_ID") else None
+    @classmethod
+    def from_env(cls) -> "TTSConfig":
+        """Đọc các field Piper từ env lúc dựng config (không chạy ở class body)."""
+        raw_speaker_id = _env("TTS_SPEAKER_ID").strip()
+        try:
+            speaker_id = int(raw_speaker_id) if raw_speaker_id else None
+        except ValueError:
+            speaker_id = None
+        return cls(
+            model_path=_env("TTS_MODEL_PATH", "models/vi_VN-vais1000-medium.onnx"),
+            speaker_id=speaker_id,
+        )
 
 
 class AppConfig(BaseModel):
     server: ServerConfig = ServerConfig()
     audio_input: AudioInputConfig = AudioInputConfig()
     audio_output: AudioOutputConfig = AudioOutputConfig()
+    vad: VADConfig = VADConfig()
     openai: OpenAIConfig = OpenAIConfig()
     llm: LLMConfig = LLMConfig()
     intent_llm: LLMConfig = LLMConfig()
@@ -178,7 +241,7 @@ class AppConfig(BaseModel):
     max_chat_history: int = 20
 
 
-_intent_provider_env = os.environ.get("INTENT_LLM_PROVIDERS", "").strip()
+_intent_provider_env = _env("INTENT_LLM_PROVIDERS", "").strip()
 if _intent_provider_env:
     _intent_llm_cfg = LLMConfig.from_env(
         providers_env="INTENT_LLM_PROVIDERS",
@@ -193,4 +256,5 @@ else:
 config = AppConfig(
     llm=LLMConfig.from_env(),
     intent_llm=_intent_llm_cfg,
+    tts=TTSConfig.from_env(),
 )
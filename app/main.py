@@ -1,8 +1,9 @@
+import asyncio
 import os
 from app.server_logging import get_logger
 from fastapi import FastAPI, Request, WebSocket
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, RedirectResponse
 from pathlib import Path
 from starlette.middleware.sessions import SessionMiddleware
 
@@ -14,7 +15,10 @@ from app.api.auth_google import router as auth_google_router
 from app.api.auth import router as auth_local_router
 from app.api.orders import router as orders_router
 from app.websocket.handler import handle_client
+from app.mcp import close_http_session
 from app.mcp.alarm_scheduler import start_scheduler
+from app.services.llm import close_llm_clients
+from app.services.stt import close_stt_clients
 from app.database.connection import init_database
 
 logger = get_logger(__name__)
@@ -26,6 +30,7 @@ app = FastAPI(
     docs_url=None,         # Ẩn /docs
     redoc_url=None,        # Ẩn /redoc
     openapi_url=None,      # Ẩn /openapi.json
+    default_response_class=ORJSONResponse,
 )
 
 # SessionMiddleware cho OAuth state (authlib cần session để lưu state/nonce)
@@ -112,4 +117,13 @@ async def on_startup():
     logger.info(f"   TTS style : {config.tts.voice_style}")
     logger.info(f"   Audio in  : {config.audio_input.sample_rate}Hz")
     logger.info(f"   Audio out : {config.audio_output.sample_rate}Hz")
+    # uvicorn[standard] cài uvloop và loop="auto" tự chọn nó (trừ Windows).
+    logger.info(f"   Event loop: {type(asyncio.get_running_loop()).__module__}")
     logger.info("=" * 60)
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await close_http_session()
+    await close_llm_clients()
+    await close_stt_clients()
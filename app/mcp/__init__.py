@@ -1,5 +1,5 @@
 """MCP tools package."""
 
-from app.mcp.tools import MCPToolRegistry
+from app.mcp.tools import MCPToolRegistry, close_http_session
 
-__all__ = ["MCPToolRegistry"]
+__all__ = ["MCPToolRegistry", "close_http_session"]
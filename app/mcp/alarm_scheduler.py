@@ -11,22 +11,104 @@ from __future__ import annotations
 
 import asyncio
 import json
+from collections import OrderedDict
+from collections.abc import AsyncIterator
 from app.server_logging import get_logger
 import os
+import stat
 from datetime import datetime
 from typing import Any
 
+try:
+    import fcntl
+except ImportError:  # Windows: không có flock, chỉ chạy được 1 worker
+    fcntl = None
+
+from app.mcp.alarm_store import flush_alarms, load_alarms, mark_alarms_dirty
 from app.websocket import handler as ws_handler
 from app.websocket.session import get_all_sessions
 
 logger = get_logger(__name__)
 
+_MODULE_DIR = os.path.dirname(__file__)
+
 # Default ringtone path (generated if missing)
-DEFAULT_RINGTONE = os.path.join(os.path.dirname(__file__), "BaoThuc.mp3")
+DEFAULT_RINGTONE = os.path.join(_MODULE_DIR, "BaoThuc.mp3")
+
+_REMOTE_PREFIXES = ("http://", "https://", "rtsp://", "ftp://")
+
+# JSON điều khiển TTS dựng sẵn; chỉ session_id thay đổi. session_id chỉ gồm
+# ký tự hex nên chèn thẳng vào chuỗi JSON không cần escape.
+_TTS_START_JSON = '{"type": "tts", "state": "start", "session_id": "%s"}'
+_TTS_SENTENCE_JSON = '{"type": "tts", "state": "sentence_start", "text": %s, "session_id": "%s"}'
+_TTS_STOP_JSON = '{"type": "tts", "state": "stop", "session_id": "%s"}'
+
+# Số frame Opus gửi liền nhau trước mỗi lần sleep pacing (4 x 60ms = 240ms)
+RINGTONE_BATCH_FRAMES = 4
 
+# Cache Opus frames của ringtone file local: decode + encode 1 lần rồi phát
+# cho mọi session. LRU theo tổng dung lượng frames.
+RINGTONE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+_ringtone_cache: OrderedDict[str, list[bytes]] = OrderedDict()
+_ringtone_cache_bytes = 0
+_ringtone_locks: dict[str, asyncio.Lock] = {}
 
-async def _trigger_alarm_for_session(session, ws, alarm: dict[str, Any]):
-    """Send alarm message + ringtone to a single session/ws.
+
+def _cache_ringtone(path: str, frames: list[bytes]) -> None:
+    global _ringtone_cache_bytes
+    size = sum(len(f) for f in frames)
+    if size > RINGTONE_CACHE_MAX_BYTES:
+        return
+    _ringtone_cache[path] = frames
+    _ringtone_cache_bytes += size
+    while _ringtone_cache_bytes > RINGTONE_CACHE_MAX_BYTES:
+        _, evicted = _ringtone_cache.popitem(last=False)
+        _ringtone_cache_bytes -= sum(len(f) for f in evicted)
+
+
+def _is_local_file(path: str) -> bool:
+    try:
+        return stat.S_ISREG(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+def _resolve_ringtone_path(ringtone: str) -> str:
+    """URL giữ nguyên; đường dẫn tương đối tính theo thư mục module này."""
+    if ringtone.lower().startswith(_REMOTE_PREFIXES) or os.path.isabs(ringtone):
+        return ringtone
+    return os.path.join(_MODULE_DIR, ringtone)
+
+
+async def _get_ringtone_frames(tts, path: str) -> list[bytes]:
+    """Opus frames của 1 file ringtone local (cache dùng chung giữa sessions)."""
+    frames = _ringtone_cache.get(path)
+    if frames is not None:
+        _ringtone_cache.move_to_end(path)
+        return frames
+
+    lock = _ringtone_locks.setdefault(path, asyncio.Lock())
+    async with lock:
+        frames = _ringtone_cache.get(path)
+        if frames is None:
+            frames = [frame async for frame in tts.stream_audio_url(path)]
+            if frames:
+                _cache_ringtone(path, frames)
+    return frames
+
+
+async def _iter_ringtone_frames(tts, path: str) -> AsyncIterator[bytes]:
+    """File local → phát từ cache; URL remote → stream trực tiếp qua ffmpeg."""
+    if _is_local_file(path):
+        for frame in await _get_ringtone_frames(tts, path):
+            yield frame
+        return
+    async for frame in tts.stream_audio_url(path):
+        yield frame
+
+
+async def _trigger_alarm_for_session(session, alarm: dict[str, Any]):
+    """Send alarm message + ringtone to a single connected session.
 
     Uses the session.pipeline._tts to stream audio frames and sends JSON
     notifications similar to other TTS flows in the project.
@@ -36,26 +118,18 @@ async def _trigger_alarm_for_session(session, ws, alarm: dict[str, Any]):
         try:
             session.is_idling = False
             session.is_speaking = True
-            session.aborted = False
+            session.abort_event.clear()
         except Exception:
             pass
 
-        # Inform client TTS start + sentence
-        # Acquire per-session send lock if available to avoid concurrent send races
-        send_lock = getattr(ws_handler, "_session_send_locks", {}).get(session.session_id)
-        try:
-            if send_lock:
-                await send_lock.acquire()
-            await ws.send_text(json.dumps({"type": "tts", "state": "start", "session_id": session.session_id}, ensure_ascii=False))
-            await ws.send_text(json.dumps({"type": "tts", "state": "sentence_start", "text": alarm.get("message", "Báo thức"), "session_id": session.session_id}, ensure_ascii=False))
-        except Exception:
+        # Inform client TTS start + sentence. Mọi message đi qua hàng đợi gửi
+        # của kết nối (cùng sender task với pipeline) nên không ghi xen nhau.
+        message_json = json.dumps(alarm.get("message", "Báo thức"), ensure_ascii=False)
+        await ws_handler.enqueue_send(session, "text", _TTS_START_JSON % session.session_id)
+        if not await ws_handler.enqueue_send(
+            session, "text", _TTS_SENTENCE_JSON % (message_json, session.session_id)
+        ):
             logger.warning("Failed to send TTS start/sentence to session %s", session.session_id)
-        finally:
-            if send_lock and send_lock.locked():
-                try:
-                    send_lock.release()
-                except Exception:
-                    pass
 
         # Play ringtone if provided, else TTS speak the message
         ringtone = alarm.get("ringtone") or DEFAULT_RINGTONE
@@ -63,11 +137,7 @@ async def _trigger_alarm_for_session(session, ws, alarm: dict[str, Any]):
 
         if ringtone:
             # If local path, ffmpeg accepts it. Otherwise treat as URL.
-            path = ringtone
-            if not os.path.isabs(path):
-                # Try relative to this module
-                base = os.path.dirname(__file__)
-                path = os.path.join(base, path)
+            path = _resolve_ringtone_path(str(ringtone))
 
             # Play the file at least once (stream_audio_url yields opus frames).
             # If alarm has `play_duration` (seconds) and it's longer than file length,
@@ -83,31 +153,35 @@ async def _trigger_alarm_for_session(session, ws, alarm: dict[str, Any]):
             total_played_s = 0.0
             played_once = False
 
-            # Helper to stream one full pass and return played seconds
+            # Helper to stream one full pass and return played seconds.
+            # Frames are queued in batches of RINGTONE_BATCH_FRAMES with one
+            # pacing sleep per batch. Each frame stays its own binary message
+            # because the ESP32 expects one Opus packet each.
             async def _stream_once() -> float:
                 frames = 0
-                async for frame in tts.stream_audio_url(path):
-                        try:
-                            if send_lock:
-                                await send_lock.acquire()
-                            await ws.send_bytes(frame)
-                        except Exception:
+                batch: list[bytes] = []
+
+                async def _flush() -> bool:
+                    for pending in batch:
+                        if not await ws_handler.enqueue_send(session, "bytes", pending):
                             logger.warning("Failed to send audio frame to %s", session.session_id)
-                            if send_lock and send_lock.locked():
-                                try:
-                                    send_lock.release()
-                                except Exception:
-                                    pass
+                            return False
+                    # pacing to match client playback
+                    await asyncio.sleep(len(batch) * tts.frame_duration_s)
+                    batch.clear()
+                    # Client gửi abort → dừng chuông (queue đã bỏ frame còn chờ)
+                    return not session.abort_event.is_set()
+
+                async for frame in _iter_ringtone_frames(tts, path):
+                    batch.append(frame)
+                    if len(batch) >= RINGTONE_BATCH_FRAMES:
+                        if not await _flush():
                             return float(frames) * tts.frame_duration_s
-                        finally:
-                            if send_lock and send_lock.locked():
-                                try:
-                                    send_lock.release()
-                                except Exception:
-                                    pass
-                        frames += 1
-                        # pacing to match client playback
-                        await asyncio.sleep(tts.frame_duration_s)
+                        frames += RINGTONE_BATCH_FRAMES
+                if batch:
+                    sent = len(batch)
+                    if await _flush():
+                        frames += sent
                 return float(frames) * tts.frame_duration_s
 
             while True:
@@ -131,16 +205,14 @@ async def _trigger_alarm_for_session(session, ws, alarm: dict[str, Any]):
         else:
             # Fallback: TTS speak the message
             async for frame in tts.synthesize(alarm.get("message", "Báo thức")):
-                try:
-                    await ws.send_bytes(frame)
-                    await asyncio.sleep(tts.frame_duration_s)
-                except Exception:
+                if not await ws_handler.enqueue_send(session, "bytes", frame):
                     logger.warning("Failed to send TTS frame to %s", session.session_id)
+                    break
+                await asyncio.sleep(tts.frame_duration_s)
+                if session.abort_event.is_set():
+                    break
 
-        try:
-            await ws.send_text(json.dumps({"type": "tts", "state": "stop", "session_id": session.session_id}, ensure_ascii=False))
-        except Exception:
-            pass
+        await ws_handler.enqueue_send(session, "text", _TTS_STOP_JSON % session.session_id)
         # restore speaking flag
         try:
             session.is_speaking = False
@@ -153,23 +225,14 @@ async def _trigger_alarm_for_session(session, ws, alarm: dict[str, Any]):
 
 
 async def _alarm_loop(poll_interval: float = 5.0) -> None:
-    base = os.path.dirname(__file__)
-    path = os.path.join(base, "alarms.json")
-
     # ensure default ringtone exists
     _ensure_default_ringtone()
 
     while True:
         now = datetime.now()
         try:
-            if not os.path.exists(path):
-                await asyncio.sleep(poll_interval)
-                continue
-
-            with open(path, "r", encoding="utf-8") as f:
-                alarms = json.load(f)
+            alarms = load_alarms()
 
-            changed = False
             for alarm in alarms:
                 if alarm.get("triggered"):
                     continue
@@ -182,23 +245,20 @@ async def _alarm_loop(poll_interval: float = 5.0) -> None:
                 if now >= alarm_dt:
                     # mark triggered asap to avoid double-trigger
                     alarm["triggered"] = True
-                    changed = True
+                    mark_alarms_dirty()
 
                     # Deliver to all connected sessions (best-effort)
                     sessions = get_all_sessions()
                     for session in sessions:
-                        ws = ws_handler._session_ws.get(session.session_id)
-                        if not ws:
+                        if not ws_handler.get_session_ws(session.session_id):
                             continue
                         # fire off tasks per session
-                        asyncio.create_task(_trigger_alarm_for_session(session, ws, alarm))
+                        asyncio.create_task(_trigger_alarm_for_session(session, alarm))
 
-            if changed:
-                try:
-                    with open(path, "w", encoding="utf-8") as f:
-                        json.dump(alarms, f, ensure_ascii=False, indent=2)
-                except Exception as e:
-                    logger.error("Failed to update alarms.json: %s", e, exc_info=True)
+            try:
+                flush_alarms()
+            except Exception as e:
+                logger.error("Failed to update alarms.json: %s", e, exc_info=True)
 
         except Exception as e:
             logger.error("Alarm scheduler error: %s", e, exc_info=True)
@@ -206,7 +266,36 @@ async def _alarm_loop(poll_interval: float = 5.0) -> None:
         await asyncio.sleep(poll_interval)
 
 
+# flock giữ suốt đời process: chạy --workers N thì chỉ 1 worker chạy scheduler.
+SCHEDULER_LOCK_PATH = os.path.join(_MODULE_DIR, "alarm_scheduler.lock")
+_scheduler_lock_fd: int | None = None
+
+
+def _acquire_scheduler_lock() -> bool:
+    """True nếu process này giành được quyền chạy scheduler."""
+    global _scheduler_lock_fd
+    if _scheduler_lock_fd is not None:
+        return True
+    if fcntl is None:
+        return True
+    fd = os.open(SCHEDULER_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    _scheduler_lock_fd = fd
+    return True
+
+
 async def start_scheduler() -> None:
+    if not _acquire_scheduler_lock():
+        logger.info(
+            "Alarm scheduler already running in another worker (pid %s skips it); "
+            "alarms only reach devices connected to that worker",
+            os.getpid(),
+        )
+        return
     logger.info("Starting alarm scheduler background task")
     asyncio.create_task(_alarm_loop())
 
@@ -216,13 +305,16 @@ def _ensure_default_ringtone(duration_s: float = 3.0, rate: int = 24000) -> None
 
     This avoids adding copyrighted ringtones to the repo.
     """
-    if os.path.exists(DEFAULT_RINGTONE):
+    try:
+        os.stat(DEFAULT_RINGTONE)
         return
+    except FileNotFoundError:
+        pass
 
     try:
-        import math
         import wave
-        import struct
+
+        import numpy as np
 
         logger.info("Generating default ringtone: %s", DEFAULT_RINGTONE)
         freq1 = 880.0
@@ -230,18 +322,18 @@ def _ensure_default_ringtone(duration_s: float = 3.0, rate: int = 24000) -> None
         amplitude = 16000
         n_samples = int(rate * duration_s)
 
+        # simple two-tone melody (beep-buzz), tính cả buffer 1 lần
+        t = np.arange(n_samples, dtype=np.float64) / rate
+        samples = (amplitude * 0.5) * (
+            np.sin(2.0 * np.pi * freq1 * t) + 0.6 * np.sin(2.0 * np.pi * freq2 * t)
+        )
+        pcm = np.clip(samples, -32767, 32767).astype("<i2")
+
         with wave.open(DEFAULT_RINGTONE, "w") as wf:
             wf.setnchannels(1)
             wf.setsampwidth(2)
             wf.setframerate(rate)
-            for i in range(n_samples):
-                t = float(i) / rate
-                # simple two-tone melody (beep-buzz)
-                sample = amplitude * 0.5 * (
-                    math.sin(2.0 * math.pi * freq1 * t) + 0.6 * math.sin(2.0 * math.pi * freq2 * t)
-                )
-                val = int(max(-32767, min(32767, sample)))
-                wf.writeframes(struct.pack('<h', val))
+            wf.writeframes(pcm.tobytes())
         logger.info("Default ringtone generated")
     except Exception as e:
         logger.error("Failed to generate default ringtone: %s", e, exc_info=True)
@@ -0,0 +1,219 @@
+"""Lưu trữ báo thức cạnh file này.
+
+- `alarms.json`: snapshot dạng JSON array (file gốc, vẫn đọc được bằng tay).
+- `alarms.jsonl`: log append-only; đặt báo thức mới chỉ ghi thêm 1 dòng
+  (O_APPEND) thay vì ghi lại toàn bộ snapshot.
+- Đọc: chỉ parse lại khi mtime snapshot đổi; log dài thêm thì chỉ đọc phần
+  đuôi mới. Entry trùng `id` thì bản trong log thắng.
+- Scheduler đánh dấu dirty khi sửa alarm trong cache; `flush_alarms` gom
+  mọi thay đổi của 1 vòng poll vào đúng 1 lần ghi snapshot (compact luôn log).
+- Compact: ghi + fsync `alarms.json.tmp` → xóa log → đổi tmp thành snapshot.
+  Crash ở bất kỳ bước nào sau khi tmp ghi xong thì lần đọc sau nhận tmp (đã
+  chứa mọi entry của log), không phát lại dòng log cũ đè lên trạng thái mới.
+- Nhiều process (uvicorn --workers) cùng ghi: mọi thao tác ghi và compact
+  chạy dưới flock trên `alarms.lock`; trước khi compact đọc nốt phần log do
+  process khác vừa append để không xóa mất.
+"""
+from __future__ import annotations
+
+import contextlib
+import os
+import threading
+from collections.abc import Iterator
+from typing import Any
+
+import orjson
+
+try:
+    import fcntl
+except ImportError:  # Windows: chỉ có lock trong process
+    fcntl = None
+
+ALARMS_PATH = os.path.join(os.path.dirname(__file__), "alarms.json")
+ALARMS_LOG_PATH = os.path.join(os.path.dirname(__file__), "alarms.jsonl")
+ALARMS_LOCK_PATH = os.path.join(os.path.dirname(__file__), "alarms.lock")
+_TMP_PATH = f"{ALARMS_PATH}.tmp"
+
+_cached_alarms: list[dict[str, Any]] = []
+_snapshot_mtime: int | None = None
+_log_offset = 0  # Số byte log đã gộp vào cache
+_loaded = False
+_dirty = False
+# append_alarm có thể chạy trong worker thread (asyncio.to_thread); lock giữ cho
+# "ghi log + cập nhật cache" và "ghi snapshot + xóa log" không xen nhau.
+_write_lock = threading.RLock()
+_flock_depth = 0
+
+
+@contextlib.contextmanager
+def _locked() -> Iterator[None]:
+    """Lock trong process + flock giữa các process (lồng nhau được)."""
+    global _flock_depth
+    with _write_lock:
+        if fcntl is None or _flock_depth:
+            # flock mở fd mới trong cùng process sẽ tự chặn chính nó → chỉ lock lần ngoài cùng
+            _flock_depth += 1
+            try:
+                yield
+            finally:
+                _flock_depth -= 1
+            return
+        fd = os.open(ALARMS_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            _flock_depth = 1
+            yield
+        finally:
+            _flock_depth = 0
+            os.close(fd)  # close nhả luôn flock
+
+
+def _snapshot_mtime_now() -> int | None:
+    try:
+        return os.stat(ALARMS_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _recover_pending_snapshot() -> None:
+    """Crash giữa lúc compact: tmp parse được nghĩa là đã ghi xong → nó là bản mới nhất."""
+    try:
+        with open(_TMP_PATH, "rb") as f:
+            data = orjson.loads(f.read())
+    except FileNotFoundError:
+        return
+    except orjson.JSONDecodeError:
+        # Crash khi đang ghi tmp: log vẫn còn nguyên → bỏ tmp
+        os.remove(_TMP_PATH)
+        return
+    if not isinstance(data, list):
+        os.remove(_TMP_PATH)
+        return
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(ALARMS_LOG_PATH)
+    os.replace(_TMP_PATH, ALARMS_PATH)
+
+
+def _read_snapshot() -> list[dict[str, Any]]:
+    try:
+        with open(ALARMS_PATH, "rb") as f:
+            data = orjson.loads(f.read())
+    except FileNotFoundError:
+        return []
+    return data if isinstance(data, list) else []
+
+
+def _apply_log_tail(alarms: list[dict[str, Any]], offset: int) -> int:
+    """Gộp các dòng log từ `offset` vào `alarms`; trả offset mới (chỉ tính dòng trọn vẹn)."""
+    try:
+        with open(ALARMS_LOG_PATH, "rb") as f:
+            f.seek(offset)
+            tail = f.read()
+    except FileNotFoundError:
+        return 0
+
+    # Dòng cuối chưa có "\n" (đang ghi dở) → để lần sau đọc lại
+    complete = tail.rfind(b"\n") + 1
+    index = {a.get("id"): i for i, a in enumerate(alarms)}
+    for line in tail[:complete].splitlines():
+        if not line.strip():
+            continue
+        try:
+            alarm = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            # Dòng hỏng (crash giữa chừng) → bỏ qua
+            continue
+        pos = index.get(alarm.get("id"))
+        if pos is None:
+            index[alarm.get("id")] = len(alarms)
+            alarms.append(alarm)
+        else:
+            alarms[pos] = alarm
+    return offset + complete
+
+
+def _log_size() -> int:
+    try:
+        return os.stat(ALARMS_LOG_PATH).st_size
+    except FileNotFoundError:
+        return 0
+
+
+def _refresh() -> None:
+    """Đồng bộ cache với file (gọi khi đang giữ `_write_lock`)."""
+    global _cached_alarms, _snapshot_mtime, _log_offset, _loaded
+    if os.path.exists(_TMP_PATH):
+        with _locked():
+            _recover_pending_snapshot()
+
+    mtime = _snapshot_mtime_now()
+    size = _log_size()
+    if not _loaded or mtime != _snapshot_mtime or size < _log_offset:
+        # Snapshot đổi / log bị compact bởi process khác → đọc lại toàn bộ
+        alarms = _read_snapshot()
+        _log_offset = _apply_log_tail(alarms, 0)
+        _cached_alarms = alarms
+        _snapshot_mtime = mtime
+        _loaded = True
+    elif size > _log_offset:
+        _log_offset = _apply_log_tail(_cached_alarms, _log_offset)
+
+
+def load_alarms() -> list[dict[str, Any]]:
+    """Trả list báo thức; file không đổi từ lần đọc trước → không parse lại."""
+    with _write_lock:
+        _refresh()
+        return _cached_alarms
+
+
+def append_alarm(alarm: dict[str, Any]) -> None:
+    """Thêm 1 báo thức: ghi đúng 1 dòng vào log, không đụng tới snapshot."""
+    line = orjson.dumps(alarm, option=orjson.OPT_APPEND_NEWLINE)
+    with _locked():
+        fd = os.open(ALARMS_LOG_PATH, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        # Đọc phần đuôi log (gồm dòng vừa ghi + dòng process khác ghi trước đó)
+        _refresh()
+
+
+def save_alarms(alarms: list[dict[str, Any]]) -> None:
+    """Ghi toàn bộ list báo thức một cách atomic (compact log) và cập nhật cache."""
+    global _cached_alarms, _snapshot_mtime, _log_offset, _loaded, _dirty
+    with _locked():
+        # Process khác có thể vừa append: gộp nốt phần log chưa đọc trước khi xóa log
+        if alarms is _cached_alarms:
+            _refresh()
+            alarms = _cached_alarms
+        data = orjson.dumps(alarms, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE)
+        with open(_TMP_PATH, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # Xóa log TRƯỚC khi thay snapshot: crash ở giữa thì tmp (đã đủ dữ liệu)
+        # được nhận lại ở lần đọc sau, không có dòng log cũ nào đè lên nữa.
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(ALARMS_LOG_PATH)
+        os.replace(_TMP_PATH, ALARMS_PATH)
+        _cached_alarms = alarms
+        _snapshot_mtime = _snapshot_mtime_now()
+        _log_offset = 0
+        _loaded = True
+        _dirty = False
+
+
+def mark_alarms_dirty() -> None:
+    """Đánh dấu list trong cache đã bị sửa tại chỗ, cần flush xuống file."""
+    global _dirty
+    _dirty = True
+
+
+def flush_alarms() -> bool:
+    """Ghi cache xuống file nếu dirty. Trả True nếu có ghi."""
+    with _write_lock:
+        if not _dirty:
+            return False
+        save_alarms(_cached_alarms)
+        return True
@@ -5,18 +5,141 @@ Hiện tại tập trung vào tool tìm nhạc Việt.
 
 from __future__ import annotations
 
-import json
+import asyncio
 from app.server_logging import get_logger
 from dataclasses import dataclass
 from typing import Any
-from urllib.parse import urlencode
-from urllib.request import urlopen
-import os
 import uuid
 from datetime import datetime, date, time, timedelta
 
+import aiohttp
+import orjson
+
+from app.mcp.alarm_store import append_alarm
+from app.ttl_cache import TTLCache
+
 logger = get_logger(__name__)
 
+DEEZER_SEARCH_URL = "https://api.deezer.com/search"
+
+# Session HTTP dùng chung để tái sử dụng kết nối TCP/TLS tới Deezer.
+# Giữ kết nối idle lâu hơn mặc định (15s) để lượt tìm kế tiếp khỏi bắt tay lại.
+HTTP_KEEPALIVE_S = 60.0
+_http_session: aiohttp.ClientSession | None = None
+
+
+def _get_http_session() -> aiohttp.ClientSession:
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=12),
+            connector=aiohttp.TCPConnector(
+                limit_per_host=8,
+                ttl_dns_cache=300,
+                keepalive_timeout=HTTP_KEEPALIVE_S,
+            ),
+        )
+    return _http_session
+
+
+# LRU + TTL cho kết quả tìm nhạc, key theo (query, limit). Nhiều session hỏi
+# cùng 1 bài cùng lúc chỉ gọi Deezer 1 lần.
+MUSIC_SEARCH_CACHE_TTL_S = 600.0
+MUSIC_SEARCH_CACHE_MAX = 256
+_music_search_cache: TTLCache[tuple[str, int], list[dict[str, Any]]] = TTLCache(
+    MUSIC_SEARCH_CACHE_TTL_S, MUSIC_SEARCH_CACHE_MAX
+)
+
+
+async def close_http_session() -> None:
+    """Đóng session HTTP dùng chung (gọi khi server shutdown)."""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+def _parse_hhmm(value: str) -> time:
+    """Parse 'H:MM'/'HH:MM' (như strptime "%H:%M") mà không qua module _strptime."""
+    hh, sep, mm = value.partition(":")
+    if (
+        sep
+        and 1 <= len(hh) <= 2
+        and 1 <= len(mm) <= 2
+        and hh.isascii()
+        and hh.isdigit()
+        and mm.isascii()
+        and mm.isdigit()
+    ):
+        return time(int(hh), int(mm))  # ngoài 0-23 / 0-59 → ValueError
+    raise ValueError(f"Không phải HH:MM: {value!r}")
+
+
+# Schema tool là hằng số → dựng 1 lần lúc import.
+_TOOLS_SCHEMA: list[dict[str, Any]] = [
+    {
+        "name": "search_vietnamese_music",
+        "description": "Tìm nhạc Việt theo từ khóa (artist/bài hát), trả metadata và link nghe.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "song_name": {
+                    "type": "string",
+                    "description": "Tên bài hát cần tìm, ví dụ: Nơi này có anh",
+                },
+                "query": {
+                    "type": "string",
+                    "description": "Từ khóa tìm kiếm, ví dụ: Son Tung M-TP",
+                },
+                "limit": {
+                    "type": "integer",
+                    "description": "Số kết quả tối đa (1-20)",
+                    "minimum": 1,
+                    "maximum": 20,
+                    "default": 5,
+                },
+            },
+            "required": [],
+        },
+    },
+    {
+        "name": "set_alarm",
+        "description": "Đặt báo thức: cung cấp `time` (ISO datetime hoặc HH:MM) và `message`.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "time": {
+                    "type": "string",
+                    "description": "Thời gian báo thức. ISO datetime (ví dụ 2026-02-18T07:30:00) hoặc giờ phút 'HH:MM' (ví dụ '07:30').",
+                },
+                "message": {"type": "string", "description": "Nội dung thông báo"},
+                "id": {"type": "string", "description": "ID tùy chọn cho báo thức"},
+            },
+            "required": ["time"],
+        },
+    },
+    {
+        "name": "set_volume",
+        "description": "Điều chỉnh âm lượng (0-100)",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "volume": {
+                    "type": "integer",
+                    "description": "Mức âm lượng (0-100)",
+                    "minimum": 0,
+                    "maximum": 100,
+                },
+            },
+            "required": ["volume"],
+        },
+    },
+]
+
+
+# Bản JSON dựng sẵn của schema cho các chỗ gửi thẳng ra socket.
+_TOOLS_SCHEMA_JSON: str = orjson.dumps(_TOOLS_SCHEMA).decode()
+
 
 @dataclass(slots=True)
 class MCPToolResult:
@@ -31,74 +154,20 @@ class MCPToolRegistry:
 
     def list_tools(self) -> list[dict[str, Any]]:
         """Trả danh sách tool theo format gần JSON-Schema."""
-        return [
-            {
-                "name": "search_vietnamese_music",
-                "description": "Tìm nhạc Việt theo từ khóa (artist/bài hát), trả metadata và link nghe.",
-                "inputSchema": {
-                    "type": "object",
-                    "properties": {
-                        "song_name": {
-                            "type": "string",
-                            "description": "Tên bài hát cần tìm, ví dụ: Nơi này có anh",
-                        },
-                        "query": {
-                            "type": "string",
-                            "description": "Từ khóa tìm kiếm, ví dụ: Son Tung M-TP",
-                        },
-                        "limit": {
-                            "type": "integer",
-                            "description": "Số kết quả tối đa (1-20)",
-                            "minimum": 1,
-                            "maximum": 20,
-                            "default": 5,
-                        },
-                    },
-                    "required": [],
-                },
-            },
-            {
-                "name": "set_alarm",
-                "description": "Đặt báo thức: cung cấp `time` (ISO datetime hoặc HH:MM) và `message`.",
-                "inputSchema": {
-                    "type": "object",
-                    "properties": {
-                        "time": {
-                            "type": "string",
-                            "description": "Thời gian báo thức. ISO datetime (ví dụ 2026-02-18T07:30:00) hoặc giờ phút 'HH:MM' (ví dụ '07:30').",
-                        },
-                        "message": {"type": "string", "description": "Nội dung thông báo"},
-                        "id": {"type": "string", "description": "ID tùy chọn cho báo thức"},
-                    },
-                    "required": ["time"],
-                },
-            },
-            {
-                "name": "set_volume",
-                "description": "Điều chỉnh âm lượng (0-100)",
-                "inputSchema": {
-                    "type": "object",
-                    "properties": {
-                        "volume": {
-                            "type": "integer",
-                            "description": "Mức âm lượng (0-100)",
-                            "minimum": 0,
-                            "maximum": 100,
-                        },
-                    },
-                    "required": ["volume"],
-                },
-            },
-        ]
+        return _TOOLS_SCHEMA
+
+    def list_tools_json(self) -> str:
+        """Như `list_tools` nhưng đã serialize sẵn thành JSON (không encode lại mỗi lần)."""
+        return _TOOLS_SCHEMA_JSON
 
     async def call_tool(self, name: str, arguments: dict[str, Any] | None) -> MCPToolResult:
         """Gọi 1 tool theo tên."""
         arguments = arguments or {}
 
         if name == "search_vietnamese_music":
-            return self._tool_search_vietnamese_music(arguments)
+            return await self._tool_search_vietnamese_music(arguments)
         if name == "set_alarm":
-            return self._tool_set_alarm(arguments)
+            return await self._tool_set_alarm(arguments)
         if name == "set_volume":
             return self._tool_set_volume(arguments)
 
@@ -124,8 +193,8 @@ class MCPToolRegistry:
             ],
         )
 
-    def _tool_set_alarm(self, arguments: dict[str, Any]) -> MCPToolResult:
-        """Đặt báo thức: lưu vào file alarms.json gần file này.
+    async def _tool_set_alarm(self, arguments: dict[str, Any]) -> MCPToolResult:
+        """Đặt báo thức: ghi thêm vào log alarms.jsonl gần file này.
 
         Hỗ trợ `time` dạng ISO datetime hoặc `HH:MM` (sẽ áp dụng cho ngày hiện tại hoặc ngày tiếp theo nếu đã qua thời gian).
         Trả về object alarm đã lưu.
@@ -143,8 +212,7 @@ class MCPToolRegistry:
             alarm_dt = datetime.fromisoformat(str(time_raw))
         except Exception:
             try:
-                hhmm = str(time_raw).strip()
-                t = datetime.strptime(hhmm, "%H:%M").time()
+                t = _parse_hhmm(str(time_raw).strip())
                 today = date.today()
                 candidate = datetime.combine(today, t)
                 now = datetime.now()
@@ -165,34 +233,27 @@ class MCPToolRegistry:
             "triggered": False,
         }
 
-        # Persist to alarms.json next to this file
+        # Append 1 dòng vào alarms.jsonl next to this file
         try:
-            base = os.path.dirname(__file__)
-            path = os.path.join(base, "alarms.json")
-            alarms: list[dict[str, Any]] = []
-            if os.path.exists(path):
-                try:
-                    with open(path, "r", encoding="utf-8") as f:
-                        alarms = json.load(f)
-                except Exception:
-                    alarms = []
-
-            alarms.append(alarm)
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(alarms, f, ensure_ascii=False, indent=2)
-
-            return MCPToolResult(
-                ok=True,
-                content=[
-                    {"type": "text", "text": f"Đã đặt báo thức: {alarm['time']} (id={alarm_id})"},
-                    {"type": "json", "json": {"alarm": alarm}},
-                ],
-            )
+            # Ghi file trong worker thread để disk chậm không chặn event loop
+            await asyncio.to_thread(append_alarm, alarm)
+        except OSError as e:
+            # Lỗi I/O là lỗi vận hành dự kiến → không cần traceback
+            logger.warning("Lỗi lưu alarm: %r", e)
+            return MCPToolResult(ok=False, content=[{"type": "text", "text": f"Lỗi lưu báo thức: {e}"}])
         except Exception as e:
             logger.error("Lỗi lưu alarm: %s", e, exc_info=True)
             return MCPToolResult(ok=False, content=[{"type": "text", "text": f"Lỗi lưu báo thức: {e}"}])
 
-    def _tool_search_vietnamese_music(self, arguments: dict[str, Any]) -> MCPToolResult:
+        return MCPToolResult(
+            ok=True,
+            content=[
+                {"type": "text", "text": f"Đã đặt báo thức: {alarm['time']} (id={alarm_id})"},
+                {"type": "json", "json": {"alarm": alarm}},
+            ],
+        )
+
+    async def _tool_search_vietnamese_music(self, arguments: dict[str, Any]) -> MCPToolResult:
         song_name = str(arguments.get("song_name", "")).strip()
         query = song_name or str(arguments.get("query", "")).strip()
         if not query:
@@ -208,25 +269,7 @@ class MCPToolRegistry:
             limit = 5
 
         try:
-            params = urlencode({"q": query, "limit": str(limit)})
-            url = f"https://api.deezer.com/search?{params}"
-
-            with urlopen(url, timeout=12) as resp:
-                data = json.loads(resp.read().decode("utf-8"))
-
-            items = data.get("data", [])
-            tracks = []
-            for item in items[:limit]:
-                tracks.append(
-                    {
-                        "title": item.get("title"),
-                        "artist": (item.get("artist") or {}).get("name"),
-                        "album": (item.get("album") or {}).get("title"),
-                        "deezer_url": item.get("link"),
-                        "preview_url": item.get("preview"),
-                        "duration": item.get("duration"),
-                    }
-                )
+            tracks = await self._fetch_deezer_tracks(query, limit)
 
             text = f"Tìm thấy {len(tracks)} kết quả nhạc cho: {query}"
             return MCPToolResult(
@@ -246,9 +289,44 @@ class MCPToolRegistry:
                     },
                 ],
             )
+        except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError) as e:
+            # Deezer lỗi mạng/timeout/trả rác: dự kiến được → log gọn, không traceback
+            logger.warning("MCP tool search_vietnamese_music failed: %r", e)
+            return MCPToolResult(
+                ok=False,
+                content=[{"type": "text", "text": f"Lỗi gọi Deezer API: {e}"}],
+            )
         except Exception as e:
             logger.error("MCP tool search_vietnamese_music failed: %s", e, exc_info=True)
             return MCPToolResult(
                 ok=False,
                 content=[{"type": "text", "text": f"Lỗi gọi Deezer API: {e}"}],
             )
+
+    async def _fetch_deezer_tracks(self, query: str, limit: int) -> list[dict[str, Any]]:
+        """Gọi Deezer search, có cache LRU/TTL theo (query, limit)."""
+        cache_key = (" ".join(query.casefold().split()), limit)
+        return await _music_search_cache.get_or_fetch(
+            cache_key, lambda: self._request_deezer_tracks(query, limit)
+        )
+
+    async def _request_deezer_tracks(self, query: str, limit: int) -> list[dict[str, Any]]:
+        params = {"q": query, "limit": str(limit)}
+        async with _get_http_session().get(DEEZER_SEARCH_URL, params=params) as resp:
+            resp.raise_for_status()
+            data = orjson.loads(await resp.read())
+
+        items = data.get("data", [])
+        tracks = []
+        for item in items[:limit]:
+            tracks.append(
+                {
+                    "title": item.get("title"),
+                    "artist": (item.get("artist") or {}).get("name"),
+                    "album": (item.get("album") or {}).get("title"),
+                    "deezer_url": item.get("link"),
+                    "preview_url": item.get("preview"),
+                    "duration": item.get("duration"),
+                }
+            )
+        return tracks
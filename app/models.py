@@ -4,21 +4,27 @@ Pydantic models cho JSON messages giữa ESP32 và server.
 Mỗi model tương ứng 1 loại message trong protocol.
 """
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Optional
 
 
+class _FrozenModel(BaseModel):
+    """Message bất biến: dựng 1 lần, chỉ đọc/serialize (an toàn khi cache dùng chung)."""
+
+    model_config = ConfigDict(frozen=True)
+
+
 # ── Client → Server ──────────────────────────────────────────
 
 
-class AudioParams(BaseModel):
+class AudioParams(_FrozenModel):
     format: str = "opus"
     sample_rate: int = 16000
     channels: int = 1
     frame_duration: int = 60
 
 
-class ClientHello(BaseModel):
+class ClientHello(_FrozenModel):
     type: str = "hello"
     version: int = 1
     transport: str = "websocket"
@@ -26,14 +32,14 @@ class ClientHello(BaseModel):
     audio_params: AudioParams = Field(default_factory=AudioParams)
 
 
-class ListenMessage(BaseModel):
+class ListenMessage(_FrozenModel):
     type: str = "listen"
     state: str  # "start" | "stop" | "detect"
     mode: str = "auto"  # "auto" | "manual" | "realtime"
     text: Optional[str] = None  # wake word text (khi state="detect")
 
 
-class AbortMessage(BaseModel):
+class AbortMessage(_FrozenModel):
     type: str = "abort"
     reason: str = "none"
 
@@ -41,27 +47,27 @@ class AbortMessage(BaseModel):
 # ── Server → Client ──────────────────────────────────────────
 
 
-class ServerHello(BaseModel):
+class ServerHello(_FrozenModel):
     type: str = "hello"
     transport: str = "websocket"
     session_id: str
     audio_params: AudioParams
 
 
-class TTSMessage(BaseModel):
+class TTSMessage(_FrozenModel):
     type: str = "tts"
     state: str  # "start" | "stop" | "sentence_start"
     session_id: str
     text: Optional[str] = None  # chỉ dùng khi state="sentence_start"
 
 
-class STTMessage(BaseModel):
+class STTMessage(_FrozenModel):
     type: str = "stt"
     text: str
     session_id: str
 
 
-class LLMMessage(BaseModel):
+class LLMMessage(_FrozenModel):
     type: str = "llm"
     emotion: str  # "happy" | "sad" | "neutral" | ...
     session_id: str
@@ -70,7 +76,7 @@ class LLMMessage(BaseModel):
 # ── REST API ──────────────────────────────────────────────────
 
 
-class SessionInfo(BaseModel):
+class SessionInfo(_FrozenModel):
     session_id: str
     device_id: str
     client_id: str
@@ -78,7 +84,7 @@ class SessionInfo(BaseModel):
     history_length: int
 
 
-class HealthResponse(BaseModel):
+class HealthResponse(_FrozenModel):
     status: str = "ok"
     version: str = "1.0.0"
     active_sessions: int = 0
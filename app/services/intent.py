@@ -23,18 +23,92 @@ from app.services.learning_content import find_topic
 
 logger = get_logger(__name__)
 
+# Regex dùng trong detect_fast — compile 1 lần lúc import.
+_WS_RE = re.compile(r"\s+")
+_BABY_RE = re.compile(r"\bbaby\b")
+_VOLUME_RE = re.compile(r"(tăng|giảm)\s*(âm\s*lượng|volume)\s*(lên|xuống)?\s*(\d{1,3})?\s*%?")
+_BRIGHTNESS_RE = re.compile(r"(tăng|giảm)\s*(độ\s*sáng|brightness)\s*(lên|xuống)?\s*(\d{1,3})?\s*%?")
+_FLASH_RE = re.compile(r"\bflash[a-z0-9]*\b")
+_ALARM_TIME_RES = (
+    re.compile(r"(\d{1,2}:\d{2})\s*(am|pm)?"),
+    re.compile(r"(\d{1,2})\s*(am|pm)"),
+    re.compile(r"(\d{1,2})h(?:ố?i|ờ)?\s*(\d{1,2})?"),
+    re.compile(r"(\d{1,2})\s*giờ\s*(\d{1,2})?"),
+)
+_HOUR_RE = re.compile(r"(\d{1,2})")
+# Gộp 4 lượt re.sub (từ khóa báo thức, buổi, am/pm, giờ số) thành 1 alternation.
+_ALARM_CLEAN_RE = re.compile(
+    r"\b(?:đặt\s+báo\s+thức|báo\s+thức|hẹn\s+giờ|báo|báo\s+cho\s+tôi)\b"
+    r"|\b(?:sáng|chiều|tối)\b"
+    r"|\b(?:am|pm)\b"
+    r"|\d{1,2}(?::\d{2})?h?\b",
+    re.IGNORECASE,
+)
+# Từ khóa khớp theo substring (như `w in lowered`); mỗi nhóm là 1 alternation
+# nên chỉ quét chuỗi 1 lượt trong C. Tách trigger/music thành 2 regex riêng vì
+# chúng chồng nhau ("play" nằm trong "playlist").
+_TRIGGER_RE = re.compile("|".join(map(re.escape, ("mở", "mơ", "mỡ", "phát", "bật", "nghe", "play"))))
+_MUSIC_KW_RE = re.compile("|".join(map(re.escape, ("nhạc", "bài", "bài hát", "ca sĩ", "playlist", "music"))))
+_ALARM_TRIGGER_RE = re.compile("|".join(map(re.escape, ("báo thức", "đặt báo thức", "hẹn giờ", "báo", "báo cho tôi"))))
+# Từ lệnh bỏ khỏi câu để lấy tên bài (so khớp theo token, bỏ dấu câu 2 đầu).
+_MUSIC_COMMAND_WORDS = frozenset(("mở", "mơ", "phát", "bật", "nghe", "play", "bài", "nhạc", "music"))
+_MUSIC_COMMAND_PAIRS = frozenset((("cho", "tôi"), ("giúp", "tôi"), ("bài", "hát")))
+_TOKEN_PUNCT = ",.!?:;\"'“”‘’"
+
+
+def _strip_marks(text: str) -> str:
+    normalized = unicodedata.normalize("NFD", text)
+    return "".join(ch for ch in normalized if unicodedata.category(ch) != "Mn")
+
+
+def _build_fold_table() -> dict[int, str | None]:
+    """Bảng translate: chữ Latin có dấu → chữ gốc, dấu kết hợp → bỏ, đ → d."""
+    table: dict[int, str | None] = {}
+    for cp in (*range(0x00C0, 0x0250), *range(0x1E00, 0x1F00)):
+        ch = chr(cp)
+        base = _strip_marks(ch)
+        if base != ch:
+            table[cp] = base
+    for cp in range(0x0300, 0x0370):
+        if unicodedata.category(chr(cp)) == "Mn":
+            table[cp] = None
+    table[ord("đ")] = "d"
+    return table
+
+
+_VI_FOLD = _build_fold_table()
+
 
 def _normalize_vi_text(text: str) -> str:
     lowered = (text or "").strip().lower()
-    normalized = unicodedata.normalize("NFD", lowered)
-    without_marks = "".join(ch for ch in normalized if unicodedata.category(ch) != "Mn")
-    without_marks = without_marks.replace("đ", "d")
-    return re.sub(r"\s+", " ", without_marks).strip()
+    # 1 lượt str.translate (C) thay cho NFD + lọc category từng ký tự.
+    without_marks = lowered.translate(_VI_FOLD)
+    if not without_marks.isascii():
+        # Ký tự ngoài bảng (chữ viết khác, ký hiệu...) → đi đường đầy đủ.
+        without_marks = _strip_marks(without_marks).replace("đ", "d")
+    return _WS_RE.sub(" ", without_marks).strip()
+
+
+def _strip_music_command_words(lowered: str) -> str:
+    """1 lượt split + lọc token thay cho re.sub từ khóa rồi re.sub khoảng trắng."""
+    tokens = [(tok, tok.strip(_TOKEN_PUNCT)) for tok in lowered.split()]
+    kept: list[str] = []
+    i = 0
+    n = len(tokens)
+    while i < n:
+        tok, core = tokens[i]
+        if i + 1 < n and (core, tokens[i + 1][1]) in _MUSIC_COMMAND_PAIRS:
+            i += 2
+            continue
+        if core not in _MUSIC_COMMAND_WORDS:
+            kept.append(tok)
+        i += 1
+    return " ".join(kept).strip(" \n\t" + _TOKEN_PUNCT)
 
 
 def _normalize_music_song_name(song_name: str) -> str:
     normalized = _normalize_vi_text(song_name)
-    if re.search(r"\bbaby\b", normalized):
+    if _BABY_RE.search(normalized):
         return "baby shank"
     return song_name
 
@@ -66,36 +140,27 @@ class IntentDetectorService:
 
         # 1. Volume/Brightness intent
         # Regex: tăng/giảm âm lượng/độ sáng (lên|xuống)? (xx%)?
-        volume_patterns = [
-            r"(tăng|giảm)\s*(âm\s*lượng|volume)\s*(lên|xuống)?\s*(\d{1,3})?\s*%?",
-        ]
-        brightness_patterns = [
-            r"(tăng|giảm)\s*(độ\s*sáng|brightness)\s*(lên|xuống)?\s*(\d{1,3})?\s*%?",
-        ]
-
-        for pat in volume_patterns:
-            m = re.search(pat, lowered)
-            if m:
-                action = m.group(1)
-                value = m.group(4)
-                try:
-                    volume = int(value) if value else (100 if action == "tăng" else 0)
-                    volume = max(0, min(100, volume))
-                except Exception:
-                    volume = 100 if action == "tăng" else 0
-                return IntentResult(intent="set_volume", volume=volume)
-
-        for pat in brightness_patterns:
-            m = re.search(pat, lowered)
-            if m:
-                action = m.group(1)
-                value = m.group(4)
-                try:
-                    brightness = int(value) if value else (100 if action == "tăng" else 0)
-                    brightness = max(0, min(100, brightness))
-                except Exception:
-                    brightness = 100 if action == "tăng" else 0
-                return IntentResult(intent="set_brightness", brightness=brightness)
+        m = _VOLUME_RE.search(lowered)
+        if m:
+            action = m.group(1)
+            value = m.group(4)
+            try:
+                volume = int(value) if value else (100 if action == "tăng" else 0)
+                volume = max(0, min(100, volume))
+            except Exception:
+                volume = 100 if action == "tăng" else 0
+            return IntentResult(intent="set_volume", volume=volume)
+
+        m = _BRIGHTNESS_RE.search(lowered)
+        if m:
+            action = m.group(1)
+            value = m.group(4)
+            try:
+                brightness = int(value) if value else (100 if action == "tăng" else 0)
+                brightness = max(0, min(100, brightness))
+            except Exception:
+                brightness = 100 if action == "tăng" else 0
+            return IntentResult(intent="set_brightness", brightness=brightness)
 
         # 2. Physical flash card vocabulary practice.
         if any(
@@ -115,7 +180,7 @@ class IntentDetectorService:
                 "on tu vung",
                 "luyen tu vung",
             )
-        ) or re.search(r"\bflash[a-z0-9]*\b", normalized):
+        ) or _FLASH_RE.search(normalized):
             return IntentResult(intent="flashcard_vocab", learning_mode="flashcard_vocab")
 
         # 3. Learning conversation intent.
@@ -151,41 +216,15 @@ class IntentDetectorService:
                 topic_id=str(topic.get("id")),
             )
 
-        trigger_words = (
-            "mở",
-            "mơ",
-            "mỡ",
-            "phát",
-            "bật",
-            "nghe",
-            "play",
-        )
-        music_words = (
-            "nhạc",
-            "bài",
-            "bài hát",
-            "ca sĩ",
-            "playlist",
-            "music",
-        )
-
-        has_trigger = any(w in lowered for w in trigger_words)
-        has_music = any(w in lowered for w in music_words)
+        has_trigger = _TRIGGER_RE.search(lowered) is not None
+        has_music = _MUSIC_KW_RE.search(lowered) is not None
         if not (has_trigger and has_music):
             # 3. Alarm intent
-            alarm_triggers = ("báo thức", "đặt báo thức", "hẹn giờ", "báo", "báo cho tôi")
-            if any(w in lowered for w in alarm_triggers):
+            if _ALARM_TRIGGER_RE.search(lowered):
                 # Try extract time with simple regexes
-                time_patterns = [
-                    r"(\d{1,2}:\d{2})\s*(am|pm)?",
-                    r"(\d{1,2})\s*(am|pm)",
-                    r"(\d{1,2})h(?:ố?i|ờ)?\s*(\d{1,2})?",
-                    r"(\d{1,2})\s*giờ\s*(\d{1,2})?",
-                ]
-
                 found = None
-                for pat in time_patterns:
-                    m = re.search(pat, lowered)
+                for pat in _ALARM_TIME_RES:
+                    m = pat.search(lowered)
                     if m:
                         found = m
                         break
@@ -229,41 +268,37 @@ class IntentDetectorService:
                 # Try also match words like 'sáng'/'chiều' to set AM/PM if no explicit
                 if not time_str:
                     if "sáng" in lowered:
-                        m = re.search(r"(\d{1,2})", lowered)
+                        m = _HOUR_RE.search(lowered)
                         if m:
                             hh = int(m.group(1)) % 24
                             if hh == 12:
                                 hh = 0
                             time_str = f"{hh:02d}:00"
                     elif "chiều" in lowered or "tối" in lowered:
-                        m = re.search(r"(\d{1,2})", lowered)
+                        m = _HOUR_RE.search(lowered)
                         if m:
                             hh = int(m.group(1)) % 12 + 12
                             time_str = f"{hh:02d}:00"
 
-                message = re.sub(r"\b(đặt\s+báo\s+thức|báo\s+thức|hẹn\s+giờ|báo|báo\s+cho\s+tôi)\b", " ", lowered, flags=re.IGNORECASE)
-                message = re.sub(r"\b(sáng|chiều|tối)\b", " ", message, flags=re.IGNORECASE)
-                message = re.sub(r"\b(am|pm)\b", " ", message, flags=re.IGNORECASE)
-                message = re.sub(r"\d{1,2}(:\d{2})?h?\b", " ", message)
-                message = re.sub(r"\s+", " ", message).strip(" ,.!?\n\t")
+                message = _ALARM_CLEAN_RE.sub(" ", lowered)
+                message = _WS_RE.sub(" ", message).strip(" ,.!?\n\t")
 
                 return IntentResult(intent="alarm", song_name="", alarm_time=time_str, alarm_message=message or "Báo thức")
 
             return IntentResult(intent="other", song_name="")
 
         # Chuẩn hóa câu lệnh thành tên bài hát truy vấn.
-        cleaned = re.sub(
-            r"\b(mở|mơ|phát|bật|nghe|cho\s+tôi|giúp\s+tôi|play|bài\s+hát|bài|nhạc|music)\b",
-            " ",
-            lowered,
-            flags=re.IGNORECASE,
-        )
-        cleaned = re.sub(r"\s+", " ", cleaned).strip(" ,.!?\n\t")
+        cleaned = _strip_music_command_words(lowered)
         song_name = _normalize_music_song_name(cleaned if cleaned else "nhạc việt")
         return IntentResult(intent="music", song_name=song_name)
 
     async def detect(self, user_text: str) -> IntentResult:
         """Trả về intent và tham số động."""
+        # Rule đã bắt chắc music/alarm → khỏi tốn 1 lượt LLM JSON.
+        fast = self.detect_fast(user_text)
+        if fast.intent in ("music", "alarm"):
+            return fast
+
         prompt = INTENT_PROMPT
         data = await self._llm.chat_json(
             user_text,
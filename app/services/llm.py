@@ -1,17 +1,93 @@
 """LLM (Large Language Model) service — với fallback nhiều provider.
 """
 
-import json
+import functools
+import hashlib
 from app.server_logging import get_logger
-import re
+from collections.abc import Iterable
 from typing import Any, AsyncGenerator
 
 import openai
+import orjson
 
 from app.config import LLMConfig, LLMProviderConfig
 
 logger = get_logger(__name__)
 
+# 1 AsyncOpenAI (kèm pool httpx bên trong) cho mỗi (base_url, api_key),
+# dùng chung giữa mọi session để giữ kết nối keep-alive tới provider.
+_clients: dict[tuple[str, str], openai.AsyncOpenAI] = {}
+
+
+def _get_client(provider: LLMProviderConfig) -> openai.AsyncOpenAI:
+    key = (provider.base_url, provider.api_key)
+    client = _clients.get(key)
+    if client is None:
+        client = openai.AsyncOpenAI(
+            api_key=provider.api_key,
+            base_url=provider.base_url,
+            max_retries=0,  # Không retry để fallback ngay lập tức
+        )
+        _clients[key] = client
+    return client
+
+
+@functools.lru_cache(maxsize=8)
+def _system_message(prompt: str) -> dict[str, str]:
+    """System message dựng sẵn cho các prompt hằng số (INTENT_PROMPT, ...)."""
+    return {"role": "system", "content": prompt}
+
+
+# OpenAI nhận tham số `prompt_cache_key` trong body; backend khác (vLLM,
+# SGLang, Groq...) có thể trả 400 với field lạ nên không gửi. Prompt đứng đầu
+# messages và không đổi giữa các lượt nên prefix caching vẫn tự tái dùng KV.
+_PROMPT_CACHE_KEY_HOSTS = ("api.openai.com",)
+
+
+@functools.lru_cache(maxsize=8)
+def _prompt_cache_key(prompt: str) -> str:
+    return hashlib.blake2b(prompt.encode(), digest_size=8).hexdigest()
+
+
+def _prompt_cache_body(provider: LLMProviderConfig, prompt: str) -> dict[str, str] | None:
+    """`extra_body` gợi ý cache prefix cho system prompt (chỉ với backend hỗ trợ)."""
+    if not any(host in provider.base_url for host in _PROMPT_CACHE_KEY_HOSTS):
+        return None
+    return {"prompt_cache_key": _prompt_cache_key(prompt)}
+
+
+async def _stream_deltas(client: openai.AsyncOpenAI, **kwargs: Any) -> AsyncGenerator[str, None]:
+    """Đọc thẳng SSE của chat.completions stream, yield `delta.content` khác rỗng.
+
+    Bỏ qua bước dựng pydantic ChatCompletionChunk cho từng token: mỗi dòng
+    `data:` chỉ qua 1 lần orjson.loads rồi lấy đúng trường cần dùng.
+    """
+    async with client.chat.completions.with_streaming_response.create(**kwargs) as response:
+        async for line in response.iter_lines():
+            if not line.startswith("data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == "[DONE]":
+                return
+            chunk = orjson.loads(payload)
+            error = chunk.get("error")
+            if error:
+                raise RuntimeError(f"LLM stream error: {error}")
+            choices = chunk.get("choices")
+            if not choices:
+                continue
+            delta = (choices[0].get("delta") or {}).get("content")
+            if delta:
+                yield delta
+
+
+async def close_llm_clients() -> None:
+    """Đóng mọi client LLM dùng chung (gọi khi server shutdown)."""
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.close()
+
 
 class LLMService:
     """Chat với LLM — fallback qua nhiều provider."""
@@ -21,13 +97,14 @@ class LLMService:
         self._max_tokens = cfg.max_tokens
         self._temperature = cfg.temperature
         self._system_prompt = cfg.system_prompt
+        self._system_msg = {"role": "system", "content": self._system_prompt}
 
         # Log providers
         names = [f"{p.name}({p.model})" for p in self._providers]
         logger.info(f"LLM providers: {' → '.join(names)}")
 
     async def chat_stream(
-        self, user_text: str, history: list[dict]
+        self, user_text: str, history: Iterable[dict]
     ) -> AsyncGenerator[str, None]:
         """
         Thử từng provider lần lượt. Nếu provider đầu fail → thử tiếp.
@@ -39,37 +116,27 @@ class LLMService:
         for i, provider in enumerate(self._providers):
             try:
                 logger.info(f"\033[92m🤖 LLM trying [{provider.name}] {provider.model} @ {provider.base_url}\033[0m")
-                client = openai.AsyncOpenAI(
-                    api_key=provider.api_key,
-                    base_url=provider.base_url,
-                    max_retries=0,  # Không retry để fallback ngay lập tức
-                )
-                stream = await client.chat.completions.create(
+                client = _get_client(provider)
+                deltas = _stream_deltas(
+                    client,
                     model=provider.model,
                     messages=messages,
                     stream=True,
                     max_tokens=self._max_tokens,
                     temperature=self._temperature,
+                    extra_body=_prompt_cache_body(provider, self._system_prompt),
                 )
 
-                # Đọc chunk đầu tiên để xác nhận provider hoạt động
-                first_chunk = None
-                async for chunk in stream:
-                    delta = chunk.choices[0].delta.content if chunk.choices else None
-                    if delta:
-                        first_chunk = delta
-                        break
+                # Chunk đầu tiên có nội dung = provider hoạt động
+                first = True
+                async for delta in deltas:
+                    if first:
+                        logger.info(f"\033[92m🤖 LLM ✅ [{provider.name}] responding\033[0m")
+                        first = False
+                    yield delta
 
-                if first_chunk is None:
+                if first:
                     raise RuntimeError("Empty response from LLM")
-
-                # Provider OK → yield tất cả
-                logger.info(f"\033[92m🤖 LLM ✅ [{provider.name}] responding\033[0m")
-                yield first_chunk
-                async for chunk in stream:
-                    delta = chunk.choices[0].delta.content if chunk.choices else None
-                    if delta:
-                        yield delta
                 return  # Thành công, không cần fallback
 
             except Exception as e:
@@ -82,13 +149,9 @@ class LLMService:
         logger.error(f"LLM all {len(self._providers)} providers failed. Last error: {last_error}")
         yield "Xin lỗi, tất cả LLM đều không phản hồi."
 
-    def _build_messages(self, user_text: str, history: list[dict]) -> list[dict]:
+    def _build_messages(self, user_text: str, history: Iterable[dict]) -> list[dict]:
         """Ghép system prompt + history + user message."""
-        return [
-            {"role": "system", "content": self._system_prompt},
-            *history,
-            {"role": "user", "content": user_text},
-        ]
+        return [self._system_msg, *history, {"role": "user", "content": user_text}]
 
     async def chat_json(
         self,
@@ -99,19 +162,13 @@ class LLMService:
         temperature: float = 0.0,
     ) -> dict[str, Any] | None:
         """Gọi LLM non-stream và parse JSON output, có fallback providers."""
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_text},
-        ]
+        messages = [_system_message(system_prompt), {"role": "user", "content": user_text}]
         last_error = None
 
         for i, provider in enumerate(self._providers):
             try:
-                client = openai.AsyncOpenAI(
-                    api_key=provider.api_key,
-                    base_url=provider.base_url,
-                    max_retries=0,
-                )
+                client = _get_client(provider)
+                cache_body = _prompt_cache_body(provider, system_prompt)
                 try:
                     response = await client.chat.completions.create(
                         model=provider.model,
@@ -119,6 +176,7 @@ class LLMService:
                         stream=False,
                         max_tokens=max_tokens,
                         temperature=temperature,
+                        extra_body=cache_body,
                         response_format={"type": "json_object"},
                     )
                 except Exception:
@@ -129,6 +187,7 @@ class LLMService:
                         stream=False,
                         max_tokens=max_tokens,
                         temperature=temperature,
+                        extra_body=cache_body,
                     )
                 content = (
                     response.choices[0].message.content
@@ -155,34 +214,49 @@ class LLMService:
     @staticmethod
     def _parse_json_content(content: str) -> dict[str, Any]:
         """Parse JSON từ output LLM kể cả khi có text thừa hoặc markdown fences."""
-        raw = content.strip()
+        raw = content.encode() if isinstance(content, str) else content
 
-        # Case chuẩn: raw đã là JSON object.
+        # Case chuẩn: raw đã là JSON object (orjson tự bỏ qua whitespace).
         try:
-            parsed = json.loads(raw)
-            if isinstance(parsed, dict):
-                return parsed
-            raise ValueError("JSON is not an object")
-        except Exception:
-            pass
+            parsed = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            parsed = None
+        if isinstance(parsed, dict):
+            return parsed
 
-        # Bỏ markdown fence nếu có.
-        fenced = re.sub(r"^```(?:json)?\s*|\s*```$", "", raw, flags=re.IGNORECASE | re.DOTALL).strip()
-        try:
-            parsed = json.loads(fenced)
-            if isinstance(parsed, dict):
-                return parsed
-            raise ValueError("JSON is not an object")
-        except Exception:
-            pass
-
-        # Tách object đầu tiên trong text.
-        start = raw.find("{")
-        end = raw.rfind("}")
-        if start != -1 and end != -1 and end > start:
-            snippet = raw[start : end + 1]
-            parsed = json.loads(snippet)
+        # Fence/prose: tách object ngoài cùng đầu tiên bằng 1 lượt quét.
+        snippet = _extract_json_object(raw)
+        if snippet is not None:
+            parsed = orjson.loads(snippet)
             if isinstance(parsed, dict):
                 return parsed
 
         raise ValueError("Cannot parse JSON object from LLM output")
+
+
+def _extract_json_object(raw: bytes) -> bytes | None:
+    """Trả đoạn `{...}` cân bằng đầu tiên trong raw (bỏ qua ngoặc nằm trong string)."""
+    start = raw.find(b"{")
+    if start == -1:
+        return None
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(raw)):
+        c = raw[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == 0x5C:  # backslash
+                escaped = True
+            elif c == 0x22:  # "
+                in_string = False
+        elif c == 0x22:
+            in_string = True
+        elif c == 0x7B:  # {
+            depth += 1
+        elif c == 0x7D:  # }
+            depth -= 1
+            if depth == 0:
+                return raw[start : i + 1]
+    return None
@@ -1,7 +1,7 @@
 """
 Pipeline orchestrator: STT → LLM → TTS.
 
-Dùng asyncio.Queue để pre-fetch TTS:
+Dùng kênh deque + Event (_FrameChannel) để pre-fetch TTS:
 - Producer: LLM stream → tách câu → TTS → đẩy opus frames vào queue
 - Consumer: đọc queue → gửi frames cho ESP32
 → Trong khi đang gửi audio câu 1, đã TTS câu 2 sẵn rồi.
@@ -9,8 +9,11 @@ Dùng asyncio.Queue để pre-fetch TTS:
 
 import asyncio
 import json
+from collections import deque
 from app.server_logging import get_logger
 import re
+from dataclasses import dataclass
+from collections.abc import Iterable
 from typing import Callable, Awaitable
 
 from app.mcp import MCPToolRegistry
@@ -42,9 +45,18 @@ SENTENCE_ENDINGS = frozenset(".!?;,\n")
 CHUNK_MIN_CHARS = 28
 CHUNK_TARGET_CHARS = 58
 CHUNK_HARD_LIMIT = 90
-CHUNK_PUNCT_BREAKS = frozenset(",，:：、")
+# Dau ngat soft chunk theo thu tu uu tien: het cau > het ve > dau phay.
+# Chi xet cap sau khi cap truoc khong cho duoc chunk >= CHUNK_MIN_CHARS.
+CHUNK_SEPARATOR_LEVELS = ("。！？", "；:：", ",，、")
 CHUNK_SPACE_BREAK = " "
 
+# Quet ky tu ket cau trong C thay vi vong lap Python tung ky tu
+_SENTENCE_END_RE = re.compile("[" + re.escape("".join(sorted(SENTENCE_ENDINGS))) + "]")
+# ".*" tham lam + lop ky tu → match tra ve dau ngat CUOI CUNG trong cua so (1 lenh C)
+_LAST_CHUNK_BREAK_RES = tuple(
+    re.compile(".*[" + re.escape(level) + "]", re.DOTALL) for level in CHUNK_SEPARATOR_LEVELS
+)
+
 
 _DONE = object()
 
@@ -53,10 +65,90 @@ VOCAB_BATCH_SIZE = 6
 LOCK_WORD_LIMIT = 6
 
 
+class _FrameChannel:
+    """Kenh 1 producer → 1 consumer: deque + 2 Event, nhe hon asyncio.Queue.
+
+    `put` chi cho khi da day `maxsize` (soft cap), `get` chi cho khi rong.
+    """
+
+    __slots__ = ("_items", "_maxsize", "_not_empty", "_not_full")
+
+    def __init__(self, maxsize: int):
+        self._items: deque = deque()
+        self._maxsize = maxsize
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+
+    async def put(self, item) -> None:
+        while len(self._items) >= self._maxsize:
+            self._not_full.clear()
+            await self._not_full.wait()
+        self._items.append(item)
+        self._not_empty.set()
+
+    async def get(self):
+        while not self._items:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        item = self._items.popleft()
+        self._not_full.set()
+        return item
+
+    def discard_pending(self, sentinel) -> bool:
+        """Bo het item dang cho (khong await). Tra True neu gap `sentinel`."""
+        items = self._items
+        found = sentinel in items
+        items.clear()
+        self._not_full.set()
+        return found
+
+
+@dataclass(slots=True)
+class _GenerationSignal:
+    """Co dung sinh cau dung chung giua intent task va producer/consumer.
+
+    Doc thuoc tinh trong vong lap frame thay vi goi closure moi lan.
+    """
+
+    stop: bool = False
+
+
+class _FramePacer:
+    """Pre-buffer vai frame cho ESP32 roi giu toc do gui = toc do phat.
+
+    Deadline frame n = start + (n - pre_buffer) * frame_s, tinh tu bo dem;
+    chi doc clock va sleep 1 lan moi `batch` frame (frame van gui rieng tung
+    message vi ESP32 can 1 Opus packet / WebSocket message).
+    """
+
+    __slots__ = ("_frame_s", "_pre_buffer", "_batch", "_now", "_start_ts", "sent")
+
+    def __init__(self, frame_s: float, pre_buffer: int = 3, batch: int = 3):
+        self._frame_s = frame_s
+        self._pre_buffer = pre_buffer
+        self._batch = batch
+        # Bound method lay 1 lan, khong resolve loop/attr moi batch
+        self._now = asyncio.get_running_loop().time
+        self._start_ts = 0.0
+        self.sent = 0
+
+    async def pace(self) -> None:
+        """Goi sau moi frame vua gui."""
+        self.sent += 1
+        n = self.sent - self._pre_buffer
+        if n == 0:
+            self._start_ts = self._now()
+        elif n > 0 and n % self._batch == 0:
+            delay = self._start_ts + n * self._frame_s - self._now()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+
 class ConversationPipeline:
     """
     Orchestrator: audio PCM → text → AI response → audio Opus.
-    Pre-fetch TTS qua asyncio.Queue de giam giat giua cac cau.
+    Pre-fetch TTS qua _FrameChannel de giam giat giua cac cau.
     """
 
     def __init__(
@@ -79,7 +171,7 @@ class ConversationPipeline:
     async def process(
         self,
         pcm_data: bytes,
-        chat_history: list[dict],
+        chat_history: Iterable[dict],
         *,
         learning_context: dict[str, str | None] | None = None,
         on_stt_result: Callable[[str], Awaitable[None]],
@@ -421,34 +513,35 @@ class ConversationPipeline:
         # -- Buoc 2: LLM → tach cau → TTS (pre-fetch queue) --
         await on_tts_start()
 
-        music_mode = {"active": False}
+        generation = _GenerationSignal()
 
-        response_task = asyncio.create_task(
-            self._stream_response(
-                user_text,
-                chat_history,
-                on_tts_sentence=on_tts_sentence,
-                on_tts_audio=on_tts_audio,
-                on_emotion=on_emotion,
-                is_aborted=is_aborted,
-                should_stop_generation=lambda: music_mode["active"],
-            )
+        response_coro = self._stream_response(
+            user_text,
+            chat_history,
+            on_tts_sentence=on_tts_sentence,
+            on_tts_audio=on_tts_audio,
+            on_emotion=on_emotion,
+            is_aborted=is_aborted,
+            generation=generation,
         )
 
-        intent_task = None
+        music_payload = None
         if not self._prefer_fast_only and self._intent_detector:
-            intent_task = asyncio.create_task(
-                self._detect_and_handle_music_intent(
-                    user_text,
-                    on_music_action=on_music_action,
-                    on_music_detected=lambda: music_mode.__setitem__("active", True),
+            # Detect intent song song với luồng LLM chính
+            async with asyncio.TaskGroup() as tg:
+                response_task = tg.create_task(response_coro)
+                intent_task = tg.create_task(
+                    self._detect_and_handle_music_intent(
+                        user_text,
+                        on_music_action=on_music_action,
+                        on_music_detected=lambda: setattr(generation, "stop", True),
+                    )
                 )
-            )
-
-        full_response = await response_task
-        music_payload = None
-        if intent_task:
-            music_payload = await intent_task
+            full_response = response_task.result()
+            music_payload = intent_task.result()
+        else:
+            # Không có gì chạy song song → await thẳng, khỏi tạo Task
+            full_response = await response_coro
 
         if isinstance(music_payload, dict) and music_payload.get("intent") == "music":
             await self._stream_music_preview(
@@ -858,13 +951,13 @@ class ConversationPipeline:
     async def _stream_response(
         self,
         user_text: str,
-        chat_history: list[dict],
+        chat_history: Iterable[dict],
         *,
         on_tts_sentence: Callable[[str], Awaitable[None]],
         on_tts_audio: Callable[[bytes], Awaitable[None]],
         on_emotion: Callable[[str], Awaitable[None]] | None = None,
         is_aborted: Callable[[], bool],
-        should_stop_generation: Callable[[], bool],
+        generation: _GenerationSignal,
     ) -> str:
         """
         LLM streaming → tach cau → TTS pre-fetch → gui audio.
@@ -872,7 +965,7 @@ class ConversationPipeline:
         Producer: LLM chunks → sentences → TTS → opus frames → queue
         Consumer: queue → on_tts_audio (gui ESP32)
         """
-        queue: asyncio.Queue = asyncio.Queue(maxsize=100)
+        queue = _FrameChannel(maxsize=100)
         full_response = ""
         producer_error = None
 
@@ -880,10 +973,15 @@ class ConversationPipeline:
             nonlocal full_response, producer_error
             try:
                 raw_response_parts: list[str] = []
-                async for chunk in self._llm.chat_stream(user_text, chat_history):
-                    if is_aborted() or should_stop_generation():
-                        break
-                    raw_response_parts.append(chunk)
+                llm_stream = self._llm.chat_stream(user_text, chat_history)
+                try:
+                    async for chunk in llm_stream:
+                        if generation.stop or is_aborted():
+                            break
+                        raw_response_parts.append(chunk)
+                finally:
+                    # Đóng stream ngay để ngắt kết nối HTTP tới provider khi abort
+                    await llm_stream.aclose()
 
                 raw_response = "".join(raw_response_parts).strip()
                 if not raw_response:
@@ -892,40 +990,31 @@ class ConversationPipeline:
                 response_language, response_text = self._parse_llm_tts_payload(raw_response)
                 full_response = response_text
 
-                buffer = response_text
-                while True:
-                    sentence, buffer = self._extract_sentence(buffer)
-                    if not sentence:
-                        break
-                    await self._enqueue_sentence(
-                        sentence,
-                        queue,
-                        on_tts_sentence,
-                        is_aborted,
-                        language=response_language,
-                    )
-
-                while len(buffer) >= CHUNK_HARD_LIMIT and not is_aborted() and not should_stop_generation():
-                    text_chunk, buffer = self._extract_soft_chunk(buffer)
-                    if not text_chunk:
-                        break
-                    await self._enqueue_sentence(
-                        text_chunk,
-                        queue,
-                        on_tts_sentence,
-                        is_aborted,
-                        language=response_language,
-                    )
-
-                remaining = buffer.strip()
-                if remaining and not is_aborted() and not should_stop_generation():
-                    await self._enqueue_sentence(
-                        remaining,
-                        queue,
-                        on_tts_sentence,
-                        is_aborted,
-                        language=response_language,
-                    )
+                sentences, tail_chunks = self._drain_buffer(response_text)
+                pieces = [*sentences, *tail_chunks]
+                next_frames: asyncio.Task | None = None
+                try:
+                    for idx, piece in enumerate(pieces):
+                        if generation.stop or is_aborted():
+                            break
+                        prefetched = next_frames
+                        # TTS câu kế tiếp chạy song song trong lúc câu hiện tại đổ frame vào queue
+                        next_frames = (
+                            asyncio.create_task(self._collect_frames(pieces[idx + 1], response_language))
+                            if idx + 1 < len(pieces)
+                            else None
+                        )
+                        await self._enqueue_sentence(
+                            piece,
+                            queue,
+                            on_tts_sentence,
+                            is_aborted,
+                            language=response_language,
+                            prefetched=prefetched,
+                        )
+                finally:
+                    if next_frames is not None and not next_frames.done():
+                        next_frames.cancel()
             except Exception as e:
                 producer_error = e
                 logger.error(f"Producer error: {e}", exc_info=True)
@@ -933,47 +1022,41 @@ class ConversationPipeline:
                 await queue.put(_DONE)
 
         async def consumer():
-            total_frames = 0
             # Gửi trước vài frames để pre-buffer trên ESP32
             PRE_BUFFER = 3
             FRAME_S = self._tts.frame_duration_s
-            PACE = 1.0      # đồng bộ 1:1 với tốc độ phát
             GRACE_S = 0.05  # nghỉ 50ms giữa các câu cho tự nhiên
-            next_send_ts: float | None = None
-            has_spoken_sentence = False
-            loop = asyncio.get_running_loop()
+            pacer = _FramePacer(FRAME_S, PRE_BUFFER, self._tts.pacing_batch_frames)
+            # Số frame đã gửi khi gặp sentence marker gần nhất
+            sent_at_marker: int | None = None
 
             while True:
                 item = await queue.get()
                 if item is _DONE:
                     break
-                if is_aborted() or should_stop_generation():
-                    continue  # drain queue
+                if generation.stop or is_aborted():
+                    # Bỏ nhanh mọi frame đang chờ (không await từng item), producer được nhả ngay
+                    if queue.discard_pending(_DONE):
+                        break
+                    continue
 
                 # Sentence marker: gui sentence_start SAU KHI audio cau truoc da gui het
                 if isinstance(item, tuple) and item[0] == _SENTENCE_MARKER:
-                    if has_spoken_sentence:
-                        # Đợi thêm 1 frame + grace để client phát dứt câu trước.
+                    if sent_at_marker is not None and pacer.sent > sent_at_marker:
+                        # Câu trước có audio → đợi thêm 1 frame + grace để client phát dứt.
                         await asyncio.sleep(FRAME_S + GRACE_S)
 
                     await on_tts_sentence(item[1])
-                    has_spoken_sentence = True
+                    sent_at_marker = pacer.sent
                     continue
 
                 if isinstance(item, bytes):
                     await on_tts_audio(item)
-                total_frames += 1
 
                 # Pacing: đảm bảo không gửi nhanh hơn tốc độ phát
-                if total_frames == PRE_BUFFER:
-                    next_send_ts = loop.time() + FRAME_S * PACE
-                elif total_frames > PRE_BUFFER and next_send_ts is not None:
-                    now = loop.time()
-                    if now < next_send_ts:
-                        await asyncio.sleep(next_send_ts - now)
-                    next_send_ts += FRAME_S * PACE
+                await pacer.pace()
 
-            logger.info(f"\033[92m✅ Sent total {total_frames} opus frames\033[0m")
+            logger.info(f"\033[92m✅ Sent total {pacer.sent} opus frames\033[0m")
 
         # Chay song song: producer TTS cau tiep, consumer gui cau hien tai
         await asyncio.gather(producer(), consumer())
@@ -1000,7 +1083,7 @@ class ConversationPipeline:
         if not tracks:
             await on_tts_sentence("Mình chưa tìm thấy bản nhạc phù hợp, để mình thử nguồn khác.")
             await self._send_frames_with_pacing(
-                self._tts.synthesize("Mình chưa tìm thấy bản nhạc phù hợp, để mình thử nguồn khác."),
+                self._tts.synthesize_cached("Mình chưa tìm thấy bản nhạc phù hợp, để mình thử nguồn khác."),
                 on_tts_audio=on_tts_audio,
                 is_aborted=is_aborted,
             )
@@ -1013,7 +1096,7 @@ class ConversationPipeline:
             if streamed == 0:
                 await on_tts_sentence("Xin lỗi, hiện tại mình chưa phát được bài này. Bạn thử nói rõ tên bài hoặc ca sĩ nhé.")
                 await self._send_frames_with_pacing(
-                    self._tts.synthesize("Xin lỗi, hiện tại mình chưa phát được bài này. Bạn thử nói rõ tên bài hoặc ca sĩ nhé."),
+                    self._tts.synthesize_cached("Xin lỗi, hiện tại mình chưa phát được bài này. Bạn thử nói rõ tên bài hoặc ca sĩ nhé."),
                     on_tts_audio=on_tts_audio,
                     is_aborted=is_aborted,
                 )
@@ -1029,6 +1112,7 @@ class ConversationPipeline:
         else:
             ack = f"Đang mở bài {title}."
         await on_tts_sentence(ack)
+        # Câu có tên bài → synthesize thường, không để tên bài đẩy câu cố định khỏi cache
         await self._send_frames_with_pacing(
             self._tts.synthesize(ack),
             on_tts_audio=on_tts_audio,
@@ -1056,7 +1140,7 @@ class ConversationPipeline:
         if streamed == 0:
             await on_tts_sentence("Xin lỗi, mình chưa phát được bài này lúc này.")
             await self._send_frames_with_pacing(
-                self._tts.synthesize("Xin lỗi, mình chưa phát được bài này lúc này."),
+                self._tts.synthesize_cached("Xin lỗi, mình chưa phát được bài này lúc này."),
                 on_tts_audio=on_tts_audio,
                 is_aborted=is_aborted,
             )
@@ -1070,27 +1154,15 @@ class ConversationPipeline:
     ) -> int:
         """Gửi Opus frames theo tốc độ phát thực để tránh audio chồng/chạy nhanh."""
         pre_buffer = 3
-        frame_s = self._tts.frame_duration_s
-        pace = 1.0
-        next_send_ts: float | None = None
-        sent = 0
-        loop = asyncio.get_running_loop()
+        pacer = _FramePacer(self._tts.frame_duration_s, pre_buffer, self._tts.pacing_batch_frames)
 
         async for opus_frame in frame_stream:
             if is_aborted():
                 return 0
 
             await on_tts_audio(opus_frame)
-            sent += 1
-
-            if sent == pre_buffer:
-                next_send_ts = loop.time() + frame_s * pace
-            elif sent > pre_buffer and next_send_ts is not None:
-                now = loop.time()
-                if now < next_send_ts:
-                    await asyncio.sleep(next_send_ts - now)
-                next_send_ts += frame_s * pace
-        return sent
+            await pacer.pace()
+        return pacer.sent
 
     async def _call_music_tool(
         self,
@@ -1151,27 +1223,42 @@ class ConversationPipeline:
     async def _enqueue_sentence(
         self,
         sentence: str,
-        queue: asyncio.Queue,
+        queue: _FrameChannel,
         on_tts_sentence: Callable[[str], Awaitable[None]],
         is_aborted: Callable[[], bool],
         *,
         language: str | None = None,
+        prefetched: asyncio.Task | None = None,
     ) -> None:
-        """TTS 1 cau → day tung opus frame vao queue."""
+        """TTS 1 cau → day tung opus frame vao queue.
+
+        `prefetched`: task `_collect_frames` da chay truoc cho cau nay (neu co).
+        """
         logger.info(f"\033[92m🔊 TTS[{language or 'auto'}]: {sentence}\033[0m")
         # Gui sentence marker qua queue de dong bo voi audio frames
         await queue.put((_SENTENCE_MARKER, sentence))
 
         frame_count = 0
-        async for opus_frame in self._tts.synthesize(
-            sentence, language_hint=language
-        ):
-            if is_aborted():
-                break
-            await queue.put(opus_frame)
-            frame_count += 1
+        if prefetched is not None:
+            for opus_frame in await prefetched:
+                if is_aborted():
+                    break
+                await queue.put(opus_frame)
+                frame_count += 1
+        else:
+            async for opus_frame in self._tts.synthesize(
+                sentence, language_hint=language
+            ):
+                if is_aborted():
+                    break
+                await queue.put(opus_frame)
+                frame_count += 1
         logger.info(f"\033[92m   Queued {frame_count} frames for: {sentence[:40]}\033[0m")
 
+    async def _collect_frames(self, sentence: str, language: str | None) -> list[bytes]:
+        """TTS ca cau vao list (dung de prefetch cau ke tiep)."""
+        return [f async for f in self._tts.synthesize(sentence, language_hint=language)]
+
     @staticmethod
     def _parse_llm_tts_payload(raw_response: str) -> tuple[str | None, str]:
         """
@@ -1231,17 +1318,48 @@ class ConversationPipeline:
 
         return (None, raw)
 
+    @classmethod
+    def _drain_buffer(cls, text: str) -> tuple[list[str], list[str]]:
+        """Chia text 1 luot: (cac cau hoan chinh, soft chunk + phan duoi con lai).
+
+        Cau dung `_extract_sentence` theo vi tri; phan con lai (khong con dau
+        ket cau) chi bi cat soft chunk khi dai >= CHUNK_HARD_LIMIT.
+        """
+        sentences: list[str] = []
+        pos = 0
+        while True:
+            sentence, pos = cls._extract_sentence(text, pos)
+            if not sentence:
+                break
+            sentences.append(sentence)
+
+        tail_chunks: list[str] = []
+        buffer = text[pos:]
+        while len(buffer) >= CHUNK_HARD_LIMIT:
+            text_chunk, buffer = cls._extract_soft_chunk(buffer)
+            if not text_chunk:
+                break
+            tail_chunks.append(text_chunk)
+
+        remaining = buffer.strip()
+        if remaining:
+            tail_chunks.append(remaining)
+        return sentences, tail_chunks
+
     @staticmethod
-    def _extract_sentence(buffer: str) -> tuple[str | None, str]:
-        """Tach cau dau tien hoan chinh tu buffer."""
-        for i, char in enumerate(buffer):
-            if char in SENTENCE_ENDINGS:
-                sentence = buffer[: i + 1].strip()
-                remaining = buffer[i + 1 :]
-                if sentence and len(sentence) > 1:
-                    return sentence, remaining
-                return None, remaining
-        return None, buffer
+    def _extract_sentence(buffer: str, start: int = 0) -> tuple[str | None, int]:
+        """Tach cau hoan chinh dau tien tu buffer[start:].
+
+        Tra ve (cau, vi tri sau cau) — khong copy phan con lai cua buffer.
+        """
+        m = _SENTENCE_END_RE.search(buffer, start)
+        if m is None:
+            return None, start
+        end = m.end()
+        sentence = buffer[start:end].strip()
+        if sentence and len(sentence) > 1:
+            return sentence, end
+        return None, end
 
     @staticmethod
     def _extract_soft_chunk(buffer: str) -> tuple[str | None, str]:
@@ -1250,23 +1368,21 @@ class ConversationPipeline:
             return None, buffer
 
         limit = min(len(buffer), CHUNK_HARD_LIMIT)
-        punct_cut = -1
-        for i in range(limit - 1, CHUNK_MIN_CHARS - 1, -1):
-            if buffer[i] in CHUNK_PUNCT_BREAKS:
-                punct_cut = i
-                break
-
-        if punct_cut != -1:
+        # Moi cap: dau ngat gan limit nhat trong [CHUNK_MIN_CHARS, limit)
+        for break_re in _LAST_CHUNK_BREAK_RES:
+            m = break_re.match(buffer, CHUNK_MIN_CHARS, limit)
+            if m is None:
+                continue
+            punct_cut = m.end() - 1
             chunk = buffer[: punct_cut + 1].rstrip()
-            remaining = buffer[punct_cut + 1 :].lstrip()
-        else:
-            # fallback: cat o khoang trang, KHONG cat giua tu
-            space_cut = buffer.rfind(CHUNK_SPACE_BREAK, CHUNK_MIN_CHARS, limit)
-            if space_cut == -1:
-                return None, buffer
-            chunk = buffer[:space_cut].rstrip()
-            remaining = buffer[space_cut + 1 :].lstrip()
+            if len(chunk) >= CHUNK_MIN_CHARS:
+                return chunk, buffer[punct_cut + 1 :].lstrip()
 
+        # fallback: cat o khoang trang, KHONG cat giua tu
+        space_cut = buffer.rfind(CHUNK_SPACE_BREAK, CHUNK_MIN_CHARS, limit)
+        if space_cut == -1:
+            return None, buffer
+        chunk = buffer[:space_cut].rstrip()
         if len(chunk) < CHUNK_MIN_CHARS:
             return None, buffer
-        return chunk, remaining
+        return chunk, buffer[space_cut + 1 :].lstrip()
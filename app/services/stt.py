@@ -1,14 +1,58 @@
+import asyncio
 import io
+import struct
 from app.server_logging import get_logger
 import re
 from typing import Optional
 
+import httpx
+import numpy as np
 import openai
 
+from app.audio.vad_math import ac_rms_i16, batch_ac_rms_i16
 from app.config import STTConfig
 
 logger = get_logger(__name__)
 
+# Giữ kết nối tới provider STT lâu hơn mặc định của httpx (5s): giữa 2 lượt
+# nói thường cách nhau vài chục giây, hết hạn sớm thì lượt sau lại tốn TLS handshake.
+STT_KEEPALIVE_S = 60.0
+STT_MAX_KEEPALIVE_CONNECTIONS = 32
+
+# 1 AsyncOpenAI cho mỗi (base_url, api_key, timeout), dùng chung giữa mọi session.
+_clients: dict[tuple[str, str, float], openai.AsyncOpenAI] = {}
+
+
+def _get_client(cfg: STTConfig) -> openai.AsyncOpenAI:
+    timeout = float(getattr(cfg, "timeout", 20.0))
+    key = (cfg.base_url, cfg.api_key, timeout)
+    client = _clients.get(key)
+    if client is None:
+        http_client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_keepalive_connections=STT_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=STT_KEEPALIVE_S,
+            ),
+        )
+        client = openai.AsyncOpenAI(
+            api_key=cfg.api_key,
+            base_url=cfg.base_url,
+            timeout=timeout,
+            max_retries=0,  # tự retry có kiểm soát ở dưới
+            http_client=http_client,
+        )
+        _clients[key] = client
+    return client
+
+
+async def close_stt_clients() -> None:
+    """Đóng mọi client STT dùng chung (gọi khi server shutdown)."""
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.close()
+
 
 MIN_PCM_BYTES = 16000
 
@@ -26,6 +70,7 @@ class STTService:
 
 BYTES_PER_SAMPLE = 2  # PCM int16
 CHANNELS = 1
+_WAV_HEADER = struct.Struct("<4sI4s4sIHHIIHH4sI")
 
 
 class STTService:
@@ -34,15 +79,12 @@ class STTService:
 
     def __init__(self, cfg: STTConfig):
         self._cfg = cfg
-        self._client = openai.AsyncOpenAI(
-            api_key=cfg.api_key,
-            base_url=cfg.base_url,
-            timeout=getattr(cfg, "timeout", 20.0),
-            max_retries=0,  # tự retry có kiểm soát ở dưới
-        )
+        self._client = _get_client(cfg)
         self._model = cfg.model
 
         self._language = (cfg.language or "").strip().lower()
+        self._upload_format = (getattr(cfg, "upload_format", "wav") or "wav").strip().lower()
+        self._min_rms = float(getattr(cfg, "min_rms", 0.0))
 
 
         # các giá trị nên thêm trong STTConfig
@@ -108,8 +150,14 @@ class STTService:
             duration_sec = len(pcm_data) / (sample_rate * BYTES_PER_SAMPLE * CHANNELS)
             logger.debug("Trim audio còn %.2fs", duration_sec)
 
-        wav_bytes = _pcm_to_wav(pcm_data, sample_rate)
-        text = await self._call_api(wav_bytes)
+        if self._min_rms > 0:
+            rms = _voiced_rms(pcm_data, sample_rate)
+            if rms < self._min_rms:
+                logger.debug("Audio im lặng: rms=%.1f < %.1f, bỏ qua", rms, self._min_rms)
+                return None
+
+        upload = await self._encode_upload(pcm_data, sample_rate)
+        text = await self._call_api(upload)
 
 
         if not text:
@@ -119,20 +167,28 @@ class STTService:
         text = _normalize_text(text)
         return text or None
 
-    async def _call_api(self, wav_bytes: bytes) -> Optional[str]:
+    async def _encode_upload(self, pcm_data: bytes, sample_rate: int) -> tuple[str, bytes, str]:
+        """Đóng gói PCM để upload: FLAC nếu được cấu hình (và có soundfile), mặc định WAV."""
+        if self._upload_format == "flac":
+            try:
+                flac_bytes = await asyncio.to_thread(_pcm_to_flac, pcm_data, sample_rate)
+                return ("audio.flac", flac_bytes, "audio/flac")
+            except ImportError:
+                logger.warning("STT_UPLOAD_FORMAT=flac nhưng chưa cài soundfile, dùng WAV")
+                self._upload_format = "wav"
+            except Exception as e:
+                logger.warning("Encode FLAC lỗi, gửi WAV: %s", e)
+        return ("audio.wav", _pcm_to_wav(pcm_data, sample_rate), "audio/wav")
+
+    async def _call_api(self, file_obj: tuple[str, bytes, str]) -> Optional[str]:
         """
-        Gửi WAV lên Whisper API.
+        Gửi audio (filename, bytes, content_type) lên Whisper API.
         Retry ngắn để chịu lỗi mạng tạm thời tốt hơn.
         """
-        file_obj = io.BytesIO(wav_bytes)
-        file_obj.name = "audio.wav"  # một số SDK/provider dùng tên file để suy format
-
         last_error: Optional[Exception] = None
 
         for attempt in range(2):
             try:
-                file_obj.seek(0)
-
                 request_kwargs = {
                     "model": self._model,
                     "file": file_obj,
@@ -168,16 +224,15 @@ class STTService:
         logger.error("STT failed after retries: %s", last_error)
         return None
 
-    async def _transcribe_verbose(self, wav_path: str) -> Optional[tuple[str, str]]:
+    async def _transcribe_verbose(self, wav_bytes: bytes) -> Optional[tuple[str, str]]:
         """Transcribe với response_format=verbose_json để lấy detected language."""
         try:
-            with open(wav_path, "rb") as f:
-                result = await self._client.audio.transcriptions.create(
-                    model=self._model,
-                    file=f,
-                    response_format="verbose_json",
-                    prompt="Transcribe Vietnamese or English speech.",
-                )
+            result = await self._client.audio.transcriptions.create(
+                model=self._model,
+                file=("audio.wav", wav_bytes, "audio/wav"),
+                response_format="verbose_json",
+                prompt="Transcribe Vietnamese or English speech.",
+            )
             text = result.text.strip() if result.text else ""
             detected_lang = getattr(result, "language", "vi") or "vi"
             return text, detected_lang
@@ -185,15 +240,14 @@ class STTService:
             logger.error(f"STT verbose API error: {e}")
             return None
 
-    async def _transcribe_with_lang(self, wav_path: str, language: str) -> Optional[str]:
+    async def _transcribe_with_lang(self, wav_bytes: bytes, language: str) -> Optional[str]:
         """Transcribe với language cố định."""
         try:
-            with open(wav_path, "rb") as f:
-                result = await self._client.audio.transcriptions.create(
-                    model=self._model,
-                    file=f,
-                    language=language,
-                )
+            result = await self._client.audio.transcriptions.create(
+                model=self._model,
+                file=("audio.wav", wav_bytes, "audio/wav"),
+                language=language,
+            )
             text = result.text.strip()
             logger.info(f"\033[92m📝 STT [{language}]: {text}\033[0m")
             return text or None
@@ -203,15 +257,44 @@ class STTService:
 
 
 def _pcm_to_wav(pcm_data: bytes, sample_rate: int) -> bytes:
-    """Đóng gói PCM int16 mono thành WAV."""
-    import wave
+    """Đóng gói PCM int16 mono thành WAV (header 44 byte dựng tay, không qua `wave`)."""
+    header = _WAV_HEADER.pack(
+        b"RIFF",
+        36 + len(pcm_data),
+        b"WAVE",
+        b"fmt ",
+        16,  # kích thước chunk fmt
+        1,  # PCM
+        CHANNELS,
+        sample_rate,
+        sample_rate * CHANNELS * BYTES_PER_SAMPLE,  # byte rate
+        CHANNELS * BYTES_PER_SAMPLE,  # block align
+        BYTES_PER_SAMPLE * 8,
+        b"data",
+        len(pcm_data),
+    )
+    return header + pcm_data
+
+
+def _voiced_rms(pcm_data: bytes, sample_rate: int) -> float:
+    """AC RMS của frame 20ms to nhất (PCM int16).
+
+    Lấy max theo frame thay vì RMS cả đoạn: câu nói ngắn nằm giữa nhiều
+    khoảng lặng không bị kéo xuống dưới ngưỡng; trừ DC offset của mic.
+    """
+    frame_bytes = max(sample_rate // 50, 1) * 2
+    frames = [pcm_data[i : i + frame_bytes] for i in range(0, len(pcm_data) - frame_bytes + 1, frame_bytes)]
+    if not frames:
+        return ac_rms_i16(pcm_data)
+    return max(batch_ac_rms_i16(frames))
+
+
+def _pcm_to_flac(pcm_data: bytes, sample_rate: int) -> bytes:
+    """Nén PCM int16 mono thành FLAC (lossless) để giảm dung lượng upload."""
+    import soundfile as sf
 
     buf = io.BytesIO()
-    with wave.open(buf, "wb") as wf:
-        wf.setnchannels(CHANNELS)
-        wf.setsampwidth(BYTES_PER_SAMPLE)
-        wf.setframerate(sample_rate)
-        wf.writeframes(pcm_data)
+    sf.write(buf, np.frombuffer(pcm_data, dtype=np.int16), sample_rate, format="FLAC", subtype="PCM_16")
     return buf.getvalue()
 
 
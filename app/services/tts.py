@@ -17,6 +17,7 @@ from __future__ import annotations
 
 import asyncio
 import base64
+import functools
 import html
 from app.server_logging import get_logger
 import math
@@ -25,6 +26,7 @@ import re
 import shutil
 import struct
 import time
+from collections import OrderedDict
 from typing import AsyncGenerator
 
 import aiohttp
@@ -36,6 +38,7 @@ except Exception:
 
 from app.audio.opus_codec import OpusEncoder
 from app.config import AudioOutputConfig, TTSConfig
+from app.ttl_cache import TTLCache
 
 logger = get_logger(__name__)
 
@@ -83,6 +86,24 @@ TOKEN_RE = re.compile(r"[A-Za-z][A-Za-z0-9+._:/#-]*")
 
 MAX_TTS_INPUT_CHARS = 4200
 
+@functools.lru_cache(maxsize=64)
+def _pcm16_struct(n_samples: int) -> struct.Struct:
+    """Struct '<{n}h' dựng sẵn theo số sample (không parse lại format mỗi lần)."""
+    return struct.Struct(f"<{n_samples}h")
+
+
+# Cache Opus frames cho các câu cố định/lặp lại (ack mở nhạc, câu xin lỗi...),
+# key theo (text, cấu hình giọng hiện tại). Dùng chung mọi session.
+PHRASE_CACHE_MAX = 64
+_phrase_frame_cache: OrderedDict[tuple, tuple[bytes, ...]] = OrderedDict()
+
+# Cache URL audio yt-dlp đã resolve theo query (mỗi lần spawn yt-dlp mất 1-3s).
+# URL stream của YouTube sống vài giờ nên TTL 10 phút là an toàn. Nhiều session
+# xin cùng 1 bài cùng lúc chỉ spawn yt-dlp 1 lần.
+YTDLP_URL_CACHE_TTL_S = 600.0
+YTDLP_URL_CACHE_MAX = 64
+_ytdlp_url_cache: TTLCache[str, str | None] = TTLCache(YTDLP_URL_CACHE_TTL_S, YTDLP_URL_CACHE_MAX)
+
 
 # Cụm từ nên đọc theo cụm, không tách lẻ
 EN_PHRASE_PRIORITY = [
@@ -219,9 +240,13 @@ class TTSService:
             logger.warning("Google TTS API key chưa được cấu hình. Hãy set GOOGLE_TTS_API_KEY trong .env")
 
         self._target_rate = audio_cfg.sample_rate
-        self._encoder = OpusEncoder(audio_cfg)
-        self._frame_bytes = self._encoder.frame_bytes
+        # Encoder Opus giữ state và không dùng song song được. Pipeline prefetch
+        # câu N+1 trong lúc câu N còn đang encode, nên mỗi lượt synthesize /
+        # stream_audio_url mượn encoder riêng từ pool (trả lại khi xong).
+        self._audio_cfg = audio_cfg
+        self._frame_bytes = audio_cfg.frame_size * 2  # 2 bytes per int16 sample
         self._frame_duration_s = audio_cfg.frame_duration_ms / 1000.0
+        self._pacing_batch_frames = audio_cfg.pacing_batch_frames
 
         self._tts_url = f"https://texttospeech.googleapis.com/v1/text:synthesize?key={self._api_key}"
 
@@ -305,12 +330,35 @@ class TTSService:
     def frame_duration_s(self) -> float:
         return self._frame_duration_s
 
+    @property
+    def pacing_batch_frames(self) -> int:
+        return self._pacing_batch_frames
+
+    def close(self) -> None:
+        """Không giữ encoder nào giữa các lượt (mượn/trả theo từng lượt), để tương thích API."""
+
     async def synthesize(
         self,
         text: str,
         *,
         language_hint: str | None = None,
     ) -> AsyncGenerator[bytes, None]:
+        """Text → Opus frames. Lỗi được log và kết thúc stream sớm."""
+        try:
+            async for opus_frame in self._synthesize_stream(text, language_hint=language_hint):
+                yield opus_frame
+        except asyncio.TimeoutError:
+            logger.error("Google TTS API timeout (%.1fs)", self._request_timeout_s)
+        except Exception as e:
+            logger.error("TTS error: %s", e, exc_info=True)
+
+    async def _synthesize_stream(
+        self,
+        text: str,
+        *,
+        language_hint: str | None = None,
+    ) -> AsyncGenerator[bytes, None]:
+        """Thân của `synthesize`: lỗi được raise ra ngoài để caller biết stream có trọn vẹn không."""
         if not text or not text.strip():
             return
 
@@ -319,6 +367,7 @@ class TTSService:
         total_frames = 0
         total_pcm_bytes = 0
         total_chunks = 0
+        encoder = OpusEncoder(self._audio_cfg)
 
         try:
             clean_text = self._strip_emotion_tags(text)
@@ -339,22 +388,11 @@ class TTSService:
                         continue
 
                     total_pcm_bytes += len(pcm_data)
-                    pcm_buffer = bytearray(pcm_data)
-
-                    while len(pcm_buffer) >= self._frame_bytes:
-                        frame_data = bytes(pcm_buffer[: self._frame_bytes])
-                        del pcm_buffer[: self._frame_bytes]
-                        total_frames += 1
-                        if first_frame_at is None:
-                            first_frame_at = time.perf_counter()
-                        yield self._encoder.encode(frame_data)
-
-                    if pcm_buffer:
-                        pcm_buffer.extend(b"\x00" * (self._frame_bytes - len(pcm_buffer)))
+                    for opus_frame in await self._encode_pcm(encoder, pcm_data):
                         total_frames += 1
                         if first_frame_at is None:
                             first_frame_at = time.perf_counter()
-                        yield self._encoder.encode(bytes(pcm_buffer))
+                        yield opus_frame
             else:
                 timeout = aiohttp.ClientTimeout(total=self._request_timeout_s)
 
@@ -366,22 +404,11 @@ class TTSService:
                             continue
 
                         total_pcm_bytes += len(pcm_data)
-                        pcm_buffer = bytearray(pcm_data)
-
-                        while len(pcm_buffer) >= self._frame_bytes:
-                            frame_data = bytes(pcm_buffer[: self._frame_bytes])
-                            del pcm_buffer[: self._frame_bytes]
+                        for opus_frame in await self._encode_pcm(encoder, pcm_data):
                             total_frames += 1
                             if first_frame_at is None:
                                 first_frame_at = time.perf_counter()
-                            yield self._encoder.encode(frame_data)
-
-                        if pcm_buffer:
-                            pcm_buffer.extend(b"\x00" * (self._frame_bytes - len(pcm_buffer)))
-                            total_frames += 1
-                            if first_frame_at is None:
-                                first_frame_at = time.perf_counter()
-                            yield self._encoder.encode(bytes(pcm_buffer))
+                            yield opus_frame
 
             elapsed = time.perf_counter() - started_at
             first_frame_ms = (
@@ -406,11 +433,65 @@ class TTSService:
                 self._voice_style,
                 self._enable_post_loudness,
             )
+        finally:
+            encoder.release()
 
+    def _voice_key(self) -> tuple:
+        """Mọi tham số runtime ảnh hưởng tới audio của 1 câu (per-robot override)."""
+        return (
+            self._provider,
+            self._voice_name_vi,
+            self._voice_name_en,
+            self._language_code_vi,
+            self._language_code_en,
+            self._edge_voice_vi,
+            self._edge_voice_en,
+            self._edge_rate_vi,
+            self._edge_rate_en,
+            self._edge_pitch_vi,
+            self._edge_pitch_en,
+            self._voice_style,
+            self._default_language_hint,
+            self._target_rate,
+        )
+
+    async def synthesize_cached(self, text: str) -> AsyncGenerator[bytes, None]:
+        """Như `synthesize` nhưng nhớ frames của câu để lần sau phát lại không gọi API.
+
+        Chỉ dùng cho câu cố định; câu chứa dữ liệu động (tên bài...) dùng `synthesize`.
+        """
+        key = (text, self._voice_key())
+        cached = _phrase_frame_cache.get(key)
+        if cached is not None:
+            _phrase_frame_cache.move_to_end(key)
+            for opus_frame in cached:
+                yield opus_frame
+            return
+
+        frames: list[bytes] = []
+        try:
+            async for opus_frame in self._synthesize_stream(text):
+                frames.append(opus_frame)
+                yield opus_frame
         except asyncio.TimeoutError:
             logger.error("Google TTS API timeout (%.1fs)", self._request_timeout_s)
+            return
         except Exception as e:
             logger.error("TTS error: %s", e, exc_info=True)
+            return
+
+        # Chỉ tới đây khi stream chạy hết không lỗi → mới cache
+        if frames:
+            _phrase_frame_cache[key] = tuple(frames)
+            while len(_phrase_frame_cache) > PHRASE_CACHE_MAX:
+                _phrase_frame_cache.popitem(last=False)
+
+    async def _encode_pcm(self, encoder: OpusEncoder, pcm_data: bytes) -> list[bytes]:
+        """Pad PCM lên bội số frame rồi encode cả chunk ngoài event loop."""
+        remainder = len(pcm_data) % self._frame_bytes
+        if remainder:
+            pcm_data = pcm_data + b"\x00" * (self._frame_bytes - remainder)
+        return await encoder.encode_all_async(pcm_data)
 
     async def _synthesize_chunk_edge(self, chunk: dict[str, str]) -> bytes | None:
         if edge_tts is None:
@@ -567,7 +648,8 @@ class TTSService:
             return pcm_data
 
         n_samples = len(pcm_data) // 2
-        samples = list(struct.unpack(f"<{n_samples}h", pcm_data[: n_samples * 2]))
+        # unpack_from đọc thẳng trên buffer, không slice bỏ byte lẻ cuối
+        samples = list(_pcm16_struct(n_samples).unpack_from(pcm_data))
         if not samples:
             return pcm_data
 
@@ -632,7 +714,7 @@ class TTSService:
                 self._post_makeup_db,
             )
 
-        return struct.pack(f"<{len(out)}h", *out)
+        return _pcm16_struct(len(out)).pack(*out)
 
     @staticmethod
     def _calc_rms(samples: list[int]) -> float:
@@ -1116,26 +1198,27 @@ class TTSService:
         )
 
         assert process.stdout is not None
-        buffer = bytearray()
+        reader = process.stdout
+        frame_bytes = self._frame_bytes
         frame_count = 0
+        # Encoder riêng cho stream này, không đụng encoder của lượt TTS đang chạy
+        encoder = OpusEncoder(self._audio_cfg)
 
         try:
+            # Đọc đúng 1 frame PCM mỗi lần: không cần buffer trung gian để cắt frame
+            tail = b""
             while True:
-                chunk = await process.stdout.read(8192)
-                if not chunk:
+                try:
+                    frame = await reader.readexactly(frame_bytes)
+                except asyncio.IncompleteReadError as e:
+                    tail = e.partial
                     break
-                buffer.extend(chunk)
-
-                while len(buffer) >= self._frame_bytes:
-                    frame = bytes(buffer[: self._frame_bytes])
-                    del buffer[: self._frame_bytes]
-                    frame_count += 1
-                    yield self._encoder.encode(frame)
+                frame_count += 1
+                yield encoder.encode(frame)
 
-            if buffer:
-                buffer.extend(b"\x00" * (self._frame_bytes - len(buffer)))
+            if tail:
                 frame_count += 1
-                yield self._encoder.encode(bytes(buffer))
+                yield encoder.encode(tail + b"\x00" * (frame_bytes - len(tail)))
 
             await process.wait()
             if process.returncode != 0:
@@ -1157,6 +1240,7 @@ class TTSService:
             logger.error("stream_audio_url error: %s", e, exc_info=True)
             process.kill()
         finally:
+            encoder.release()
             if process.returncode is None:
                 process.kill()
 
@@ -1173,6 +1257,15 @@ class TTSService:
             yield frame
 
     async def _resolve_audio_url_from_youtube(self, query: str) -> str | None:
+        """Resolve URL audio cho query, có cache LRU/TTL (chỉ cache kết quả thành công)."""
+        cache_key = " ".join(query.casefold().split())
+        return await _ytdlp_url_cache.get_or_fetch(
+            cache_key,
+            lambda: self._run_ytdlp(query),
+            should_cache=bool,
+        )
+
+    async def _run_ytdlp(self, query: str) -> str | None:
         ytdlp = shutil.which("yt-dlp")
         if not ytdlp:
             logger.warning("yt-dlp not found, full-song streaming unavailable")
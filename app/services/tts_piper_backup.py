@@ -9,21 +9,55 @@ import asyncio
 from app.server_logging import get_logger
 import math
 import shutil
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from math import gcd
 from pathlib import Path
-from queue import Queue
+from queue import Empty, Full, Queue
 from typing import AsyncGenerator
 
 import numpy as np
 from piper import PiperVoice
-from scipy.signal import resample_poly
+from scipy.signal import firwin, lfilter, resample_poly
 
 from app.config import AudioOutputConfig, TTSConfig
 from app.audio.opus_codec import OpusEncoder
 
 logger = get_logger(__name__)
 
+# Sau frame đầu tiên, encode + đẩy về event loop theo lô N frame
+# (1 lần call_soon_threadsafe / lô thay vì / frame).
+ENCODE_BATCH_FRAMES = 4
+
+# Thread pool chung cho 3 tầng Piper/DSP/encode của mọi session: không xếp hàng
+# sau các lệnh chặn khác (ffmpeg, yt-dlp...) trên default executor. Mỗi lượt
+# synthesize cần đủ 3 thread cùng lúc (các tầng chờ nhau qua queue) nên giới
+# hạn số lượt chạy song song bằng semaphore, pool luôn đủ thread cho mọi lượt.
+DSP_MAX_PIPELINES = 4
+_dsp_executor = ThreadPoolExecutor(max_workers=3 * DSP_MAX_PIPELINES, thread_name_prefix="tts-dsp")
+_dsp_slots = asyncio.Semaphore(DSP_MAX_PIPELINES)
+
+
+@dataclass(slots=True)
+class _DspState:
+    """State DSP nối liền giữa các chunk của 1 lượt synthesize (mới cho mỗi lượt)."""
+    lerp_pos: float = 0.0  # vị trí sample đích kế tiếp, tính từ sample cuối chunk trước
+    lerp_last: np.ndarray | None = None
+    robot_sample_idx: int = 0  # vị trí sample trong chu kỳ carrier vuông
+    robot_lp_prev: float = 0.0
+
+
+def _identity_pcm(samples: np.ndarray, state: _DspState) -> np.ndarray:
+    return samples
+
+
+def _to_pcm16_bytes(samples: np.ndarray) -> bytes:
+    """Lượng tử hóa 1 lần duy nhất ở cuối chuỗi DSP (clip tại chỗ rồi ép int16)."""
+    np.clip(samples, -32768, 32767, out=samples)
+    return samples.astype(np.int16).tobytes()
+
 
 class TTSService:
     """Chuyển text thành Opus audio frames dùng Piper TTS."""
@@ -51,15 +85,16 @@ class TTSService:
             g = gcd(self._target_rate, self._source_rate)
             self._up = self._target_rate // g    # 160
             self._down = self._source_rate // g  # 147
-
-        self._encoder = OpusEncoder(audio_cfg)
-        self._frame_bytes = self._encoder.frame_bytes
+            # Thiết kế FIR chống alias 1 lần (đúng filter mặc định của
+            # resample_poly: Kaiser beta=5, half_len=10*max) thay vì mỗi chunk.
+            max_rate = max(self._up, self._down)
+            self._resample_taps = firwin(20 * max_rate + 1, 1.0 / max_rate, window=("kaiser", 5.0))
+
+        # Encoder mượn theo từng lượt: prefetch câu sau chạy song song câu đang phát
+        self._audio_cfg = audio_cfg
+        self._frame_bytes = audio_cfg.frame_size * 2  # 2 bytes per int16 sample
         self._frame_duration_s = audio_cfg.frame_duration_ms / 1000.0
 
-        # State cho hiệu ứng robot để tránh pop/crack giữa các chunk
-        self._robot_phase = 0.0
-        self._robot_lp_prev = 0.0
-
         self._style_profiles = {
             "normal": {"enabled": False},
             "robot": {
@@ -90,6 +125,21 @@ class TTSService:
 
         logger.info(f"TTS voice_style: {self._voice_style}")
 
+        # Chọn hàm hiệu ứng 1 lần: style normal → trả nguyên PCM, không kiểm tra mỗi chunk
+        self._robot_profile = self._style_profiles[self._voice_style]
+        if self._robot_profile.get("enabled", False):
+            self._apply_voice_style = self._apply_robot_style
+        else:
+            self._apply_voice_style = _identity_pcm
+
+        # Resample nhanh: nội suy tuyến tính, giữ state qua các chunk
+        quality = (getattr(tts_cfg, "resample_quality", "auto") or "auto").strip().lower()
+        if quality == "auto":
+            quality = "fast" if self._robot_profile.get("enabled") else "high"
+        self._fast_resample = self._need_resample and quality == "fast"
+        if self._need_resample:
+            self._lerp_step = self._down / self._up  # số sample nguồn / 1 sample đích
+
         # Pre-tạo SynthesisConfig 1 lần
         from piper.config import SynthesisConfig
         self._syn_cfg = SynthesisConfig(
@@ -102,6 +152,9 @@ class TTSService:
         """Thời lượng 1 Opus frame (giây)."""
         return self._frame_duration_s
 
+    def close(self) -> None:
+        """Không giữ encoder/thread riêng giữa các lượt (dùng pool chung), để tương thích API."""
+
     async def synthesize(self, text: str) -> AsyncGenerator[bytes, None]:
         """
         Text → Opus frames (streaming per Piper chunk).
@@ -111,64 +164,152 @@ class TTSService:
             return
 
         loop = asyncio.get_running_loop()
-        pcm_buffer = bytearray()
         started_at = time.perf_counter()
         first_frame_at: float | None = None
         total_pcm_bytes = 0
         total_frames = 0
 
-        try:
-            # Chạy Piper ở thread riêng và stream PCM chunks về async loop.
-            queue: Queue[bytes | BaseException | object] = Queue(maxsize=8)
-            _DONE = object()
+        # 3 tầng chạy song song trên thread pool, nối bằng queue:
+        # Piper → (resample + style) → (cắt frame + Opus encode) → async loop.
+        pcm_q: Queue[bytes | BaseException | object] = Queue(maxsize=4)
+        processed_q: Queue[bytes | BaseException | object] = Queue(maxsize=4)
+        # Tầng cuối đẩy thẳng vào asyncio.Queue qua call_soon_threadsafe:
+        # async loop await trực tiếp, không chiếm thêm 1 thread pool chỉ để chờ get().
+        opus_q: asyncio.Queue[list[bytes] | BaseException | object] = asyncio.Queue()
+        _DONE = object()
+        # Set khi phía async dừng đọc (xong / abort) để các worker không kẹt ở put/get.
+        stop = threading.Event()
+        # State resample/robot và encoder riêng cho lượt này: không kế thừa đuôi
+        # câu trước, không đụng lượt prefetch chạy song song.
+        dsp_state = _DspState()
+
+        def _put(q: Queue, item: object) -> None:
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return
+                except Full:
+                    continue
 
-            def producer() -> None:
+        def _get(q: Queue) -> object:
+            while not stop.is_set():
                 try:
-                    for audio_chunk in self._voice.synthesize(text, syn_config=self._syn_cfg):
-                        pcm = audio_chunk.audio_int16_bytes
-                        if pcm:
-                            queue.put(pcm)
+                    return q.get(timeout=0.1)
+                except Empty:
+                    continue
+            return _DONE
+
+        def _emit(item: object) -> None:
+            if not stop.is_set():
+                loop.call_soon_threadsafe(opus_q.put_nowait, item)
+
+        def piper_worker() -> None:
+            try:
+                for audio_chunk in self._voice.synthesize(text, syn_config=self._syn_cfg):
+                    if stop.is_set():
+                        break
+                    # Lấy thẳng float [-1, 1] của Piper, bỏ vòng float→int16→float
+                    samples = audio_chunk.audio_float_array
+                    if samples.size:
+                        _put(pcm_q, samples)
+            except BaseException as e:
+                _put(pcm_q, e)
+            finally:
+                _put(pcm_q, _DONE)
+
+        def dsp_worker() -> None:
+            while True:
+                item = _get(pcm_q)
+                if item is _DONE or isinstance(item, BaseException):
+                    _put(processed_q, item)
+                    return
+                try:
+                    # Thang int16 dạng float32; bản copy riêng nên DSP ghi đè tại chỗ được
+                    samples = np.multiply(item, 32767.0, dtype=np.float32)
+                    if self._fast_resample:
+                        samples = self._resample_linear(samples, dsp_state)
+                    elif self._need_resample:
+                        samples = self._resample(samples)
+                    samples = self._apply_voice_style(samples, dsp_state)
+                    if samples.size:
+                        _put(processed_q, _to_pcm16_bytes(samples))
                 except BaseException as e:
-                    queue.put(e)
-                finally:
-                    queue.put(_DONE)
-
-            producer_future = loop.run_in_executor(None, producer)
+                    _put(processed_q, e)
+                    return
+
+        def encode_worker() -> None:
+            nonlocal total_pcm_bytes
+            pcm_buffer = bytearray()
+            frame_bytes = self._frame_bytes
+            batch_bytes = ENCODE_BATCH_FRAMES * frame_bytes
+            first_sent = False
+            try:
+                while True:
+                    item = _get(processed_q)
+                    if item is _DONE:
+                        break
+                    if isinstance(item, BaseException):
+                        _emit(item)
+                        return
+
+                    total_pcm_bytes += len(item)
+                    pcm_buffer.extend(item)
+
+                    # Encode ngay khi đủ frame: cắt qua memoryview (1 copy/frame
+                    # cho opuslib), dời phần dư về đầu buffer 1 lần mỗi chunk.
+                    usable = len(pcm_buffer) - len(pcm_buffer) % frame_bytes
+                    if not usable:
+                        continue
+                    with memoryview(pcm_buffer) as mv:
+                        offset = 0
+                        if not first_sent:
+                            # Frame đầu gửi riêng ngay để không trễ first-frame
+                            _emit([encoder.encode(bytes(mv[:frame_bytes]))])
+                            offset = frame_bytes
+                            first_sent = True
+                        while offset < usable:
+                            end = min(offset + batch_bytes, usable)
+                            frames = [bytes(mv[i : i + frame_bytes]) for i in range(offset, end, frame_bytes)]
+                            _emit(encoder.encode_many(frames))
+                            offset = end
+                    del pcm_buffer[:usable]
+
+                # Pad và encode phần còn lại
+                if len(pcm_buffer) > 0:
+                    pcm_buffer.extend(b"\x00" * (frame_bytes - len(pcm_buffer)))
+                    _emit([encoder.encode(bytes(pcm_buffer))])
+            except BaseException as e:
+                _emit(e)
+            finally:
+                # Trả encoder ngay trên thread dùng nó, kể cả khi phía async bỏ ngang
+                encoder.release()
+                _emit(_DONE)
+
+        await _dsp_slots.acquire()
+        encoder = OpusEncoder(self._audio_cfg)
+        workers = [
+            loop.run_in_executor(_dsp_executor, piper_worker),
+            loop.run_in_executor(_dsp_executor, dsp_worker),
+            loop.run_in_executor(_dsp_executor, encode_worker),
+        ]
+        # Nhả slot khi cả 3 thread thật sự xong, không phải khi generator dừng
+        asyncio.gather(*workers, return_exceptions=True).add_done_callback(lambda _: _dsp_slots.release())
 
+        try:
             while True:
-                item = await loop.run_in_executor(None, queue.get)
+                item = await opus_q.get()
                 if item is _DONE:
                     break
                 if isinstance(item, BaseException):
                     raise item
 
-                pcm_chunk = item
-                if self._need_resample:
-                    pcm_chunk = self._resample(pcm_chunk)
-
-                pcm_chunk = self._apply_voice_style(pcm_chunk)
-                total_pcm_bytes += len(pcm_chunk)
-
-                pcm_buffer.extend(pcm_chunk)
-
-                # Yield opus frames ngay khi đủ 1 frame
-                while len(pcm_buffer) >= self._frame_bytes:
-                    frame_data = bytes(pcm_buffer[: self._frame_bytes])
-                    pcm_buffer = pcm_buffer[self._frame_bytes :]
-                    total_frames += 1
-                    if first_frame_at is None:
-                        first_frame_at = time.perf_counter()
-                    yield self._encoder.encode(frame_data)
-
-            await producer_future
-
-            # Pad và encode phần còn lại
-            if len(pcm_buffer) > 0:
-                pcm_buffer.extend(b"\x00" * (self._frame_bytes - len(pcm_buffer)))
-                total_frames += 1
                 if first_frame_at is None:
                     first_frame_at = time.perf_counter()
-                yield self._encoder.encode(bytes(pcm_buffer))
+                for packet in item:
+                    total_frames += 1
+                    yield packet
+
+            await asyncio.gather(*workers)
 
             elapsed = time.perf_counter() - started_at
             first_frame_ms = (
@@ -191,6 +332,8 @@ class TTSService:
 
         except Exception as e:
             logger.error(f"Piper TTS error: {e}", exc_info=True)
+        finally:
+            stop.set()
 
     async def stream_audio_url(self, url: str) -> AsyncGenerator[bytes, None]:
         """Stream audio từ URL (ví dụ preview mp3) -> Opus frames 24kHz mono."""
@@ -252,26 +395,26 @@ class TTSService:
         )
 
         assert process.stdout is not None
-        buffer = bytearray()
+        reader = process.stdout
+        frame_bytes = self._frame_bytes
         frame_count = 0
+        encoder = OpusEncoder(self._audio_cfg)
 
         try:
+            # Đọc đúng 1 frame PCM mỗi lần: không cần buffer trung gian để cắt frame
+            tail = b""
             while True:
-                chunk = await process.stdout.read(8192)
-                if not chunk:
+                try:
+                    frame = await reader.readexactly(frame_bytes)
+                except asyncio.IncompleteReadError as e:
+                    tail = e.partial
                     break
-                buffer.extend(chunk)
-
-                while len(buffer) >= self._frame_bytes:
-                    frame = bytes(buffer[: self._frame_bytes])
-                    del buffer[: self._frame_bytes]
-                    frame_count += 1
-                    yield self._encoder.encode(frame)
+                frame_count += 1
+                yield encoder.encode(frame)
 
-            if buffer:
-                buffer.extend(b"\x00" * (self._frame_bytes - len(buffer)))
+            if tail:
                 frame_count += 1
-                yield self._encoder.encode(bytes(buffer))
+                yield encoder.encode(tail + b"\x00" * (frame_bytes - len(tail)))
 
             await process.wait()
             if process.returncode != 0:
@@ -287,6 +430,7 @@ class TTSService:
             logger.error("stream_audio_url error: %s", e, exc_info=True)
             process.kill()
         finally:
+            encoder.release()
             if process.returncode is None:
                 process.kill()
 
@@ -337,51 +481,80 @@ class TTSService:
         url = (stdout or b"").decode("utf-8", errors="ignore").strip().splitlines()
         return url[0].strip() if url else None
 
-    def _resample(self, pcm_data: bytes) -> bytes:
-        """Resample PCM int16 dùng polyphase filter (nhanh hơn FFT)."""
-        samples = np.frombuffer(pcm_data, dtype=np.int16).astype(np.float32)
-        resampled = resample_poly(samples, self._up, self._down)
-        return np.clip(resampled, -32768, 32767).astype(np.int16).tobytes()
-
-    def _apply_voice_style(self, pcm_data: bytes) -> bytes:
-        """Áp hiệu ứng giọng nói theo `voice_style` (normal/robot*)."""
-        profile = self._style_profiles[self._voice_style]
-        if not profile.get("enabled", False):
-            return pcm_data
-
-        x = np.frombuffer(pcm_data, dtype=np.int16).astype(np.float32)
-        if x.size == 0:
-            return pcm_data
-
-        # Normalize về [-1, 1]
-        dry = x / 32768.0
+    def _resample(self, samples: np.ndarray) -> np.ndarray:
+        """Resample audio float (thang int16) dùng polyphase filter (nhanh hơn FFT)."""
+        return resample_poly(samples, self._up, self._down, window=self._resample_taps)
+
+    def _resample_linear(self, samples: np.ndarray, state: _DspState) -> np.ndarray:
+        """Resample audio float bằng nội suy tuyến tính 2 tap (liền mạch giữa các chunk)."""
+        if state.lerp_last is not None:
+            samples = np.concatenate((state.lerp_last, samples))
+        if samples.size < 2:
+            if samples.size:
+                state.lerp_last = samples.copy()
+            return samples[:0]
+
+        last = samples.size - 1
+        count = int(math.ceil((last - state.lerp_pos) / self._lerp_step))
+        if count <= 0:
+            state.lerp_last = samples[-1:]
+            state.lerp_pos -= last
+            return samples[:0]
+
+        positions = state.lerp_pos + np.arange(count, dtype=np.float64) * self._lerp_step
+        out = np.interp(positions, np.arange(samples.size, dtype=np.float64), samples)
+
+        # Sample cuối làm điểm nội suy đầu cho chunk sau
+        state.lerp_last = samples[-1:].copy()
+        state.lerp_pos = state.lerp_pos + count * self._lerp_step - last
+        return out
+
+    def _apply_robot_style(self, dry: np.ndarray, state: _DspState) -> np.ndarray:
+        """Áp hiệu ứng robot theo profile của `voice_style` (robot*), ghi đè input.
+
+        Toàn bộ chuỗi hiệu ứng tuyến tính → làm thẳng trên thang int16,
+        không chuẩn hóa về [-1, 1] rồi nhân ngược lại (bớt 2 lượt quét).
+        """
+        profile = self._robot_profile
+        if dry.size == 0:
+            return dry
 
         # Ring-modulation kiểu robot: carrier hình vuông để accent robotic rõ.
         mod_hz = float(profile["mod_hz"])
         mix = float(profile["mix"])
         lp_hz = float(profile["lp_hz"])
 
-        phase_inc = 2.0 * math.pi * mod_hz / float(self._target_rate)
-        idx = np.arange(dry.size, dtype=np.float32)
-        phase = self._robot_phase + idx * phase_inc
-        carrier = np.sign(np.sin(phase))
-        carrier[carrier == 0] = 1.0
-        wet = dry * carrier
+        # Chỉ cần dấu của sin → lấy thẳng từ chỉ số nửa chu kỳ, không gọi np.sin.
+        samples_per_half = max(1, int(round(self._target_rate / (2.0 * mod_hz))))
+        # Nửa chu kỳ lẻ → đảo dấu; tính tại chỗ trên idx, không dựng mảng carrier.
+        idx = np.arange(state.robot_sample_idx, state.robot_sample_idx + dry.size, dtype=np.int64)
+        idx //= samples_per_half
+        idx &= 1
+        wet = dry.copy()
+        np.negative(wet, out=wet, where=idx.astype(bool))
 
         # 1-pole low-pass để bớt chói/cắt gắt
         dt = 1.0 / float(self._target_rate)
         rc = 1.0 / (2.0 * math.pi * max(lp_hz, 10.0))
         alpha = dt / (rc + dt)
 
-        y = np.empty_like(wet)
-        prev = self._robot_lp_prev
-        for i, sample in enumerate(wet):
-            prev = prev + alpha * (float(sample) - prev)
-            y[i] = prev
+        # y[n] = y[n-1] + alpha * (x[n] - y[n-1]) chạy trong C qua lfilter;
+        # zi giữ state giữa các chunk (tương đương prev của vòng lặp cũ).
+        # Hệ số cùng dtype với tín hiệu → lfilter không nâng lên float64.
+        decay = 1.0 - alpha
+        dtype = wet.dtype
+        y, _ = lfilter(
+            np.array([alpha], dtype=dtype),
+            np.array([1.0, -decay], dtype=dtype),
+            wet,
+            zi=np.array([decay * state.robot_lp_prev], dtype=dtype),
+        )
 
-        self._robot_lp_prev = prev
-        self._robot_phase = float((phase[-1] + phase_inc) % (2.0 * math.pi))
+        state.robot_lp_prev = float(y[-1])
+        state.robot_sample_idx = (state.robot_sample_idx + dry.size) % (2 * samples_per_half)
 
-        out = (1.0 - mix) * dry + mix * y
-        out = np.clip(out * 32768.0, -32768, 32767).astype(np.int16)
-        return out.tobytes()
+        # out = (1 - mix) * dry + mix * y, ghi đè vào buffer y
+        np.multiply(y, mix, out=y)
+        np.multiply(dry, 1.0 - mix, out=dry)
+        np.add(y, dry, out=y)
+        return y
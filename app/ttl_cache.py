@@ -0,0 +1,85 @@
+"""Cache LRU + TTL trong process, gộp các lượt fetch trùng key đang chạy.
+
+Dùng cho kết quả tra cứu mạng tốn thời gian (yt-dlp, Deezer): nhiều session
+hỏi cùng 1 key cùng lúc thì chỉ 1 lượt fetch chạy, các lượt khác chờ chung
+kết quả (kể cả khi fetch lỗi hoặc kết quả không được cache).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Generic, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+def _always(_value: object) -> bool:
+    return True
+
+
+class TTLCache(Generic[K, V]):
+    """LRU tối đa `max_entries` phần tử, mỗi phần tử sống `ttl_s` giây."""
+
+    def __init__(self, ttl_s: float, max_entries: int):
+        self._ttl_s = ttl_s
+        self._max_entries = max_entries
+        self._entries: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        # Future của lượt fetch đang chạy theo key (chỉ tồn tại trong lúc fetch)
+        self._inflight: dict[K, asyncio.Future[V]] = {}
+
+    def get(self, key: K) -> V | None:
+        hit = self._entries.get(key)
+        if hit is None:
+            return None
+        stored_at, value = hit
+        if time.monotonic() - stored_at > self._ttl_s:
+            self._entries.pop(key, None)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: K, value: V) -> None:
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_fetch(
+        self,
+        key: K,
+        fetch: Callable[[], Awaitable[V]],
+        *,
+        should_cache: Callable[[V], bool] = _always,
+    ) -> V:
+        """Trả giá trị cache; chưa có thì chạy `fetch` (1 lượt cho mọi caller cùng key).
+
+        Fetch chạy trong task riêng + shield: 1 caller bị cancel không hủy lượt
+        fetch mà các caller khác đang chờ.
+        """
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(self._fetch(key, fetch, should_cache))
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda done: self._fetch_done(key, done))
+        return await asyncio.shield(fut)
+
+    async def _fetch(self, key: K, fetch: Callable[[], Awaitable[V]], should_cache: Callable[[V], bool]) -> V:
+        value = await fetch()
+        if should_cache(value):
+            self.put(key, value)
+        return value
+
+    def _fetch_done(self, key: K, done: asyncio.Future[V]) -> None:
+        if self._inflight.get(key) is done:
+            del self._inflight[key]
+        # Mọi caller đã bị cancel thì không ai đọc lỗi → đánh dấu đã đọc, tránh log rác
+        if not done.cancelled():
+            done.exception()
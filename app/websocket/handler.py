@@ -6,18 +6,24 @@ Mỗi client kết nối = 1 instance handle_client().
 """
 
 import json
+import logging
 import struct
 import time
 import asyncio
 import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from app.server_logging import get_logger
 
+import orjson
+
 from fastapi import WebSocket, WebSocketDisconnect
 
 from app.config import config
 from app.mcp import MCPToolRegistry
 from app.models import ServerHello, AudioParams
-from app.websocket.session import Session, create_session, remove_session, get_all_sessions
+from app.audio.vad_math import VadBatcher, vad_peak_shortcut
+from app.websocket.session import DTX_MAX_OPUS_BYTES, Session, create_session, remove_session, get_session_by_device, get_session_by_id
 from app.robots.crud import get_robot_config, get_robot_by_mac, create_robot, update_robot_status, touch_robot_last_seen, generate_otp
 from app.database.chat_history import save_chat_session
 from app.database.assignments import get_latest_active_assignment_for_robot
@@ -25,10 +31,16 @@ from app.robots.models import RobotCreate
 
 logger = get_logger(__name__)
 mcp_tools = MCPToolRegistry()
-_session_ws: dict[str, WebSocket] = {}
-_session_send_locks: dict[str, asyncio.Lock] = {}
 _pending_offline_tasks: dict[str, asyncio.Task] = {}
 OFFLINE_DELAY_SECONDS = 300
+# Số message tối đa chờ trong hàng đợi gửi của 1 kết nối (~4s audio 60ms/frame)
+SEND_QUEUE_MAX = 64
+
+
+def get_session_ws(session_id: str) -> WebSocket | None:
+    """WebSocket đang mở của session (cho background task push dữ liệu)."""
+    session = get_session_by_id(session_id)
+    return session.ws if session else None
 
 
 def _cancel_pending_offline(device_id: str) -> None:
@@ -38,7 +50,7 @@ def _cancel_pending_offline(device_id: str) -> None:
 
 
 def _has_active_session_for_device(device_id: str) -> bool:
-    return any(s.device_id == device_id for s in get_all_sessions())
+    return get_session_by_device(device_id) is not None
 
 
 def _schedule_offline_if_inactive(device_id: str) -> None:
@@ -108,8 +120,9 @@ async def handle_client(ws: WebSocket) -> None:
     session = create_session(config, device_id, client_id)
     _cancel_pending_offline(device_id)
     # Register websocket for this session so background tasks can push to it
-    _session_ws[session.session_id] = ws
-    _session_send_locks[session.session_id] = asyncio.Lock()
+    session.ws = ws
+    session.send_queue = asyncio.Queue(maxsize=SEND_QUEUE_MAX)
+    session.sender_task = asyncio.create_task(_sender_loop(ws, session.send_queue))
 
     # Auto register robot from ESP32 identity headers (Device-Id/Client-Id)
     _ensure_robot_registered(device_id, client_id)
@@ -124,7 +137,12 @@ async def handle_client(ws: WebSocket) -> None:
                 if "text" in raw and raw["text"]:
                     await _on_text(ws, session, raw["text"])
                 elif "bytes" in raw and raw["bytes"]:
-                    _on_binary(ws, session, raw["bytes"], int(proto_version))
+                    if config.audio_input.decode_offload:
+                        await _on_binary_offloaded(ws, session, raw["bytes"], int(proto_version))
+                    elif _vad_batcher is not None:
+                        await _on_binary_batched(ws, session, raw["bytes"], int(proto_version))
+                    else:
+                        _on_binary(ws, session, raw["bytes"], int(proto_version))
 
             elif raw["type"] == "websocket.disconnect":
                 break
@@ -136,17 +154,10 @@ async def handle_client(ws: WebSocket) -> None:
     finally:
 
         # Nếu disconnect mà buffer còn data VÀ chưa trigger pipeline → trigger
-        frames = _frame_counters.pop(session.session_id, 0)
-        _low_rms_counters.pop(session.session_id, None)
-        _high_rms_counters.pop(session.session_id, None)
-        _post_high_silence_counters.pop(session.session_id, None)
-        _high_rms_armed.discard(session.session_id)
-        _rms_baseline_avg.pop(session.session_id, None)
-        _rms_noise_jitter.pop(session.session_id, None)
-        _pipeline_finished_at.pop(session.session_id, None)
-        already = session.session_id in _pipeline_triggered
+        frames = session.frame_count
+        already = session.pipeline_triggered
         if session.buffer_size > 3200 and not already:
-            _pipeline_triggered.add(session.session_id)
+            session.pipeline_triggered = True
             logger.info(f"[{device_id}] Disconnected with {frames} frames, buffer={session.buffer_size} bytes -> auto-triggering STT")
             try:
                 await _run_pipeline(ws, session)
@@ -155,7 +166,7 @@ async def handle_client(ws: WebSocket) -> None:
         else:
             logger.info(f"[{device_id}] Disconnected ({frames} frames, pipeline_already={'yes' if already else 'no'})")
 
-        _pipeline_triggered.discard(session.session_id)
+        session.pipeline_triggered = False
 
         try:
             touch_robot_last_seen(device_id)
@@ -164,12 +175,12 @@ async def handle_client(ws: WebSocket) -> None:
             logger.warning("[%s] Failed to schedule robot offline status: %s", device_id, e)
 
         # Cleanup websocket mapping and session
-        try:
-            _session_ws.pop(session.session_id, None)
-            # remove send lock
-            _session_send_locks.pop(session.session_id, None)
-        except Exception:
-            pass
+        if session.sender_task is not None:
+            session.sender_task.cancel()
+        _clear_send_queue(session)
+        session.ws = None
+        session.send_queue = None
+        session.sender_task = None
 
         remove_session(session.session_id)
 
@@ -178,22 +189,17 @@ async def handle_client(ws: WebSocket) -> None:
 async def _on_text(ws: WebSocket, session: Session, raw: str) -> None:
     """Phân loại JSON message và gọi handler tương ứng."""
     try:
-        msg = json.loads(raw)
-    except json.JSONDecodeError:
+        msg = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        msg = None
+    if not isinstance(msg, dict):
         logger.warning(f"[{session.device_id}] Invalid JSON: {raw[:100]}")
         return
 
     msg_type = msg.get("type", "")
     logger.info(f"[{session.device_id}] ← {msg_type}")
 
-    handlers = {
-        "hello": _handle_hello,
-        "listen": _handle_listen,
-        "abort": _handle_abort,
-        "mcp": _handle_mcp,
-    }
-
-    handler = handlers.get(msg_type)
+    handler = _TEXT_HANDLERS.get(msg_type)
     if handler:
         await handler(ws, session, msg)
     else:
@@ -201,16 +207,6 @@ async def _on_text(ws: WebSocket, session: Session, raw: str) -> None:
 
 
 
-_frame_counters: dict[str, int] = {}
-_low_rms_counters: dict[str, int] = {}
-_high_rms_counters: dict[str, int] = {}
-_post_high_silence_counters: dict[str, int] = {}
-_high_rms_armed: set[str] = set()
-_rms_baseline_avg: dict[str, float] = {}
-_rms_noise_jitter: dict[str, float] = {}
-_pipeline_triggered: set[str] = set()  # Chặn trigger pipeline nhiều lần
-_pipeline_finished_at: dict[str, float] = {}  # Timestamp khi pipeline kết thúc
-
 IDLE_TIMEOUT_FRAMES = 1000  
 LOW_RMS_THRESHOLD_MIN = 700
 LOW_RMS_FRAMES = 90
@@ -223,32 +219,20 @@ COOLDOWN_SECONDS = 1.5  # Bỏ qua audio residual sau khi pipeline xong
 MAX_UTTERANCE_FRAMES = 260  # ~15.6s @ 60ms/frame
 
 
-def _update_consecutive_counter(
-    counters: dict[str, int],
-    session_id: str,
-    *,
-    enabled: bool,
-    matched: bool,
-) -> int:
-    """Cập nhật bộ đếm frame liên tiếp theo điều kiện (clean helper)."""
-    if enabled and matched:
-        value = counters.get(session_id, 0) + 1
-    else:
-        value = 0
-    counters[session_id] = value
-    return value
+def _update_consecutive_counter(count: int, *, enabled: bool, matched: bool) -> int:
+    """Giá trị mới của bộ đếm frame liên tiếp theo điều kiện (clean helper)."""
+    return count + 1 if enabled and matched else 0
 
 
-def _update_rms_baseline(session_id: str, rms: float, *, freeze: bool) -> tuple[float, int]:
+def _update_rms_baseline(session: Session, rms: float, *, freeze: bool) -> tuple[float, int]:
     """Theo dõi baseline RMS động và biên nhiễu (kẹp 500-800)."""
-    baseline = _rms_baseline_avg.get(session_id)
-    jitter = _rms_noise_jitter.get(session_id, 0.0)
+    baseline = session.rms_baseline_avg
+    jitter = session.rms_noise_jitter
 
     if baseline is None:
-        baseline = rms
-        _rms_baseline_avg[session_id] = baseline
-        _rms_noise_jitter[session_id] = 0.0
-        return baseline, RMS_MARGIN_MIN
+        session.rms_baseline_avg = rms
+        session.rms_noise_jitter = 0.0
+        return rms, RMS_MARGIN_MIN
 
     abs_delta = abs(rms - baseline)
     jitter = (1.0 - 0.08) * jitter + 0.08 * abs_delta
@@ -259,101 +243,208 @@ def _update_rms_baseline(session_id: str, rms: float, *, freeze: bool) -> tuple[
         capped_rms = min(rms, baseline + margin)
         baseline = (1.0 - alpha) * baseline + alpha * capped_rms
 
-    _rms_baseline_avg[session_id] = baseline
-    _rms_noise_jitter[session_id] = jitter
+    session.rms_baseline_avg = baseline
+    session.rms_noise_jitter = jitter
     return baseline, margin
 
 
-def _on_binary(ws: WebSocket, session: Session, data: bytes, proto_version: int) -> None:
-    """Parse binary audio frame, thêm vào buffer, check VAD."""
+def _should_drop_audio(session: Session) -> bool:
+    """Trạng thái session hiện tại có bỏ qua frame audio mới không."""
     # Đang chạy pipeline thì bỏ qua frame mới để tránh tích lũy buffer vô hạn.
-    if session.session_id in _pipeline_triggered:
-        return
+    if session.pipeline_triggered:
+        return True
 
-    now = time.monotonic()
-    finished_at = _pipeline_finished_at.get(session.session_id)
-    if finished_at is not None and (now - finished_at) < COOLDOWN_SECONDS:
-        return
+    finished_at = session.pipeline_finished_at
+    if finished_at is not None and (time.monotonic() - finished_at) < COOLDOWN_SECONDS:
+        return True
 
     # Khi đã vào idle hoặc server đang phát TTS thì bỏ qua audio.
     # Tránh thu lại tiếng loa của chính thiết bị và trigger STT lặp.
-    if session.is_idling or session.is_speaking:
+    return session.is_idling or session.is_speaking
+
+
+def _on_binary(ws: WebSocket, session: Session, data: bytes, proto_version: int) -> None:
+    """Parse binary audio frame, thêm vào buffer, check VAD."""
+    if _should_drop_audio(session):
         return
 
     opus_data = _extract_opus_payload(data, proto_version)
     if not opus_data:
         return
+    if _on_dtx_frame(ws, session, opus_data):
+        return
 
     pcm = session.append_audio(opus_data)
     if pcm is None:
         return
 
-    count = _frame_counters.get(session.session_id, 0) + 1
-    _frame_counters[session.session_id] = count
+    _on_pcm(ws, session, pcm, session._calc_rms(pcm), len(opus_data))
+
+
+def _on_dtx_frame(ws: WebSocket, session: Session, opus_data: bytes) -> bool:
+    """Frame DTX (im lặng): không decode, không tính RMS, đi thẳng VAD với rms=0."""
+    if len(opus_data) > DTX_MAX_OPUS_BYTES:
+        return False
+    pcm = session.append_dtx_frame()
+    if pcm is None:
+        return False
+    _on_pcm(ws, session, pcm, 0.0, len(opus_data))
+    return True
+
+
+# Pool decode cho AUDIO_INPUT_DECODE_OFFLOAD, tạo khi frame đầu tiên cần tới.
+_audio_pool: ThreadPoolExecutor | None = None
+
+
+def _get_audio_pool() -> ThreadPoolExecutor:
+    global _audio_pool
+    if _audio_pool is None:
+        _audio_pool = ThreadPoolExecutor(
+            max_workers=max(2, (os.cpu_count() or 2) // 2),
+            thread_name_prefix="audio-in",
+        )
+    return _audio_pool
+
 
-    rms = session._calc_rms(pcm)
-    high_rms_armed = session.session_id in _high_rms_armed
+def _decode_and_measure(session: Session, opus_data: bytes) -> tuple[bytes, float] | None:
+    """Chạy trong worker thread: decode + RMS, chưa ghi gì vào session."""
+    pcm = session.decode_audio(opus_data)
+    if pcm is None:
+        return None
+    return pcm, session._calc_rms(pcm)
+
+
+async def _on_binary_offloaded(ws: WebSocket, session: Session, data: bytes, proto_version: int) -> None:
+    """Như `_on_binary` nhưng decode + RMS chạy trong thread pool.
+
+    Vòng nhận của kết nối await kết quả nên frame của 1 session vẫn tuần tự
+    (decoder không bị 2 thread dùng cùng lúc), các session khác chạy tiếp.
+    """
+    if _should_drop_audio(session):
+        return
+
+    opus_data = _extract_opus_payload(data, proto_version)
+    if not opus_data:
+        return
+    if _on_dtx_frame(ws, session, opus_data):
+        return
+
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(_get_audio_pool(), _decode_and_measure, session, opus_data)
+    # Trong lúc chờ, pipeline/TTS có thể đã bắt đầu → bỏ frame như bản đồng bộ
+    if result is None or _should_drop_audio(session):
+        return
+    pcm, rms = result
+    session.append_pcm(pcm)
+    _on_pcm(ws, session, pcm, rms, len(opus_data))
+
+
+# Gom RMS của mọi session theo cửa sổ AUDIO_INPUT_VAD_BATCH_MS (None = tắt).
+_vad_batcher: VadBatcher | None = (
+    VadBatcher(
+        config.audio_input.vad_batch_ms / 1000.0,
+        vad_peak_shortcut(config.vad.speech_threshold, config.vad.silence_threshold),
+    )
+    if config.audio_input.vad_batch_ms > 0
+    else None
+)
+
+
+async def _on_binary_batched(ws: WebSocket, session: Session, data: bytes, proto_version: int) -> None:
+    """Như `_on_binary` nhưng RMS được tính chung 1 lô với frame của các session khác."""
+    if _should_drop_audio(session):
+        return
+
+    opus_data = _extract_opus_payload(data, proto_version)
+    if not opus_data:
+        return
+    if _on_dtx_frame(ws, session, opus_data):
+        return
+
+    pcm = session.decode_audio(opus_data)
+    if pcm is None:
+        return
+    rms = await _vad_batcher.submit(pcm)
+    if _should_drop_audio(session):
+        return
+    session.append_pcm(pcm)
+    _on_pcm(ws, session, pcm, rms, len(opus_data))
+
+
+def _on_pcm(ws: WebSocket, session: Session, pcm: bytes | memoryview, rms: float, opus_len: int) -> None:
+    """Đếm frame, cập nhật các bộ đếm RMS + VAD và trigger pipeline khi cần."""
+    session.frame_count += 1
+    count = session.frame_count
+
+    high_rms_armed = session.high_rms_armed
     baseline_rms, adaptive_margin = _update_rms_baseline(
-        session.session_id,
+        session,
         rms,
         freeze=high_rms_armed,
     )
     dynamic_high_threshold = baseline_rms + RMS_SPIKE_DELTA
     dynamic_return_threshold = baseline_rms + adaptive_margin
 
-    high_rms_count = _update_consecutive_counter(
-        _high_rms_counters,
-        session.session_id,
+    high_rms_count = session.high_rms_count = _update_consecutive_counter(
+        session.high_rms_count,
         enabled=True,
         matched=rms > dynamic_high_threshold,
     )
 
     if (not high_rms_armed) and high_rms_count >= HIGH_RMS_FRAMES:
-        _high_rms_armed.add(session.session_id)
-        high_rms_armed = True
-        _post_high_silence_counters[session.session_id] = 0
+        session.high_rms_armed = high_rms_armed = True
+        session.post_high_silence_count = 0
         logger.info(
             f"[{session.device_id}] High-RMS armed: rms>{dynamic_high_threshold:.0f} "
             f"(base={baseline_rms:.0f}, spike=+{RMS_SPIKE_DELTA}) for {high_rms_count} frames"
         )
 
-    post_high_silence_count = _update_consecutive_counter(
-        _post_high_silence_counters,
-        session.session_id,
+    post_high_silence_count = session.post_high_silence_count = _update_consecutive_counter(
+        session.post_high_silence_count,
         enabled=high_rms_armed,
         matched=rms <= dynamic_return_threshold,
     )
 
     # Cập nhật VAD trước để lấy trạng thái mới nhất (_has_speech/_silent_frames/thresholds)
-    vad_state = session.check_vad(pcm)
+    vad_state = session.check_vad(pcm, rms=rms)
 
     # Low-RMS fallback chỉ hoạt động SAU KHI đã có speech.
     # Dùng ngưỡng động theo noise floor để tránh timeout giả khi phòng yên tĩnh.
     dynamic_low_rms_threshold = max(LOW_RMS_THRESHOLD_MIN, int(session._last_silence_threshold + 80))
-    low_rms_count = _update_consecutive_counter(
-        _low_rms_counters,
-        session.session_id,
+    low_rms_count = session.low_rms_count = _update_consecutive_counter(
+        session.low_rms_count,
         enabled=session._has_speech,
         matched=rms < dynamic_low_rms_threshold,
     )
 
-    if count <= 10 or count % 5 == 0:
+    # Log theo frame: chỉ format khi INFO bật (%-args, không f-string trên hot path)
+    if (count <= 10 or count % 5 == 0) and logger.isEnabledFor(logging.INFO):
         logger.info(
-            f"[{session.device_id}] #{count} rms={rms:.0f} "
-            f"base={baseline_rms:.0f} margin={adaptive_margin} "
-            f"noise_floor={session._noise_floor_rms:.0f} "
-            f"delta={session._last_rms_delta:.0f} "
-            f"th_s={session._last_speech_threshold:.0f} th_z={session._last_silence_threshold:.0f} "
-            f"silent_frames={session._silent_frames} has_speech={session._has_speech} "
-            f"high_rms={high_rms_count} "
-            f"high_armed={high_rms_armed} post_sil={post_high_silence_count} "
-            f"({len(opus_data)}B opus, {session.buffer_size}B buf)"
+            "[%s] #%d rms=%.0f base=%.0f margin=%s noise_floor=%.0f delta=%.0f "
+            "th_s=%.0f th_z=%.0f silent_frames=%d has_speech=%s high_rms=%d "
+            "high_armed=%s post_sil=%d (%dB opus, %dB buf)",
+            session.device_id,
+            count,
+            rms,
+            baseline_rms,
+            adaptive_margin,
+            session._noise_floor_rms,
+            session._last_rms_delta,
+            session._last_speech_threshold,
+            session._last_silence_threshold,
+            session._silent_frames,
+            session._has_speech,
+            high_rms_count,
+            high_rms_armed,
+            post_high_silence_count,
+            opus_len,
+            session.buffer_size,
         )
 
     if high_rms_armed and post_high_silence_count >= POST_HIGH_SILENCE_FRAMES:
-        _pipeline_triggered.add(session.session_id)
-        _high_rms_armed.discard(session.session_id)
-        _post_high_silence_counters[session.session_id] = 0
+        session.pipeline_triggered = True
+        session.high_rms_armed = False
+        session.post_high_silence_count = 0
         logger.info(
             f"[{session.device_id}] Adaptive High-RMS trigger: "
             f"rms>{dynamic_high_threshold:.0f}({HIGH_RMS_FRAMES}f) rồi "
@@ -364,7 +455,7 @@ def _on_binary(ws: WebSocket, session: Session, data: bytes, proto_version: int)
 
     # Trigger STT fallback khi đã có speech và đã im lặng đủ lâu.
     if session._has_speech and session._silent_frames >= 8 and low_rms_count >= LOW_RMS_FRAMES:
-        _pipeline_triggered.add(session.session_id)
+        session.pipeline_triggered = True
         logger.info(
             f"[{session.device_id}] Low-RMS timeout: rms<{dynamic_low_rms_threshold} for {low_rms_count} frames -> triggering STT"
         )
@@ -372,12 +463,12 @@ def _on_binary(ws: WebSocket, session: Session, data: bytes, proto_version: int)
         return
 
     if vad_state == 'silence_after_speech':
-        _pipeline_triggered.add(session.session_id)
+        session.pipeline_triggered = True
         logger.info(f"[{session.device_id}] VAD: silence after speech -- {count} frames, buffer={session.buffer_size} bytes -> triggering STT")
         asyncio.create_task(_run_pipeline(ws, session))
 
     elif session._has_speech and count >= MAX_UTTERANCE_FRAMES:
-        _pipeline_triggered.add(session.session_id)
+        session.pipeline_triggered = True
         logger.info(f"[{session.device_id}] Max utterance length ({count} frames) -> triggering STT")
         asyncio.create_task(_run_pipeline(ws, session))
 
@@ -386,18 +477,22 @@ def _on_binary(ws: WebSocket, session: Session, data: bytes, proto_version: int)
         if session.is_idling:
             return
 
-        _pipeline_triggered.add(session.session_id)
+        session.pipeline_triggered = True
         logger.info(f"\033[93m[{session.device_id}] ⏰ Idle timeout ({count} frames, ~{count*0.06:.0f}s) → goodbye (enter idle)\033[0m")
         # Enter idle state and play goodbye once (or send idle notification).
         asyncio.create_task(_goodbye_and_idle(ws, session))
 
 
+# Header protocol v3: [type:1][reserved:1][payload_size:2 big-endian]
+_V3_PAYLOAD_SIZE = struct.Struct("!H")
+
+
 def _extract_opus_payload(data: bytes, version: int) -> bytes | None:
     """Tách Opus payload từ binary frame (bỏ header nếu có)."""
     if version == 2 and len(data) > 16:
         return data[16:]
     elif version == 3 and len(data) > 4:
-        payload_size = struct.unpack("!H", data[2:4])[0]
+        payload_size = _V3_PAYLOAD_SIZE.unpack_from(data, 2)[0]
         return data[4 : 4 + payload_size]
     elif version == 1:
         return data
@@ -411,28 +506,27 @@ async def _goodbye_and_idle(ws: WebSocket, session: Session) -> None:
     # mark idling to avoid retriggers
     session.is_idling = True
     try:
-        await _send_json(ws, session, {"type": "tts", "state": "start"})
-        await _send_json(ws, session, {"type": "tts", "state": "sentence_start", "text": goodbye_text})
+        await _send_cached(session, session.tts_start_json)
+        await _send_json(session, {"type": "tts", "state": "sentence_start", "text": goodbye_text})
 
         logger.info(f"\033[92m🔊 Goodbye TTS: {goodbye_text}\033[0m")
-        async for opus_frame in session.pipeline._tts.synthesize(goodbye_text):
-            if session.aborted:
-                break
-            await ws.send_bytes(opus_frame)
-            await asyncio.sleep(0.054)  # pacing
+        # Pacing theo deadline tuyệt đối (pre-buffer + frame_duration_s), không trôi như sleep cố định
+        await session.pipeline._send_frames_with_pacing(
+            session.pipeline._tts.synthesize(goodbye_text),
+            on_tts_audio=lambda frame: enqueue_send(session, "bytes", frame),
+            is_aborted=session.abort_event.is_set,
+        )
 
-        await _send_json(ws, session, {"type": "tts", "state": "stop"})
+        await _send_cached(session, session.tts_stop_json)
+        # Chờ sender task gửi hết trước khi đóng websocket
+        if session.send_queue is not None:
+            await asyncio.wait_for(session.send_queue.join(), timeout=5.0)
     except Exception as e:
         logger.error(f"[{session.device_id}] Goodbye error: {e}")
 
     session.reset_audio_buffer()
-    _frame_counters.pop(session.session_id, None)
-    _low_rms_counters.pop(session.session_id, None)
-    _high_rms_counters.pop(session.session_id, None)
-    _post_high_silence_counters.pop(session.session_id, None)
-    _high_rms_armed.discard(session.session_id)
-    _rms_baseline_avg.pop(session.session_id, None)
-    _rms_noise_jitter.pop(session.session_id, None)
+    session.frame_count = 0
+    session.reset_rms_state()
 
     # Với ESP32 auto mode, sau tts stop thiết bị sẽ tự quay lại listening.
     # Đóng websocket để thiết bị chuyển hẳn về idle, tránh lặp lại timeout-goodbye.
@@ -453,7 +547,7 @@ async def _handle_hello(ws: WebSocket, session: Session, msg: dict) -> None:
             frame_duration=config.audio_output.frame_duration_ms,
         ),
     )
-    await ws.send_text(response.model_dump_json())
+    await _send_cached(session, response.model_dump_json())
     logger.info(f"[{session.device_id}] → hello (session={session.session_id[:8]}...)")
 
 
@@ -466,21 +560,16 @@ async def _handle_listen(ws: WebSocket, session: Session, msg: dict) -> None:
     if state in ("start", "detect"):
         session.reset_audio_buffer()
         session.is_idling = False
-        _pipeline_finished_at.pop(session.session_id, None)
-        _frame_counters[session.session_id] = 0
-        _low_rms_counters[session.session_id] = 0
-        _high_rms_counters[session.session_id] = 0
-        _post_high_silence_counters[session.session_id] = 0
-        _high_rms_armed.discard(session.session_id)
-        _rms_baseline_avg.pop(session.session_id, None)
-        _rms_noise_jitter.pop(session.session_id, None)
-        _pipeline_triggered.discard(session.session_id)
+        session.pipeline_finished_at = None
+        session.frame_count = 0
+        session.reset_rms_state()
+        session.pipeline_triggered = False
         logger.info(f"[{session.device_id}] Recording started (mode={mode})")
 
     elif state == "stop":
-        if session.session_id not in _pipeline_triggered:
-            _pipeline_triggered.add(session.session_id)
-            frames = _frame_counters.get(session.session_id, 0)
+        if not session.pipeline_triggered:
+            session.pipeline_triggered = True
+            frames = session.frame_count
             logger.info(f"[{session.device_id}] Recording stopped -- {frames} frames, buffer={session.buffer_size} bytes")
             asyncio.create_task(_run_pipeline(ws, session))
         else:
@@ -490,6 +579,7 @@ async def _handle_listen(ws: WebSocket, session: Session, msg: dict) -> None:
 async def _handle_abort(ws: WebSocket, session: Session, msg: dict) -> None:
     """Dừng phát audio ngay lập tức."""
     session.abort()
+    _drop_queued_audio(session)
     logger.info(f"[{session.device_id}] Aborted")
 
 
@@ -506,15 +596,11 @@ async def _handle_mcp(ws: WebSocket, session: Session, msg: dict) -> None:
     )
 
     if op in ("tools/list", "list_tools", "mcp.tools.list"):
-        await _send_json(
-            ws,
+        # Schema tool là hằng số → ghép chuỗi JSON dựng sẵn, không encode lại.
+        await _send_cached(
             session,
-            {
-                "type": "mcp",
-                "op": "tools/list",
-                "ok": True,
-                "tools": mcp_tools.list_tools(),
-            },
+            '{"type": "mcp", "op": "tools/list", "ok": true, "tools": '
+            f'{mcp_tools.list_tools_json()}, "session_id": {json.dumps(session.session_id)}}}'
         )
         return
 
@@ -535,7 +621,6 @@ async def _handle_mcp(ws: WebSocket, session: Session, msg: dict) -> None:
 
         result = await mcp_tools.call_tool(str(name or ""), arguments)
         await _send_json(
-            ws,
             session,
             {
                 "type": "mcp",
@@ -548,7 +633,6 @@ async def _handle_mcp(ws: WebSocket, session: Session, msg: dict) -> None:
         return
 
     await _send_json(
-        ws,
         session,
         {
             "type": "mcp",
@@ -559,25 +643,32 @@ async def _handle_mcp(ws: WebSocket, session: Session, msg: dict) -> None:
 
 
 
+# Bảng dispatch theo "type" — dựng 1 lần thay vì mỗi message.
+_TEXT_HANDLERS = {
+    "hello": _handle_hello,
+    "listen": _handle_listen,
+    "abort": _handle_abort,
+    "mcp": _handle_mcp,
+}
+
+
 async def _run_pipeline(ws: WebSocket, session: Session) -> None:
     """Chạy pipeline STT → LLM → TTS và gửi kết quả về client."""
-    pcm_data = session.take_audio_buffer()
-    duration_s = len(pcm_data) / (16000 * 2)  
-    logger.info(f"[{session.device_id}] Pipeline starting -- {len(pcm_data)} bytes ({duration_s:.1f}s audio)")
+    # Kiểm tra độ dài trên buffer của session trước, chưa lấy buffer ra
+    buffer_size = session.buffer_size
+    duration_s = buffer_size / (16000 * 2)
+    logger.info(f"[{session.device_id}] Pipeline starting -- {buffer_size} bytes ({duration_s:.1f}s audio)")
 
-    if len(pcm_data) < 3200:
+    if buffer_size < 3200:
         logger.info(f"[{session.device_id}] Audio quá ngắn ({duration_s:.1f}s), bỏ qua")
-        _pipeline_triggered.discard(session.session_id)
-        _frame_counters[session.session_id] = 0
-        _low_rms_counters[session.session_id] = 0
-        _high_rms_counters[session.session_id] = 0
-        _post_high_silence_counters[session.session_id] = 0
-        _high_rms_armed.discard(session.session_id)
-        _rms_baseline_avg.pop(session.session_id, None)
-        _rms_noise_jitter.pop(session.session_id, None)
+        session.pipeline_triggered = False
+        session.frame_count = 0
+        session.reset_rms_state()
         session.reset_audio_buffer()
         return
 
+    pcm_data = session.take_audio_buffer()
+
     # Get robot config to customize behavior
     robot_config = get_robot_config(session.device_id)
 
@@ -589,32 +680,24 @@ async def _run_pipeline(ws: WebSocket, session: Session) -> None:
         logger.warning("[%s] Failed to apply robot TTS config: %s", session.device_id, e)
     
     session.is_speaking = True
-    ws_open = True
 
+    # Message của pipeline đi qua sender task của kết nối → JSON và audio ra
+    # đúng thứ tự, không có 2 coroutine cùng ghi lên websocket.
     async def safe_send_json(data: dict) -> None:
-        nonlocal ws_open
-        if not ws_open:
-            return
-        try:
-            await _send_json(ws, session, data)
-        except Exception:
-            ws_open = False
+        await _send_json(session, data)
+
+    async def safe_send_text(text: str) -> None:
+        await enqueue_send(session, "text", text)
 
     async def safe_send_bytes(data: bytes) -> None:
-        nonlocal ws_open
-        if not ws_open:
-            return
-        try:
-            await ws.send_bytes(data)
-        except Exception:
-            ws_open = False
+        await enqueue_send(session, "bytes", data)
 
     async def on_stt_result(text: str) -> None:
         logger.info(f"[{session.device_id}] STT result: {text}")
         await safe_send_json({"type": "stt", "text": text})
 
     async def on_tts_start() -> None:
-        await safe_send_json({"type": "tts", "state": "start"})
+        await safe_send_text(session.tts_start_json)
 
     async def on_tts_sentence(text: str) -> None:
         logger.info(f"[{session.device_id}] TTS sentence: {text}")
@@ -628,7 +711,7 @@ async def _run_pipeline(ws: WebSocket, session: Session) -> None:
         await safe_send_bytes(opus_frame)
 
     async def on_tts_stop() -> None:
-        await safe_send_json({"type": "tts", "state": "stop"})
+        await safe_send_text(session.tts_stop_json)
 
     async def on_learning_card(payload: dict) -> None:
         image_url = payload.get("image_url")
@@ -702,7 +785,7 @@ async def _run_pipeline(ws: WebSocket, session: Session) -> None:
     if robot_config and robot_config.system_prompt:
         # Create a temporary chat history with the robot's system prompt
         chat_history = [{"role": "system", "content": robot_config.system_prompt}]
-        chat_history.extend(session.chat_history[1:])  # Add the rest of the history without the original system message
+        chat_history.extend(islice(session.chat_history, 1, None))  # Add the rest of the history without the original system message
 
     try:
         result = await session.pipeline.process(
@@ -718,7 +801,7 @@ async def _run_pipeline(ws: WebSocket, session: Session) -> None:
             on_learning_card=on_learning_card,
             assignment_provider=assignment_provider,
             on_emotion=on_emotion,
-            is_aborted=lambda: session.aborted,
+            is_aborted=session.abort_event.is_set,
         )
 
         if result:
@@ -730,7 +813,7 @@ async def _run_pipeline(ws: WebSocket, session: Session) -> None:
                 save_chat_session(
                     robot_mac=session.device_id,
                     session_id=session.session_id,
-                    messages=session.chat_history,
+                    messages=list(session.chat_history),
                 )
             except Exception as e:
                 logger.warning("[%s] Failed to save chat session: %s", session.device_id, e)
@@ -740,24 +823,90 @@ async def _run_pipeline(ws: WebSocket, session: Session) -> None:
         logger.error(f"[{session.device_id}] Pipeline error: {e}", exc_info=True)
     finally:
         session.is_speaking = False
-        _pipeline_finished_at[session.session_id] = time.monotonic()
+        session.pipeline_finished_at = time.monotonic()
         # Reset emotion to blink (nháy mắt) when done speaking
         await safe_send_json({"type": "llm", "emotion": "blink"})
 
         # ── CRITICAL FIX: cho phép nhận audio tiếp sau khi pipeline xong ──
-        _pipeline_triggered.discard(session.session_id)
-        _frame_counters[session.session_id] = 0
-        _low_rms_counters[session.session_id] = 0
-        _high_rms_counters[session.session_id] = 0
-        _post_high_silence_counters[session.session_id] = 0
-        _high_rms_armed.discard(session.session_id)
-        _rms_baseline_avg.pop(session.session_id, None)
-        _rms_noise_jitter.pop(session.session_id, None)
+        session.pipeline_triggered = False
+        session.frame_count = 0
+        session.reset_rms_state()
         session.reset_audio_buffer()
         logger.info(f"[{session.device_id}] Pipeline finished → reset state, ready for next utterance")
 
 
-async def _send_json(ws: WebSocket, session: Session, data: dict) -> None:
+async def _send_json(session: Session, data: dict) -> None:
     """Gửi JSON message kèm session_id."""
     data["session_id"] = session.session_id
-    await ws.send_text(json.dumps(data, ensure_ascii=False))
+    await enqueue_send(session, "text", json.dumps(data, ensure_ascii=False))
+
+
+async def _send_cached(session: Session, text: str) -> None:
+    """Gửi JSON đã serialize sẵn (vd. `session.tts_start_json`)."""
+    await enqueue_send(session, "text", text)
+
+
+async def _sender_loop(ws: WebSocket, queue: asyncio.Queue[tuple[str, str | bytes]]) -> None:
+    """Task gửi duy nhất của 1 kết nối: lấy (kind, payload) từ queue và ghi ra websocket.
+
+    Mọi nơi gửi (handler, pipeline, alarm scheduler) đều đi qua `enqueue_send`.
+    """
+    while True:
+        kind, payload = await queue.get()
+        try:
+            if kind == "bytes":
+                await ws.send_bytes(payload)
+            else:
+                await ws.send_text(payload)
+        except Exception:
+            # Websocket đã đóng: dừng task, enqueue_send sẽ bỏ qua message sau đó
+            _clear_send_queue_items(queue)
+            return
+        finally:
+            queue.task_done()
+
+
+async def enqueue_send(session: Session, kind: str, payload: str | bytes) -> bool:
+    """Xếp message vào hàng đợi gửi của session; False nếu kết nối đã đóng.
+
+    Queue có giới hạn: đầy thì chờ sender gửi bớt (backpressure cho TTS).
+    """
+    queue = session.send_queue
+    task = session.sender_task
+    if queue is None or task is None or task.done():
+        return False
+    await queue.put((kind, payload))
+    return True
+
+
+def _clear_send_queue_items(queue: asyncio.Queue[tuple[str, str | bytes]]) -> None:
+    while True:
+        try:
+            queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        queue.task_done()
+
+
+def _clear_send_queue(session: Session) -> None:
+    """Bỏ mọi message chưa gửi (kết nối đóng) → giải phóng coroutine đang chờ put."""
+    if session.send_queue is not None:
+        _clear_send_queue_items(session.send_queue)
+
+
+def _drop_queued_audio(session: Session) -> None:
+    """Abort: bỏ các frame audio còn trong queue, giữ lại message JSON theo thứ tự."""
+    queue = session.send_queue
+    if queue is None:
+        return
+    kept = []
+    while True:
+        try:
+            item = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            break
+        queue.task_done()
+        if item[0] != "bytes":
+            kept.append(item)
+    for item in kept:
+        queue.put_nowait(item)
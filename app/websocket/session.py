@@ -5,14 +5,22 @@ Mỗi ESP32 kết nối = 1 Session.
 Quản lý: audio buffer, chat history, trạng thái.
 """
 
-import uuid
-import struct
-import math
+import asyncio
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+from collections.abc import Iterator, ValuesView
 from app.server_logging import get_logger
 from datetime import datetime
 
+from fastapi import WebSocket
+
 from app.config import AppConfig
 from app.audio.opus_codec import OpusDecoder
+from app.audio.vad_math import vad_level, vad_peak_shortcut
 from app.mcp import MCPToolRegistry
 from app.services.intent import IntentDetectorService
 from app.services.stt import STTService
@@ -22,26 +30,82 @@ from app.services.pipeline import ConversationPipeline
 
 logger = get_logger(__name__)
 
+# Buffer PCM cấp phát sẵn cho mỗi session (1 MB ≈ 32s audio 16kHz int16), ghi
+# theo chỉ số thay vì bytearray.extend → không realloc/memmove khi câu nói dài.
+# Session đóng trả buffer về pool để session sau mượn lại.
+PCM_BUFFER_BYTES = 1 << 20
+PCM_BUFFER_POOL_MAX = 32
+_pcm_buffer_pool: list[bytearray] = []
+
+
+def _rent_pcm_buffer() -> bytearray:
+    if _pcm_buffer_pool:
+        return _pcm_buffer_pool.pop()
+    return bytearray(PCM_BUFFER_BYTES)
+
+
+def _return_pcm_buffer(buf: bytearray) -> None:
+    # Buffer đã bị nới rộng thì bỏ, pool chỉ giữ buffer kích thước chuẩn.
+    if len(buf) == PCM_BUFFER_BYTES and len(_pcm_buffer_pool) < PCM_BUFFER_POOL_MAX:
+        _pcm_buffer_pool.append(buf)
+
+# Opus DTX: encoder gửi frame im lặng chỉ 1-2 byte. Frame cỡ này ghi thẳng
+# PCM 0 vào buffer, bỏ qua decode + RMS; cứ DTX_DECODE_EVERY frame thì vẫn
+# decode thật 1 lần để state decoder không lệch quá xa.
+DTX_MAX_OPUS_BYTES = 2
+DTX_DECODE_EVERY = 50
+
+# session_id: hex(time_ns) + pid + bộ đếm — tăng dần, không gọi RNG của OS.
+# pid giữ id không trùng khi chạy nhiều worker process.
+_session_counter = itertools.count()
+
+
+def _new_session_id() -> str:
+    return f"{time.time_ns():x}{os.getpid() & 0xFFFF:04x}{next(_session_counter) & 0xFFFF:04x}"
+
+
+# Service không giữ state theo session (STT, LLM, intent, MCP tools) tạo 1 lần
+# cho cả process; mỗi session chỉ tạo TTS (runtime config + Opus encoder
+# riêng), decoder, buffer và state VAD/history.
+_shared_config: AppConfig | None = None
+_shared_stt: STTService | None = None
+_shared_llm: LLMService | None = None
+_shared_intent_detector: IntentDetectorService | None = None
+_shared_mcp: MCPToolRegistry | None = None
+
+
+def _get_shared_services(
+    config: AppConfig,
+) -> tuple[STTService, LLMService, IntentDetectorService, MCPToolRegistry]:
+    """Lazy singleton cho các service dùng chung; tạo lại nếu đổi object config."""
+    global _shared_config, _shared_stt, _shared_llm, _shared_intent_detector, _shared_mcp
+    if _shared_config is not config:
+        _shared_stt = STTService(config.stt)
+        _shared_llm = LLMService(config.llm)
+        _shared_intent_detector = IntentDetectorService(LLMService(config.intent_llm))
+        _shared_mcp = MCPToolRegistry()
+        _shared_config = config
+    return _shared_stt, _shared_llm, _shared_intent_detector, _shared_mcp
+
 
 class Session:
     """State cho 1 phiên kết nối client."""
 
     def __init__(self, config: AppConfig, device_id: str, client_id: str):
-        self.session_id = str(uuid.uuid4())
+        self.session_id = _new_session_id()
         self.device_id = device_id
         self.client_id = client_id
 
         # Audio
         self._decoder = OpusDecoder(config.audio_input)
-        self._pcm_buffer = bytearray()
+        self._pcm_buffer = _rent_pcm_buffer()
+        self._pcm_len = 0  # Số byte PCM hợp lệ ở đầu _pcm_buffer
+        self._silence_frame = bytes(self._decoder.max_frame_bytes)
+        self._dtx_frames = 0
 
-        # Services
-        stt = STTService(config.stt)
-        llm = LLMService(config.llm)
-        intent_llm = LLMService(config.intent_llm)
-        intent_detector = IntentDetectorService(intent_llm)
+        # Services: TTS có state riêng theo session, còn lại dùng chung
+        stt, llm, intent_detector, mcp_tools = _get_shared_services(config)
         tts = TTSService(config.tts, config.audio_output)
-        mcp_tools = MCPToolRegistry()
         self.pipeline = ConversationPipeline(
             stt,
             llm,
@@ -51,11 +115,36 @@ class Session:
         )
 
         # State
-        self.chat_history: list[dict] = []
+        # deque(maxlen) tự bỏ lượt cũ nhất khi đầy, không slice-copy mỗi lượt
+        self.chat_history: deque[dict] = deque(maxlen=config.max_chat_history)
         self.is_speaking = False
         self.is_idling = False
         self.last_idle_at: datetime | None = None
-        self.aborted = False
+        # Cờ abort: handler set, vòng phát TTS poll bằng `abort_event.is_set`
+        # (đọc atomic, an toàn cả trên build free-threaded).
+        self.abort_event = threading.Event()
+        # Kết nối + bookkeeping của handler, đọc mỗi frame audio nên để thẳng trên session
+        self.ws: WebSocket | None = None
+        # Hàng đợi gửi (kind, payload) + task gửi duy nhất của kết nối
+        self.send_queue: asyncio.Queue[tuple[str, str | bytes]] | None = None
+        self.sender_task: asyncio.Task | None = None
+        self.frame_count = 0
+        self.pipeline_triggered = False  # Chặn trigger pipeline nhiều lần
+        self.pipeline_finished_at: float | None = None  # monotonic lúc pipeline xong (cooldown)
+        # Bộ đếm RMS / trigger của handler (xem `reset_rms_state`)
+        self.low_rms_count = 0
+        self.high_rms_count = 0
+        self.post_high_silence_count = 0
+        self.high_rms_armed = False
+        self.rms_baseline_avg: float | None = None
+        self.rms_noise_jitter = 0.0
+        # JSON cố định gửi mỗi lượt TTS, serialize sẵn 1 lần cho session
+        self.tts_start_json = json.dumps(
+            {"type": "tts", "state": "start", "session_id": self.session_id}, ensure_ascii=False
+        )
+        self.tts_stop_json = json.dumps(
+            {"type": "tts", "state": "stop", "session_id": self.session_id}, ensure_ascii=False
+        )
         self.learning_context: dict[str, str | None] = {
             "mode": None,
             "topic_id": None,
@@ -67,9 +156,12 @@ class Session:
             "seen_words": "",
         }
 
-        self._max_history = config.max_chat_history
-
-        # VAD (Voice Activity Detection)
+        # VAD (Voice Activity Detection): ngưỡng đọc 1 lần từ config
+        self._speech_th = float(config.vad.speech_threshold)
+        self._silence_th = float(config.vad.silence_threshold)
+        self._vad_peak_shortcut = vad_peak_shortcut(self._speech_th, self._silence_th)
+        self._speech_frames_needed = config.vad.speech_frames_needed
+        self._silence_frames_needed = config.vad.silence_frames_needed
         self._silent_frames = 0  # Số frames im lặng liên tiếp
         self._has_speech = False  # Đã xác nhận giọng nói chưa
         self._speech_frames = 0  # Số frames có năng lượng cao (đếm để xác nhận)
@@ -81,7 +173,7 @@ class Session:
     @property
     def buffer_size(self) -> int:
         """Kích thước buffer PCM hiện tại (bytes)."""
-        return len(self._pcm_buffer)
+        return self._pcm_len
 
     def reset_audio_buffer(self) -> None:
         """Xóa buffer audio, chuẩn bị nhận recording mới.
@@ -89,7 +181,7 @@ class Session:
         GIỮ LẠI noise_floor_rms để tránh recalibration sai khi user
         đang nói → noise floor nhảy lên cao → speech không detect được.
         """
-        self._pcm_buffer = bytearray()
+        self._pcm_len = 0
         self._silent_frames = 0
         self._has_speech = False
         self._speech_frames = 0
@@ -97,27 +189,88 @@ class Session:
         self._last_speech_threshold = 0.0
         self._last_silence_threshold = 0.0
         self._last_rms_delta = 0.0
-        self.aborted = False
+        self.abort_event.clear()
+
+    def reset_rms_state(self) -> None:
+        """Reset bộ đếm RMS và baseline động của handler cho lượt nói mới."""
+        self.low_rms_count = 0
+        self.high_rms_count = 0
+        self.post_high_silence_count = 0
+        self.high_rms_armed = False
+        self.rms_baseline_avg = None
+        self.rms_noise_jitter = 0.0
 
-    def append_audio(self, opus_data: bytes) -> bytes | None:
-        """Decode 1 Opus frame, thêm PCM vào buffer, trả về PCM để phân tích."""
-        if self.aborted:
+    def append_audio(self, opus_data: bytes) -> memoryview | None:
+        """Decode 1 Opus frame thẳng vào buffer, trả về view PCM vừa ghi để phân tích.
+
+        View chỉ dùng trong frame hiện tại: frame sau có thể ghi đè vùng đó.
+        """
+        if self.abort_event.is_set():
             return None
+        start = self._pcm_len
+        self._reserve_pcm(self._decoder.max_frame_bytes)
+        buf = self._pcm_buffer
         try:
-            pcm = self._decoder.decode(opus_data)
-            self._pcm_buffer.extend(pcm)
-            return pcm
+            n_samples = self._decoder.decode_into(opus_data, buf, start)
         except Exception as e:
             logger.error(f"[{self.device_id}] Opus decode error: {e}")
             return None
+        end = start + n_samples * 2
+        self._pcm_len = end
+        return memoryview(buf)[start:end]
+
+    def append_dtx_frame(self) -> memoryview | None:
+        """Frame DTX: ghi 1 frame PCM 0 vào buffer thay vì decode, trả về view như `append_audio`.
+
+        Trả None khi đang abort hoặc tới lượt decode thật (caller đi đường thường).
+        """
+        if self.abort_event.is_set():
+            return None
+        self._dtx_frames += 1
+        if self._dtx_frames % DTX_DECODE_EVERY == 0:
+            return None
+        start = self._pcm_len
+        end = start + len(self._silence_frame)
+        self._reserve_pcm(len(self._silence_frame))
+        # Buffer mượn từ pool còn dữ liệu cũ → phải ghi 0 tường minh
+        self._pcm_buffer[start:end] = self._silence_frame
+        self._pcm_len = end
+        return memoryview(self._pcm_buffer)[start:end]
+
+    def decode_audio(self, opus_data: bytes) -> bytes | None:
+        """Decode 1 Opus frame (không đụng buffer, gọi được từ worker thread)."""
+        if self.abort_event.is_set():
+            return None
+        try:
+            return self._decoder.decode(opus_data)
+        except Exception as e:
+            logger.error(f"[{self.device_id}] Opus decode error: {e}")
+            return None
+
+    def append_pcm(self, pcm: bytes) -> None:
+        """Ghi PCM đã decode vào cuối buffer."""
+        start = self._pcm_len
+        end = start + len(pcm)
+        self._reserve_pcm(len(pcm))
+        # Gán slice cùng độ dài = memcpy tại chỗ, không đổi kích thước bytearray
+        self._pcm_buffer[start:end] = pcm
+        self._pcm_len = end
+
+    def _reserve_pcm(self, n_bytes: int) -> None:
+        """Bảo đảm buffer còn `n_bytes` trống sau vị trí ghi."""
+        buf = self._pcm_buffer
+        if self._pcm_len + n_bytes <= len(buf):
+            return
+        # Hiếm: câu nói dài hơn buffer → cấp buffer gấp đôi và copy sang. Không
+        # extend tại chỗ vì có thể còn memoryview của frame trước trỏ vào buf.
+        grown = bytearray(max(2 * len(buf), self._pcm_len + n_bytes))
+        grown[: self._pcm_len] = memoryview(buf)[: self._pcm_len]
+        self._pcm_buffer = grown
 
     def check_vad(
         self,
-        pcm: bytes,
-        speech_threshold: int = 500,
-        silence_threshold: int = 260,
-        speech_frames_needed: int = 8,
-        silence_frames_needed: int = 10,
+        pcm: bytes | memoryview,
+        rms: float | None = None,
     ) -> str:
         """
         Phân tích năng lượng âm thanh, trả về trạng thái.
@@ -125,105 +278,110 @@ class Session:
         Yêu cầu ít nhất `speech_frames_needed` frames có RMS > speech_threshold
         để xác nhận có người nói thật. Sau đó, nếu RMS < silence_threshold
         trong `silence_frames_needed` frames liên tiếp → trigger STT.
+        Các ngưỡng lấy từ `config.vad` lúc tạo session.
 
         Returns:
             'speech': Đang nói
             'silence_after_speech': Im lặng sau khi đã nói → trigger STT
             'silence': Im lặng (chưa nói gì)
+
+        `rms`: RMS caller đã tính cho chính frame này (tránh tính 2 lần).
         """
-        rms = self._calc_rms(pcm)
+        if rms is None:
+            rms = self._calc_rms(pcm)
 
-        # Ngưỡng tạm để quyết định có cập nhật noise floor hay không
-        pre_speech_gate = self._noise_floor_rms * 1.18 + 120.0 if self._noise_floor_rms > 0 else float(speech_threshold)
+        # Đọc state vào biến local 1 lần, ghi lại 1 lần (mỗi frame đều chạy qua đây)
+        floor = self._noise_floor_rms
+        has_speech = self._has_speech
 
         # Adaptive noise floor: theo dõi nền nhiễu nhưng không đuổi theo frame nghi là speech.
-        if self._noise_floor_rms <= 0:
-            self._noise_floor_rms = rms
-        else:
-            if not self._has_speech and rms > pre_speech_gate:
-                # Đang nghi có speech: freeze noise floor để không tự nâng ngưỡng.
-                pass
-            else:
-                # Hạ xuống nhanh hơn, tăng lên chậm hơn để bám nhiễu ổn định.
-                alpha = 0.06 if rms < self._noise_floor_rms else 0.015
-                capped = min(rms, self._noise_floor_rms * 1.08)
-                self._noise_floor_rms = (1.0 - alpha) * self._noise_floor_rms + alpha * capped
-
-        dynamic_speech_threshold = max(float(speech_threshold), self._noise_floor_rms * 1.18 + 120.0)
-        dynamic_silence_threshold = max(float(silence_threshold), self._noise_floor_rms * 1.08 + 60.0)
-        rms_delta = rms - self._noise_floor_rms
+        if floor <= 0:
+            floor = rms
+        # Đang nghi có speech (vượt ngưỡng tạm) thì freeze noise floor để không tự nâng ngưỡng.
+        elif has_speech or rms <= floor * 1.18 + 120.0:
+            # Hạ xuống nhanh hơn, tăng lên chậm hơn để bám nhiễu ổn định.
+            alpha = 0.06 if rms < floor else 0.015
+            floor = (1.0 - alpha) * floor + alpha * min(rms, floor * 1.08)
+        self._noise_floor_rms = floor
+
+        dynamic_speech_threshold = max(self._speech_th, floor * 1.18 + 120.0)
+        dynamic_silence_threshold = max(self._silence_th, floor * 1.08 + 60.0)
+        rms_delta = rms - floor
         self._last_speech_threshold = dynamic_speech_threshold
         self._last_silence_threshold = dynamic_silence_threshold
         self._last_rms_delta = rms_delta
 
         if rms > dynamic_speech_threshold and rms_delta > 120:
             self._silent_frames = 0
-            self._speech_frames += 1
-            if self._speech_frames >= speech_frames_needed:
+            speech_frames = self._speech_frames + 1
+            self._speech_frames = speech_frames
+            if speech_frames >= self._speech_frames_needed:
                 self._has_speech = True
             return 'speech'
-        elif rms > dynamic_silence_threshold:
+        if rms > dynamic_silence_threshold:
             self._silent_frames = 0
+            if has_speech:
+                return 'speech'
             # Chưa đủ mạnh để xác nhận speech: giảm dần bộ đếm để yêu cầu
             # các frame "speech mạnh" phải gần như liên tiếp, tránh cộng dồn
             # do nhiễu rời rạc.
-            if not self._has_speech and self._speech_frames > 0:
+            if self._speech_frames > 0:
                 self._speech_frames -= 1
-            return 'speech' if self._has_speech else 'silence'
-        else:
-            self._silent_frames += 1
-            if not self._has_speech:
-                # Nếu vẫn chưa vào trạng thái speech thì reset hẳn bộ đếm.
-                self._speech_frames = 0
-            if self._has_speech and self._silent_frames >= silence_frames_needed:
-                return 'silence_after_speech'
             return 'silence'
+        silent_frames = self._silent_frames + 1
+        self._silent_frames = silent_frames
+        if not has_speech:
+            # Nếu vẫn chưa vào trạng thái speech thì reset hẳn bộ đếm.
+            self._speech_frames = 0
+            return 'silence'
+        if silent_frames >= self._silence_frames_needed:
+            return 'silence_after_speech'
+        return 'silence'
 
     @property
     def has_speech(self) -> bool:
         return self._has_speech
 
-    @staticmethod
-    def _calc_rms(pcm: bytes) -> float:
-        """Tính AC RMS (trừ DC offset) của PCM int16."""
-        if len(pcm) < 2:
-            return 0.0
-        n_samples = len(pcm) // 2
-        samples = struct.unpack(f'<{n_samples}h', pcm[:n_samples * 2])
-        if not samples:
-            return 0.0
-        mean = sum(samples) / n_samples
-        sum_sq = sum((s - mean) * (s - mean) for s in samples)
-        return math.sqrt(sum_sq / n_samples)
+    def _calc_rms(self, pcm: bytes) -> float:
+        """Mức VAD của PCM int16 (AC RMS, frame gần im lặng lấy đỉnh)."""
+        return vad_level(pcm, self._vad_peak_shortcut)
 
     def take_audio_buffer(self) -> bytes:
-        """Lấy toàn bộ PCM buffer và xóa."""
-        data = bytes(self._pcm_buffer)
-        self._pcm_buffer = bytearray()
+        """Lấy PCM đã thu (1 lần copy) và xóa; buffer cấp phát sẵn được giữ lại."""
+        with memoryview(self._pcm_buffer) as mv:
+            data = bytes(mv[: self._pcm_len])
+        self._pcm_len = 0
         return data
 
     def save_history(self, user_text: str, assistant_text: str) -> None:
         """Lưu 1 lượt hội thoại vào history."""
         self.chat_history.append({"role": "user", "content": user_text})
         self.chat_history.append({"role": "assistant", "content": assistant_text})
-        # Giới hạn kích thước
-        if len(self.chat_history) > self._max_history:
-            self.chat_history = self.chat_history[-self._max_history :]
 
     def abort(self) -> None:
         """Đánh dấu abort — dừng phát audio."""
-        self.aborted = True
+        self.abort_event.set()
         self.is_speaking = False
 
+    def close(self) -> None:
+        """Giải phóng tài nguyên dùng chung (Opus encoder, buffer PCM) khi disconnect."""
+        self.pipeline._tts.close()
+        buf, self._pcm_buffer = self._pcm_buffer, bytearray()
+        self._pcm_len = 0
+        _return_pcm_buffer(buf)
+
 
 
 _active_sessions: dict[str, Session] = {}
+# Session mới nhất theo device_id (tra O(1) khi disconnect / lên lịch offline)
+_by_device: dict[str, Session] = {}
 
 
 def create_session(config: AppConfig, device_id: str, client_id: str) -> Session:
     """Tạo session mới và lưu vào registry."""
     session = Session(config, device_id, client_id)
     _active_sessions[session.session_id] = session
+    _by_device[device_id] = session
     logger.info(f"[{device_id}] Session created: {session.session_id}")
     return session
 
@@ -232,9 +390,45 @@ def remove_session(session_id: str) -> None:
     """Xóa session khi client disconnect."""
     removed = _active_sessions.pop(session_id, None)
     if removed:
+        if _by_device.get(removed.device_id) is removed:
+            del _by_device[removed.device_id]
+            # Hiếm: thiết bị reconnect khi session cũ chưa đóng → trỏ về session còn lại
+            for other in _active_sessions.values():
+                if other.device_id == removed.device_id:
+                    _by_device[other.device_id] = other
+                    break
+        removed.close()
         logger.info(f"[{removed.device_id}] Session removed: {session_id}")
 
 
-def get_all_sessions() -> list[Session]:
-    """Lấy danh sách tất cả sessions đang active."""
+def get_all_sessions() -> ValuesView[Session]:
+    """View các sessions đang active (không copy); chỉ dùng để duyệt ngay.
+
+    Cần list ổn định qua các điểm await thì dùng `snapshot_sessions`.
+    """
+    return _active_sessions.values()
+
+
+def snapshot_sessions() -> list[Session]:
+    """Copy danh sách sessions đang active ra list."""
     return list(_active_sessions.values())
+
+
+def iter_sessions() -> Iterator[Session]:
+    """Duyệt sessions đang active mà không copy ra list."""
+    return iter(_active_sessions.values())
+
+
+def session_count() -> int:
+    """Số sessions đang active."""
+    return len(_active_sessions)
+
+
+def get_session_by_id(session_id: str) -> Session | None:
+    """Tra session theo session_id (O(1))."""
+    return _active_sessions.get(session_id)
+
+
+def get_session_by_device(device_id: str) -> Session | None:
+    """Tra session mới nhất của device_id (O(1))."""
+    return _by_device.get(device_id)
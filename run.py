@@ -1,4 +1,7 @@
 import argparse
+import importlib.util
+import logging
+
 import uvicorn
 from app.config import config
 from app.server_logging import setup_logging
@@ -10,15 +13,39 @@ def main():
     parser.add_argument("--host", default=config.server.host, help="Bind host")
     parser.add_argument("--port", type=int, default=config.server.port, help="Bind port")
     parser.add_argument("--reload", action="store_true", help="Auto-reload on code change")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=config.server.workers,
+        help="Số worker process (session nằm trong RAM từng process → proxy phía trước phải sticky theo kết nối)",
+    )
     args = parser.parse_args()
 
+    # uvloop (libuv) + httptools: ít overhead hơn mỗi lần wake/frame so với
+    # asyncio loop mặc định + h11. Có sẵn trong uvicorn[standard] (uvloop không
+    # có trên Windows) → thiếu thì quay về bản thuần Python.
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = "httptools" if importlib.util.find_spec("httptools") else "h11"
+    logging.getLogger(__name__).info("Event loop: %s, HTTP parser: %s", loop, http)
+    workers = 1 if args.reload else max(1, args.workers)
+    if workers > 1:
+        logging.getLogger(__name__).warning(
+            "workers=%d: alarm scheduler chỉ chạy ở 1 worker, báo thức chỉ tới thiết bị nối vào worker đó",
+            workers,
+        )
+
     uvicorn.run(
         "app.main:app",
         host=args.host,
         port=args.port,
         reload=args.reload,
+        # --reload chỉ chạy được 1 process
+        workers=workers,
         log_level="info",
         log_config=None,
+        loop=loop,
+        http=http,
+        ws="websockets",
     )
 
 
@@ -0,0 +1,29 @@
+"""Test tách tên bài hát trong `IntentDetectorService.detect_fast`."""
+
+import pytest
+
+from app.services.intent import IntentDetectorService, _strip_music_command_words
+
+
+@pytest.fixture
+def detector() -> IntentDetectorService:
+    # detect_fast chỉ dùng rule, không gọi LLM
+    return IntentDetectorService(llm=None)
+
+
+def test_song_name_after_colon(detector: IntentDetectorService) -> None:
+    result = detector.detect_fast("mở bài hát: Em của ngày hôm qua")
+    assert result.intent == "music"
+    assert result.song_name == "em của ngày hôm qua"
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        'mở bài "em của ngày hôm qua"',
+        "mở bài “em của ngày hôm qua”",
+        "phát nhạc; em của ngày hôm qua.",
+    ],
+)
+def test_strip_command_words_with_quotes_and_semicolon(text: str) -> None:
+    assert _strip_music_command_words(text) == "em của ngày hôm qua"